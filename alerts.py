@@ -0,0 +1,406 @@
+"""
+Description: Alert rules matched against every new listing, with an index so matching does not scan all rules
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.0
+"""
+
+import json, re, threading, time
+
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from database import AlertRule, get_engine
+from models import parse_price
+from notify import notify_listings
+
+load_dotenv()
+# New listings sent as separate notifications per topic and crawl. The rest are summed up in one.
+ALERT_NOTIFY_LIMIT = int(getenv("ALERT_NOTIFY_LIMIT", 3))
+# Seconds between checks for rules changed by other processes, such as the API for worker.py.
+ALERT_RELOAD_SECONDS = float(getenv("ALERT_RELOAD_SECONDS", 10))
+# Listings remembered per topic, so a listing found by several searches is sent once.
+ALERT_RECENT_SIZE = 10000
+
+logger = getLogger(__name__)
+
+_NOT_WORD = re.compile(r"[\W_]+")
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def normalize_text(text):
+    """Returns: The text lowercased, with each run of punctuation and spaces as one space."""
+    return _NOT_WORD.sub(" ", (text or "").lower()).strip()
+
+
+def normalize_location(location):
+    """Returns: The location lowercased with single spaces, i.e. "Calgary,  AB" is "calgary, ab"."""
+    return " ".join((location or "").lower().split())
+
+
+def _location_keys(location):
+    """Returns: The keys a listing's location matches, the whole location and its city."""
+    location = normalize_location(location)
+    return {location, location.split(",")[0].strip()} - {""}
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over all the keywords of all rules. One pass over a title
+    finds every keyword in it, however many keywords there are. Keywords only match whole
+    words: text and keywords are normalized and matched with a space on each side.
+    """
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for keyword in keywords:
+            state = 0
+            for char in f" {keyword} ":
+                if (next_state := self._goto[state].get(char)) is None:
+                    next_state = self._goto[state][char] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] += (keyword,)
+
+        # Breadth first, so each state's failure state is built before its children.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                # Children of the root fail back to the root.
+                self._fail[child] = self._goto[fail].get(char, 0) if state else 0
+                self._out[child] += self._out[self._fail[child]]
+
+    def find(self, text):
+        """Returns: The set of keywords in the normalized text."""
+        found = set()
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for char in f" {text} ":
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class PriceIntervalIndex:
+    """
+    Segment tree over the rules' price bounds. Each range is stored at O(log n) nodes,
+    and a price finds the ranges containing it on the path from its leaf to the root.
+    Bounds are inclusive, None is unbounded.
+    """
+
+    def __init__(self, ranges):
+        """ranges: (min_price, max_price, item) tuples."""
+        self._points = sorted({bound for low, high, _ in ranges for bound in (low, high) if bound is not None})
+        # Slot 2k+1 is the point k, slot 2k lies between points k-1 and k.
+        self._size = 1
+        while self._size < 2 * len(self._points) + 1:
+            self._size *= 2
+        self._nodes = defaultdict(list)
+        for low, high, item in ranges:
+            left = 0 if low is None else 2 * bisect_left(self._points, low) + 1
+            right = 2 * len(self._points) if high is None else 2 * bisect_left(self._points, high) + 1
+            left, right = left + self._size, right + self._size + 1
+            while left < right:
+                if left & 1:
+                    self._nodes[left].append(item)
+                    left += 1
+                if right & 1:
+                    right -= 1
+                    self._nodes[right].append(item)
+                left //= 2
+                right //= 2
+
+    def _slot(self, price):
+        index = bisect_left(self._points, price)
+        if index < len(self._points) and self._points[index] == price:
+            return 2 * index + 1
+        return 2 * index
+
+    def find(self, price):
+        """Returns: The items of every range containing price."""
+        items = []
+        node = self._slot(price) + self._size
+        while node:
+            items.extend(self._nodes.get(node, ()))
+            node //= 2
+        return items
+
+
+class _CompiledRule:
+    __slots__ = ("rule", "include", "exclude", "min_price", "max_price", "locations", "min_deal_score")
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.include = {keyword for keyword in map(normalize_text, rule["include_keywords"]) if keyword}
+        self.exclude = {keyword for keyword in map(normalize_text, rule["exclude_keywords"]) if keyword}
+        self.min_price = rule["min_price"]
+        self.max_price = rule["max_price"]
+        self.locations = {location for location in map(normalize_location, rule["locations"]) if location}
+        self.min_deal_score = rule.get("min_deal_score")
+
+    def has_price(self):
+        return self.min_price is not None or self.max_price is not None
+
+    def matches(self, keywords, price, locations, deal_score=None):
+        if not self.include <= keywords or self.exclude & keywords:
+            return False
+        if self.min_deal_score is not None and (deal_score is None or deal_score < self.min_deal_score):
+            return False
+        if self.has_price():
+            if price is None:
+                return False
+            if self.min_price is not None and price < self.min_price:
+                return False
+            if self.max_price is not None and price > self.max_price:
+                return False
+        return not self.locations or bool(self.locations & locations)
+
+
+class AlertIndex:
+    """
+    Rules compiled for matching. Each rule is filed under its most selective filter:
+    its least common include keyword, else its locations, else its price range.
+    Rules with none of these are checked for every listing. A listing's candidates
+    come from the keywords found in its title, its location and its price, and only
+    those are checked against the rest of their rule, so matching costs grow with the
+    matching rules rather than the number of rules.
+    """
+
+    def __init__(self, rules):
+        compiled = [_CompiledRule(rule) for rule in rules]
+        keyword_rules = defaultdict(int)
+        for rule in compiled:
+            for keyword in rule.include:
+                keyword_rules[keyword] += 1
+
+        self._by_keyword = defaultdict(list)
+        self._by_location = defaultdict(list)
+        self._always = []
+        price_ranges = []
+        for rule in compiled:
+            if rule.include:
+                self._by_keyword[min(rule.include, key=lambda keyword: (keyword_rules[keyword], keyword))].append(rule)
+            elif rule.locations:
+                for location in rule.locations:
+                    self._by_location[location].append(rule)
+            elif rule.has_price():
+                price_ranges.append((rule.min_price, rule.max_price, rule))
+            else:
+                self._always.append(rule)
+
+        self.rule_count = len(compiled)
+        self._matcher = KeywordMatcher({keyword for rule in compiled for keyword in rule.include | rule.exclude})
+        self._prices = PriceIntervalIndex(price_ranges)
+
+    def match(self, title, price, location, deal_score=None):
+        """
+        title, price, location and deal score of a listing, with price as text ("CA$1,200") or a number.
+        Returns: The rules (as dictionaries) the listing matches.
+        """
+        keywords = self._matcher.find(normalize_text(title))
+        if isinstance(price, str) or price is None:
+            price = parse_price(price)
+        locations = _location_keys(location)
+
+        candidates = list(self._always)
+        for keyword in keywords:
+            candidates.extend(self._by_keyword.get(keyword, ()))
+        for key in locations:
+            candidates.extend(self._by_location.get(key, ()))
+        if price is not None:
+            candidates.extend(self._prices.find(price))
+
+        matched, seen = [], set()
+        for rule in candidates:
+            if id(rule) not in seen and rule.matches(keywords, price, locations, deal_score):
+                seen.add(id(rule))
+                matched.append(rule.rule)
+        return matched
+
+
+class AlertEngine:
+    """
+    The compiled index of the rules in the database. Rebuilt when rules are changed
+    through this module, or within ALERT_RELOAD_SECONDS when another process changed them.
+    """
+
+    def __init__(self, reload_seconds=ALERT_RELOAD_SECONDS):
+        self.reload_seconds = reload_seconds
+        self._index = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # (topic, url) recently sent, oldest first.
+        self._recent = OrderedDict()
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+    def index(self):
+        """Returns: The AlertIndex, rebuilt first if the rules changed."""
+        with self._lock:
+            if self._index is not None and time.monotonic() - self._checked_at < self.reload_seconds:
+                return self._index
+            with Session(get_engine()) as session:
+                # Deleting the newest rule and adding another can reuse its id. created_at still differs.
+                signature = tuple(session.execute(select(
+                    func.count(AlertRule.id), func.max(AlertRule.id),
+                    func.sum(AlertRule.id), func.max(AlertRule.created_at)
+                )).one())
+                if self._index is None or signature != self._signature:
+                    rules = [rule.to_dict() for rule in session.scalars(select(AlertRule))]
+                    start = time.perf_counter()
+                    self._index = AlertIndex(rules)
+                    self._signature = signature
+                    logger.info(f"Compiled {len(rules)} alert rules in {time.perf_counter() - start:.3f} seconds.")
+            self._checked_at = time.monotonic()
+            return self._index
+
+    def _is_recent(self, topic, url):
+        with self._lock:
+            key = (topic, url)
+            if key in self._recent:
+                return True
+            self._recent[key] = None
+            if len(self._recent) > ALERT_RECENT_SIZE:
+                self._recent.popitem(last=False)
+            return False
+
+    def match_listings(self, listings):
+        """
+        listings: ListingRecord or dictionaries with title, price, location, url and deal_score.
+        Returns: A dictionary of ntfy topic to the listings matched by its rules, each listing once.
+        """
+        index = self.index()
+        by_topic = defaultdict(list)
+        for listing in listings:
+            get = listing.get if isinstance(listing, dict) else lambda field: getattr(listing, field, None)
+            matched = index.match(get("title"), get("price"), get("location"), get("deal_score"))
+            topics = {rule["ntfy_topic"] for rule in matched}
+            for topic in topics:
+                if not self._is_recent(topic, get("url")):
+                    by_topic[topic].append(listing)
+        return dict(by_topic)
+
+
+alert_engine = AlertEngine()
+
+
+def _keyword_list(keywords):
+    """Returns: A list of keywords from a list or a comma separated string."""
+    if isinstance(keywords, str):
+        keywords = keywords.split(",")
+    return [" ".join(keyword.split()) for keyword in keywords or () if keyword and keyword.strip()]
+
+
+def add_alert_rule(ntfy_topic, include_keywords=None, exclude_keywords=None,
+                   min_price=None, max_price=None, locations=None, name=None, min_deal_score=None):
+    """
+    Add a rule sending new listings to ntfy_topic. A listing matches when its title has every
+    include keyword as whole words and no exclude keyword, its price is within min_price and
+    max_price, its location or city is one of locations, and its deal score is at least
+    min_deal_score (see price_stats.deal_score). Filters left out match any listing.
+    Keywords and locations are lists or comma separated strings.
+    Returns: The rule as a dictionary.
+    Throws: ValueError if the topic is missing or the price range is empty.
+    """
+    if not ntfy_topic or not ntfy_topic.strip():
+        raise ValueError("An alert rule needs an ntfy_topic.")
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise ValueError("min_price is more than max_price.")
+
+    include, exclude, locations = _keyword_list(include_keywords), _keyword_list(exclude_keywords), _keyword_list(locations)
+    with Session(get_engine()) as session:
+        rule = AlertRule(
+            name = name,
+            ntfy_topic = ntfy_topic.strip(),
+            include_keywords = json.dumps(include) if include else None,
+            exclude_keywords = json.dumps(exclude) if exclude else None,
+            min_price = min_price,
+            max_price = max_price,
+            locations = json.dumps(locations) if locations else None,
+            min_deal_score = min_deal_score,
+            created_at = _now(),
+        )
+        session.add(rule)
+        session.commit()
+        result = rule.to_dict()
+    alert_engine.invalidate()
+    logger.info(f"Added alert rule {result['id']} for topic {result['ntfy_topic']}.")
+    return result
+
+
+def get_alert_rules(ntfy_topic=None):
+    """Returns: All alert rules, or those of one topic, as dictionaries."""
+    with Session(get_engine()) as session:
+        stmt = select(AlertRule).order_by(AlertRule.id)
+        if ntfy_topic is not None:
+            stmt = stmt.where(AlertRule.ntfy_topic == ntfy_topic)
+        return [rule.to_dict() for rule in session.scalars(stmt)]
+
+
+def delete_alert_rule(rule_id):
+    """Returns: True if the rule existed."""
+    with Session(get_engine()) as session:
+        rule = session.get(AlertRule, rule_id)
+        if rule is None:
+            return False
+        session.delete(rule)
+        session.commit()
+    alert_engine.invalidate()
+    logger.info(f"Deleted alert rule {rule_id}.")
+    return True
+
+
+def match_alert_rules(listing):
+    """Returns: The rules matching one listing (ListingRecord or dictionary)."""
+    get = listing.get if isinstance(listing, dict) else lambda field: getattr(listing, field, None)
+    return alert_engine.index().match(get("title"), get("price"), get("location"), get("deal_score"))
+
+
+def notify_alerts(listings, limit=ALERT_NOTIFY_LIMIT):
+    """
+    Send new listings to the topics of the alert rules they match, each listing once per topic.
+    A failed topic does not stop the others.
+    Returns: The number of topics notified.
+    """
+    if not listings:
+        return 0
+    try:
+        by_topic = alert_engine.match_listings(listings)
+    except Exception as e:
+        logger.error(f"Matching alert rules failed: {e}", exc_info=True)
+        return 0
+
+    notified = 0
+    for topic, matched in by_topic.items():
+        try:
+            notify_listings(topic, matched, limit, more_text="{} more listings matched your alerts.")
+            notified += 1
+        except Exception as e:
+            logger.error(f"Sending alerts to {topic} failed: {e}")
+    return notified
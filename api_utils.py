@@ -1,14 +1,15 @@
 """
 Description: Functions to help with connecting to the API
 Date Created: 2024-08-27
-Date Modified: 2024-09-11
+Date Modified: 2026-10-19
 Author: SPolton
 Modified by: SPolton
-Version: 1.4.1
+Version: 1.7.3
 """
 
-import requests, logging
+import json, logging, queue, threading, time
 
+from collections import OrderedDict
 from os import getenv
 from dotenv import load_dotenv
 from urllib.parse import urlencode
@@ -21,6 +22,14 @@ PORT = int(getenv('PORT', 8000))
 API_URL_BASE = f"http://{HOST}:{PORT}"
 API_URL_CRAWL = API_URL_BASE + "/crawl_marketplace"
 API_URL_CRAWL_NEW = API_URL_CRAWL + "/new_results"
+API_URL_RESULTS = API_URL_BASE + "/results"
+API_URL_EVENTS = API_URL_BASE + "/events"
+API_URL_SCHEDULES = API_URL_BASE + "/schedules"
+API_URL_JOBS = API_URL_BASE + "/jobs"
+API_URL_SUBSCRIPTIONS = API_URL_BASE + "/subscriptions"
+
+# Responses kept for conditional requests to the results endpoint.
+RESULTS_CACHE_SIZE = 64
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +37,8 @@ def format_crawl_params(city, category, query=None, sort=None, min_price=None,
                      max_price=None, condition_values=None):
     """
     Returns the unencoded params needed for api crawl, based on user query.
+    The query is left as given for the crawl URL. The API keys the search
+    by its canonical form (see models.canonical_query).
     """
     terms = []
     if query:
@@ -58,30 +69,265 @@ def format_crawl_params(city, category, query=None, sort=None, min_price=None,
     return params
 
 
+def _api_error(e, res=None):
+    """Returns: A RuntimeError describing a failed API request."""
+    import requests
+
+    if isinstance(e, requests.exceptions.HTTPError):
+        detail = None
+        try:
+            detail = res.json().get("detail")
+        except ValueError:  # JSON decode error
+            detail = "No additional details available."
+        return RuntimeError(f"An error occured within the backend API." \
+                            f"\n\n{e}\n\nDetails: {detail}")
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return RuntimeError(f"Could not establish a connection to the API." \
+                            f" The sever might be down.\n\n{e}")
+    return RuntimeError(f"There was a problem with the request.\n\n{e}")
+
+
 def get_crawl_results(params, api_url=API_URL_CRAWL):
     """
     Attempts to conncet to the API and return the results.
     Throws: RuntimeError
     """
+    import requests  # Imported on first request to keep GUI startup fast.
+
     encoded_params = urlencode(params)
     url = f"{api_url}?{encoded_params}"
 
+    res = None
     try:
         logger.info(f"Request URL:\n{url}\n")
         res = requests.get(url, timeout=60)
         res.raise_for_status()  # Throw exception if response not OK
         return res.json()
+    except requests.exceptions.RequestException as e:
+        raise _api_error(e, res)
 
-    except requests.exceptions.HTTPError as e:
-        detail = None
-        try:
-            detail = res.json().get("detail")
-        except ValueError:  # JSON decode error
-            detail = "No additional details available."
-        raise RuntimeError(f"An error occured within the backend API." \
-                           f"\n\n{e}\n\nDetails: {detail}")
-    except requests.exceptions.ConnectionError as e:
-        raise RuntimeError(f"Could not establish a connection to the API." \
-                           f" The sever might be down.\n\n{e}")
+
+# A connection pool for each thread, and the last response for each URL.
+_http = threading.local()
+_results_cache = OrderedDict()
+_results_cache_lock = threading.Lock()
+
+def _get_http():
+    """
+    Returns: This thread's requests.Session. Sessions are not thread-safe, so Streamlit
+    script threads and event streams each use their own, and streams do not hold the pool of other calls.
+    """
+    if (session := getattr(_http, "session", None)) is None:
+        import requests
+        session = _http.session = requests.Session()
+    return session
+
+def _close_http():
+    """Close this thread's session, i.e. when a thread that streamed events ends."""
+    if (session := getattr(_http, "session", None)) is not None:
+        session.close()
+        _http.session = None
+
+
+def get_stored_results(search_id, after=None, limit=None, new_since=None, api_url=API_URL_RESULTS):
+    """
+    Get one page of a search's stored results, without crawling.
+    Requests are conditional: if the page is cached, its ETag is sent and
+    a 304 Not Modified answer is served from the cache.
+    Returns: {"search_id", "results", "next"}, where next is the after value of the next page.
+    Throws: RuntimeError
+    """
+    import requests
+
+    params = {"after": after, "limit": limit, "new_since": new_since.isoformat() if new_since else None}
+    query = urlencode({key: value for key, value in params.items() if value is not None})
+    url = f"{api_url}/{search_id}" + (f"?{query}" if query else "")
+
+    with _results_cache_lock:
+        cached = _results_cache.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+
+    res = None
+    try:
+        res = _get_http().get(url, headers=headers, timeout=60)
+        if res.status_code == 304 and cached:
+            logger.debug(f"Not modified: {url}")
+            return cached[1]
+        res.raise_for_status()
+        data = res.json()
+    except requests.exceptions.RequestException as e:
+        raise _api_error(e, res)
+
+    if etag := res.headers.get("ETag"):
+        with _results_cache_lock:
+            _results_cache[url] = (etag, data)
+            _results_cache.move_to_end(url)
+            while len(_results_cache) > RESULTS_CACHE_SIZE:
+                _results_cache.popitem(last=False)
+    return data
+
+
+def get_all_stored_results(search_id, new_since=None, limit=500, api_url=API_URL_RESULTS):
+    """
+    Get every stored result of a search, page by page, each with a conditional request.
+    Returns: A list of listings as dictionaries.
+    Throws: RuntimeError
+    """
+    results = []
+    after = None
+    while True:
+        page = get_stored_results(search_id, after, limit, new_since, api_url)
+        results.extend(page["results"])
+        if (after := page["next"]) is None:
+            return results
+
+
+def _api_request(method, url, **kwargs):
+    """
+    Send a request with the pooled session.
+    Returns: The response JSON.
+    Throws: RuntimeError
+    """
+    import requests
+
+    res = None
+    try:
+        res = _get_http().request(method, url, timeout=60, **kwargs)
+        res.raise_for_status()
+        return res.json()
     except requests.exceptions.RequestException as e:
-        raise RuntimeError(f"There was a problem with the request.\n\n{e}")
\ No newline at end of file
+        raise _api_error(e, res)
+
+
+def queue_crawl(params, incremental=False, api_url=API_URL_JOBS):
+    """
+    Ask the API to crawl a search once, in its queue workers.
+    Returns: {"job_id", "search_id"}
+    Throws: RuntimeError
+    """
+    return _api_request("POST", api_url, params={**params, "incremental": incremental})
+
+
+def create_schedule(params, interval, incremental=False, api_url=API_URL_SCHEDULES):
+    """
+    Ask the API to crawl a search now and every interval seconds.
+    Returns: The schedule, with its id and search_id.
+    Throws: RuntimeError
+    """
+    return _api_request("POST", api_url, params={**params, "interval": interval, "incremental": incremental})
+
+
+def delete_schedule(schedule_id, api_url=API_URL_SCHEDULES):
+    """Throws: RuntimeError"""
+    return _api_request("DELETE", f"{api_url}/{schedule_id}")
+
+
+def subscribe(params, subscriber, interval=None, ntfy_topic=None, incremental=False,
+              api_url=API_URL_SUBSCRIPTIONS):
+    """
+    Ask the API to follow a search for subscriber, crawling it every interval seconds if
+    given, and to send its new listings to ntfy_topic.
+    Returns: The subscription, with its id, search_id and schedule.
+    Throws: RuntimeError
+    """
+    options = {"subscriber": subscriber, "incremental": incremental}
+    if interval:
+        options["interval"] = interval
+    if ntfy_topic:
+        options["ntfy_topic"] = ntfy_topic
+    return _api_request("POST", api_url, params={**params, **options})
+
+
+def unsubscribe(subscription_id, api_url=API_URL_SUBSCRIPTIONS):
+    """Throws: RuntimeError"""
+    return _api_request("DELETE", f"{api_url}/{subscription_id}")
+
+
+class EventSubscription:
+    """
+    Follows a search's server-sent events on a daemon thread, reconnecting with the last
+    event id. Update events are put on the events queue as dictionaries, for the GUI
+    to take with poll(). The subscription ends itself if poll() is not called for
+    idle_timeout seconds, such as after the browser tab was closed.
+    """
+
+    def __init__(self, search_id, last_id=None, api_url=API_URL_EVENTS, idle_timeout=60):
+        self.search_id = search_id
+        self.last_id = last_id
+        self.url = f"{api_url}/{search_id}"
+        self.idle_timeout = idle_timeout
+        self.events = queue.Queue()
+        self.retry = 5
+        self._last_poll = time.monotonic()
+        self._stop = threading.Event()
+        self._response = None
+        self._thread = threading.Thread(target=self._run, name=f"events-{search_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._response is not None:
+            self._response.close()
+
+    @property
+    def running(self):
+        return self._thread.is_alive() and not self._stop.is_set()
+
+    def poll(self):
+        """Returns: The events received since the last poll."""
+        self._last_poll = time.monotonic()
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _idle(self):
+        return time.monotonic() - self._last_poll > self.idle_timeout
+
+    def _run(self):
+        while not self._stop.is_set() and not self._idle():
+            headers = {"Accept": "text/event-stream"}
+            if self.last_id is not None:
+                headers["Last-Event-ID"] = str(self.last_id)
+            try:
+                # Read timeout above the server's keep-alive interval.
+                with _get_http().get(self.url, headers=headers, stream=True, timeout=(5, 60)) as res:
+                    self._response = res
+                    if res.status_code == 404:
+                        logger.info(f"Search {self.search_id} no longer exists.")
+                        break
+                    res.raise_for_status()
+                    self._read(res)
+            except Exception as e:
+                # stop() closes the response under the reading thread, which can raise anything.
+                if self._stop.is_set():
+                    break
+                logger.warning(f"Event stream for search {self.search_id} lost: {e}")
+            self._stop.wait(self.retry)
+        _close_http()
+        logger.info(f"Stopped following events for search {self.search_id}.")
+
+    def _read(self, res):
+        """Parse the event stream, one field per line and a blank line after each event."""
+        data = []
+        for line in res.iter_lines(chunk_size=None, decode_unicode=True):
+            if self._stop.is_set() or self._idle():
+                return
+            if not line:
+                if data:
+                    self.events.put(json.loads("\n".join(data)))
+                    data = []
+                continue
+            field, _, value = line.partition(":")
+            value = value.removeprefix(" ")
+            if field == "data":
+                data.append(value)
+            elif field == "id" and value.isdigit():
+                self.last_id = int(value)
+            elif field == "retry" and value.isdigit():
+                self.retry = int(value) / 1000
@@ -1,27 +1,47 @@
 """
 Description: This file contains the code for Passivebot's Facebook Marketplace Scraper API.
 Date Created: 2024-01-24
-Date Modified: 2024-09-09
+Date Modified: 2026-10-19
 Author: Harminder Nijjar (v1.0.0)
 Modified by: SPolton
-Version: 1.5.1
+Version: 1.15.6
 Usage: python app.py
 """
 
-import json, logging, os, time, uvicorn
+import json, logging, math, os, socket, threading, time
 
+from contextlib import contextmanager
+from datetime import datetime
 from os import getenv
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup, element
 
-from fastapi import FastAPI, Response, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import BackgroundTasks, FastAPI, Query, Request, Response, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from playwright.sync_api import sync_playwright
-from playwright._impl._errors import TimeoutError
 
-from database import *
-from models import FBClassBullshit, MARKETPLACE_URL
+# Playwright and BeautifulSoup are imported inside the functions that use them,
+# so the API can start and answer health checks without loading them.
+from database import (
+    init_db, get_or_insert_search_criteria, insert_new_results, apply_crawl_results,
+    set_search_retention, get_result_urls, get_unenriched_result_urls, get_search_stats, dispose_async_engine,
+    get_listing_details_async, get_search_version_async, get_results_page_async, get_search_state_async
+)
+from alerts import add_alert_rule, delete_alert_rule, get_alert_rules, match_alert_rules, notify_alerts
+from crawl_pool import CrawlPool, CrawlPoolFull, CrawlTimeoutError
+from enrich import enrich_listings, ENRICH_DETAILS
+from events import EventBroker
+from governor import CrawlBudgetExceeded, CrawlGovernor, EMPTY, ERROR, LOGIN_WALL, OK, TIMEOUT
+from ip_info import get_ip_information
+from live_watch import LiveWatcher
+from jobs import enqueue_job, get_job, job_stats, retry_dead_job, JobDeferred
+from schedules import ScheduleRunner, delete_schedule, get_schedules, set_schedule
+from subscriptions import get_subscriptions, notify_subscribers, subscribe, unsubscribe
+from worker import Worker, crawl_job
+from export import check_export, export_stream, EXPORT_FORMATS
+from maintenance import MaintenanceScheduler
+from snapshots import find_snapshots, load_snapshot, parse_failed, save_snapshot
+from models import FBClassBullshit, ListingRecord, MARKETPLACE_BASE_URL, MARKETPLACE_URL
+from responses import CompactJSONResponse, cache_validators, is_not_modified, json_response
 
 # Retrieve sensitive data from environment variables
 load_dotenv()
@@ -29,6 +49,13 @@ FB_USER = getenv('FB_USER')
 FB_PASSWORD = getenv('FB_PASSWORD')
 HOST = getenv('HOST', "127.0.0.1")
 PORT = int(getenv("PORT", 8000))
+# Incremental crawls stop scrolling after this many known listings in a row.
+INCREMENTAL_STOP_AFTER = int(getenv("INCREMENTAL_STOP_AFTER", 5))
+# Crawl without a browser window, i.e. on a server or in load tests.
+BROWSER_HEADLESS = getenv("BROWSER_HEADLESS", "false").lower() == "true"
+COOKIES_FILE = getenv("COOKIES_FILE", "static/cookies.json")
+# Threads in the API that run queued and scheduled crawl jobs. 0 leaves them to worker.py.
+API_QUEUE_WORKERS = int(getenv("API_QUEUE_WORKERS", 1))
 
 # Configure logging
 logging.basicConfig(
@@ -52,10 +79,73 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["GET", "POST"],
+    allow_methods=["GET", "POST", "DELETE"],
     allow_headers=["Content-Type"],
 )
 
+# Number of browser crawls in progress. Maintenance waits for this to reach 0.
+_active_crawls = 0
+_active_crawls_lock = threading.Lock()
+
+@contextmanager
+def crawl_activity():
+    """Count a crawl as active for the duration of the block."""
+    global _active_crawls
+    with _active_crawls_lock:
+        _active_crawls += 1
+    try:
+        yield
+    finally:
+        with _active_crawls_lock:
+            _active_crawls -= 1
+
+def crawls_running():
+    return _active_crawls > 0
+
+maintenance = MaintenanceScheduler(is_busy=crawls_running)
+# Crawls run in worker processes when CRAWL_WORKERS > 0.
+crawl_pool = CrawlPool()
+# New listing events for /events subscribers.
+broker = EventBroker()
+# Crawl budget shared by the endpoints and queue workers. Schedules slow down while it backs off.
+governor = CrawlGovernor()
+schedule_runner = ScheduleRunner(stretch=governor.schedule_stretch)
+queue_workers = []
+
+def live_watch_listings(search_id, listings):
+    """Stores listings new to a live watch tab and notifies about those not stored before."""
+    new_results, _ = apply_crawl_results(search_id, listings, incremental=True)
+    broker.notify(search_id)
+    if new_results:
+        logger.info(f"Live watch found {len(new_results)} new listings for search_id {search_id}.")
+        notify_subscribers(search_id, new_results)
+        notify_alerts(new_results)
+
+# Resident browser tabs for hot searches, refreshed in place.
+live_watcher = LiveWatcher(live_watch_listings, governor=governor, account=FB_USER)
+
+@app.on_event("startup")
+def start_background_jobs():
+    maintenance.start()
+    schedule_runner.start()
+    for i in range(API_QUEUE_WORKERS):
+        worker = Worker(f"api-{socket.gethostname()}-{os.getpid()}-{i}", handler=api_crawl_job)
+        threading.Thread(target=worker.run, name=f"queue-worker-{i}", daemon=True).start()
+        queue_workers.append(worker)
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    maintenance.stop()
+    schedule_runner.stop()
+    for worker in queue_workers:
+        worker.stop()
+    live_watcher.stop()
+    crawl_pool.shutdown()
+
+@app.on_event("shutdown")
+async def close_database():
+    await dispose_async_engine()
+
 # Route to the root endpoint.
 @app.get("/")
 def root() -> Response:
@@ -68,16 +158,30 @@ def root() -> Response:
     )
 
 
+@app.get("/health")
+def health() -> JSONResponse:
+    """
+    Liveness check. Does not touch the database or the browser,
+    so it answers as soon as the process is up.
+    """
+    return JSONResponse({"status": "ok"})
+
+
 @app.get("/crawl_marketplace")
-def crawl_marketplace(city: str, category: str, query: str) -> JSONResponse:
+def crawl_marketplace(request: Request, city: str, category: str, query: str) -> CompactJSONResponse:
     """
     Attempts to scrape Facebook Marketplace for listing information.
-    Returns: A JSON Response containing a list of dictionaries.
-    Throws: HTTPException 500 on RuntimeError.
+    Returns: A JSON Response containing a list of listings.
+    Throws: HTTPException 429 if the crawl budget is exhausted, 503 if every crawl worker is busy,
+    500 on RuntimeError.
     """
     try:
-        results = crawl_marketplace_logic(city, category, query)
-        return JSONResponse(results)
+        results = run_crawl(city, category, query)
+        return json_response(request, results)
+    except CrawlBudgetExceeded as e:
+        raise budget_exceeded(e)
+    except CrawlPoolFull as e:
+        raise pool_full(e)
     except AssertionError as e:
         raise HTTPException(401, str(e))
     except RuntimeError as e:
@@ -88,31 +192,49 @@ def crawl_marketplace(city: str, category: str, query: str) -> JSONResponse:
 
 
 @app.get("/crawl_marketplace/new_results")
-def crawl_marketplace_new_results(city: str, category: str, query: str) -> JSONResponse:
+def crawl_marketplace_new_results(request: Request, background_tasks: BackgroundTasks,
+                                  city: str, category: str, query: str,
+                                  incremental: bool = False,
+                                  stop_after: int = INCREMENTAL_STOP_AFTER) -> CompactJSONResponse:
     """
     Attempts to scrape Facebook Marketplace for new listings.
     Results are compared to the previous results.
+    With incremental, scrolling stops after stop_after listings in a row that
+    are already stored, and stale listings are not removed, since the crawl
+    did not see the whole feed. Best with sortBy=creation_time_descend.
+    Subscribers of the search are notified of new listings after the response is sent,
+    and if ENRICH_DETAILS is enabled, the search's listings without details are enriched.
     Returns: A JSON Response containing a list of new listings.
-    Throws: HTTPException 500 on RuntimeError
+    Throws: HTTPException 429 if the crawl budget is exhausted, 503 if every crawl worker is busy,
+    500 on RuntimeError
     """
     try:
         logger.debug("Entering crawl_marketplace_new_listings")
-        results = crawl_marketplace_logic(city, category, query)
+        known_urls = None
+        if incremental and category != "test":
+            known_urls = get_result_urls(get_or_insert_search_criteria(city, category, query))
+        results = run_crawl(city, category, query, known_urls, stop_after)
 
         if len(results) > 0 and category != "test":
             search_id = get_or_insert_search_criteria(city, category, query)
             logger.info(f"Accessing database with search_id {search_id}")
 
-            remove_stale_results(search_id, results)
-            insert_new_results(search_id, results)
-            new_results = get_new_results(search_id)
-            db_results = get_results(search_id)
-            set_all_not_new(search_id)
+            new_results, db_results = apply_crawl_results(search_id, results, incremental)
+            broker.notify(search_id)
 
             logger.info(f"Found {len(new_results)} new listings.")
-            return JSONResponse(db_results)
-        return JSONResponse(results)
+            if new_results:
+                background_tasks.add_task(notify_subscribers, search_id, new_results)
+                background_tasks.add_task(notify_alerts, new_results)
+            if ENRICH_DETAILS:
+                background_tasks.add_task(enrich_search_listings, search_id)
+            return json_response(request, db_results)
+        return json_response(request, results)
     
+    except CrawlBudgetExceeded as e:
+        raise budget_exceeded(e)
+    except CrawlPoolFull as e:
+        raise pool_full(e)
     except AssertionError as e:
         raise HTTPException(401, str(e))
     except RuntimeError as e:
@@ -122,9 +244,442 @@ def crawl_marketplace_new_results(city: str, category: str, query: str) -> JSONR
         raise HTTPException(500, str(e))
 
 
-def crawl_marketplace_logic(city, category, query):
+@app.get("/stats/{search_id}")
+def search_stats(search_id: int) -> CompactJSONResponse:
+    """
+    Returns: Statistics of the listings first seen by a search: listing_count, priced_count,
+    price quantiles (within PRICE_SKETCH_ACCURACY) and first_seen_rate, new listings per hour.
+    Throws: HTTPException 404 if the search has no statistics yet.
+    """
+    if (stats := get_search_stats(search_id)) is None:
+        raise HTTPException(404, f"No statistics for search {search_id}.")
+    return CompactJSONResponse(stats)
+
+
+@app.get("/results/{search_id}")
+async def results_page(request: Request, search_id: int, after: str | None = None,
+                 limit: int = Query(100, ge=1, le=1000), new_since: datetime | None = None) -> Response:
+    """
+    Stored results of a search, without crawling, in pages of limit listings
+    ordered by (order, id). Pass the returned next value as after for the next page.
+    new_since only returns listings first found at or after that time.
+    ETag and Last-Modified come from the search's last change, so polling clients
+    get 304 Not Modified until new results are stored.
+    Returns: {"search_id", "results", "next"}, where next is None on the last page.
+    Throws: HTTPException 400 on a malformed after, 404 if the search does not exist.
+    """
+    cursor = None
+    if after is not None:
+        try:
+            order, listing_id = after.split(":")
+            cursor = (int(order), int(listing_id))
+        except ValueError:
+            raise HTTPException(400, "after must be <order>:<id>, as returned in next.")
+
+    # Read the version before the page, so a change in between is caught by the next poll.
+    if (changed := await get_search_version_async(search_id)) is None:
+        raise HTTPException(404, f"Search {search_id} not found.")
+    validators = cache_validators(search_id, changed)
+    if is_not_modified(request, validators):
+        return Response(status_code=304, headers=validators)
+
+    results = await get_results_page_async(search_id, cursor, limit, new_since)
+    next_after = f"{results[-1].order}:{results[-1].id}" if len(results) == limit else None
+    return json_response(
+        request, {"search_id": search_id, "results": results, "next": next_after}, headers=validators
+    )
+
+
+@app.get("/events/{search_id}")
+async def events(request: Request, search_id: int, last_id: int | None = None) -> StreamingResponse:
+    """
+    Server-sent events for a search. An update event is sent each time the search is
+    crawled, with the listings stored since the previous event, the result count and
+    the last crawl time. Clients that reconnect with Last-Event-ID (or last_id)
+    receive the listings they missed.
+    Throws: HTTPException 404 if the search does not exist.
+    """
+    if last_id is None and (last_event_id := request.headers.get("last-event-id", "")).isdigit():
+        last_id = int(last_event_id)
+    if await get_search_state_async(search_id) is None:
+        raise HTTPException(404, f"Search {search_id} not found.")
+    return StreamingResponse(
+        broker.stream(search_id, last_id),
+        media_type = "text/event-stream",
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/schedules")
+def schedules_set(city: str, category: str, query: str, interval: int, incremental: bool = False,
+                  run_now: bool = True) -> CompactJSONResponse:
+    """
+    Crawls a search every interval seconds, in the API's queue workers or worker.py.
+    Scheduling a search again changes its interval. Follow the results with /events/{search_id}.
+    Returns: The schedule, including its id and search_id.
+    """
+    return CompactJSONResponse(set_schedule(city, category, query, interval, incremental, run_now))
+
+
+@app.get("/schedules")
+def schedules_list() -> CompactJSONResponse:
+    """Returns: All schedules with their search and next run time."""
+    return CompactJSONResponse(get_schedules())
+
+
+@app.delete("/schedules/{schedule_id}")
+def schedules_delete(schedule_id: int) -> CompactJSONResponse:
+    """
+    Stops crawling a search on a schedule. Its stored results are kept.
+    Throws: HTTPException 404 if the schedule does not exist.
+    """
+    if not delete_schedule(schedule_id):
+        raise HTTPException(404, f"Schedule {schedule_id} not found.")
+    return CompactJSONResponse({"schedule_id": schedule_id})
+
+
+@app.post("/subscriptions")
+def subscriptions_add(city: str, category: str, query: str, subscriber: str,
+                      interval: int | None = None, ntfy_topic: str | None = None,
+                      incremental: bool = False) -> CompactJSONResponse:
+    """
+    Follows a search for a subscriber, such as a user or GUI session. Equivalent searches
+    share one canonical search, crawled once at the shortest interval of its subscribers.
+    New listings are sent to each subscribed ntfy topic. Subscribing again changes the
+    interval and topic. Follow the results with /events/{search_id}.
+    Returns: The subscription, including its id, search_id and schedule.
+    """
+    return CompactJSONResponse(subscribe(city, category, query, subscriber, interval, ntfy_topic, incremental))
+
+
+@app.get("/subscriptions")
+def subscriptions_list(search_id: int | None = None) -> CompactJSONResponse:
+    """Returns: All subscriptions, or those of one search."""
+    return CompactJSONResponse(get_subscriptions(search_id))
+
+
+@app.delete("/subscriptions/{subscription_id}")
+def subscriptions_delete(subscription_id: int) -> CompactJSONResponse:
+    """
+    Stops following a search. Its schedule runs at the shortest interval of the
+    remaining subscribers, or stops when none is left.
+    Throws: HTTPException 404 if the subscription does not exist.
+    """
+    if not unsubscribe(subscription_id):
+        raise HTTPException(404, f"Subscription {subscription_id} not found.")
+    return CompactJSONResponse({"subscription_id": subscription_id})
+
+
+@app.post("/alerts")
+def alerts_add(ntfy_topic: str, include: str | None = None, exclude: str | None = None,
+               min_price: int | None = None, max_price: int | None = None,
+               locations: str | None = None, name: str | None = None,
+               min_deal_score: float | None = None) -> CompactJSONResponse:
+    """
+    Adds an alert rule. Every new listing of any search is sent to ntfy_topic if its title
+    has all include keywords and none of the exclude keywords, its price is within the range
+    and its location is one of locations. With min_deal_score, only listings that far below
+    their search's median price match, i.e. 0.2. Keywords and locations are comma separated.
+    Returns: The rule, with its id.
+    Throws: HTTPException 400 if the rule is not valid.
+    """
+    try:
+        return CompactJSONResponse(add_alert_rule(
+            ntfy_topic, include, exclude, min_price, max_price, locations, name, min_deal_score
+        ))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+@app.get("/alerts")
+def alerts_list(ntfy_topic: str | None = None) -> CompactJSONResponse:
+    """Returns: All alert rules, or those of one topic."""
+    return CompactJSONResponse(get_alert_rules(ntfy_topic))
+
+
+@app.get("/alerts/match")
+def alerts_match(title: str, price: str | None = None, location: str | None = None,
+                 deal_score: float | None = None) -> CompactJSONResponse:
+    """Returns: The alert rules a listing with this title, price, location and deal score would match."""
+    return CompactJSONResponse(match_alert_rules(
+        {"title": title, "price": price, "location": location, "deal_score": deal_score}
+    ))
+
+
+@app.delete("/alerts/{rule_id}")
+def alerts_delete(rule_id: int) -> CompactJSONResponse:
+    """Throws: HTTPException 404 if the rule does not exist."""
+    if not delete_alert_rule(rule_id):
+        raise HTTPException(404, f"Alert rule {rule_id} not found.")
+    return CompactJSONResponse({"rule_id": rule_id})
+
+
+@app.post("/live_watch")
+def live_watch_add(city: str, category: str, query: str, interval: float | None = None) -> CompactJSONResponse:
+    """
+    Keeps a browser tab open on a hot search and refreshes it every interval seconds,
+    LIVE_WATCH_INTERVAL by default. Only listings not in the tab at the last refresh
+    are stored, and subscribers and alert rules are notified of those new to the search.
+    At most LIVE_WATCH_MAX_TABS searches are watched, the least recently watched is dropped.
+    Watching a search again renews it. Follow the results with /events/{search_id}.
+    Returns: The search_id and the live watch status.
     """
-    Returns a list of listings
+    search_id = get_or_insert_search_criteria(city, category, query)
+    live_watcher.watch(search_id, city, category, query, interval)
+    return CompactJSONResponse({"search_id": search_id, **live_watcher.status()})
+
+
+@app.get("/live_watch")
+def live_watch_status() -> CompactJSONResponse:
+    """
+    Returns: The watched searches, most recently watched first, with their refresh counts,
+    new listings found, listings in the tab and last error, and the tab cap.
+    """
+    return CompactJSONResponse(live_watcher.status())
+
+
+@app.delete("/live_watch/{search_id}")
+def live_watch_delete(search_id: int) -> CompactJSONResponse:
+    """
+    Stops live watching a search and closes its tab. Its stored results are kept.
+    Throws: HTTPException 404 if the search is not watched.
+    """
+    if not live_watcher.unwatch(search_id):
+        raise HTTPException(404, f"Search {search_id} is not live watched.")
+    return CompactJSONResponse({"search_id": search_id})
+
+
+@app.post("/jobs")
+def jobs_enqueue(city: str, category: str, query: str, incremental: bool = False,
+                 delay: float = 0) -> CompactJSONResponse:
+    """
+    Queues a crawl for the queue workers instead of crawling in this request.
+    A search that is already queued or running is not queued twice.
+    Returns: The job id, and the search_id to follow with /events/{search_id}.
+    """
+    return CompactJSONResponse({
+        "job_id": enqueue_job(city, category, query, incremental, delay),
+        "search_id": get_or_insert_search_criteria(city, category, query),
+    })
+
+
+@app.get("/jobs")
+def jobs_stats() -> CompactJSONResponse:
+    """Returns: The number of jobs queued, running, done and dead."""
+    return CompactJSONResponse(job_stats())
+
+
+@app.get("/jobs/{job_id}")
+def jobs_get(job_id: int) -> CompactJSONResponse:
+    """
+    Returns: The job status, attempts, last error and result counts.
+    Throws: HTTPException 404 if the job does not exist.
+    """
+    if (job := get_job(job_id)) is None:
+        raise HTTPException(404, f"Job {job_id} not found.")
+    return CompactJSONResponse(job)
+
+
+@app.post("/jobs/{job_id}/retry")
+def jobs_retry(job_id: int) -> CompactJSONResponse:
+    """
+    Queues a dead-lettered job again.
+    Throws: HTTPException 404 if the job does not exist or is not dead.
+    """
+    if not retry_dead_job(job_id):
+        raise HTTPException(404, f"No dead job {job_id}.")
+    return CompactJSONResponse({"job_id": job_id})
+
+
+@app.get("/listing_details")
+async def listing_details(url: list[str] = Query()) -> CompactJSONResponse:
+    """
+    Returns: The stored details (description, seller, listed at, images) for
+    each listing URL that has been enriched.
+    """
+    return CompactJSONResponse(await get_listing_details_async(url))
+
+
+def enrich_search_listings(search_id):
+    """
+    Background task: Opens the item pages of a search's stored listings without details,
+    newest first, and stores their details. Listings left when the time or page budget runs
+    out are still without details, so the next crawl of the search picks them up.
+    """
+    urls = get_unenriched_result_urls(search_id)
+    if urls:
+        with crawl_activity():
+            enrich_listings(urls, prepare_context=load_cookies, governor=governor, account=FB_USER)
+
+
+@app.get("/export/{table}")
+def export(table: str, format: str = "ndjson", search_id: int | None = None,
+           since: datetime | None = None, until: datetime | None = None) -> StreamingResponse:
+    """
+    Streams the 'results' or 'search_criteria' table as ndjson, csv or parquet.
+    Rows can be filtered by search_id and timestamp (since inclusive, until exclusive).
+    Throws: HTTPException 400 on an unknown table or format.
+    """
+    try:
+        check_export(table, format)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    filename = f"{table}.{format}"
+    return StreamingResponse(
+        export_stream(table, format, search_id, since, until),
+        media_type = EXPORT_FORMATS[format],
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.get("/crawl_pool")
+def crawl_pool_status() -> CompactJSONResponse:
+    """Returns: The crawl worker processes, with their crawl counts and memory use."""
+    return CompactJSONResponse(crawl_pool.status())
+
+
+@app.get("/governor")
+def governor_status() -> CompactJSONResponse:
+    """
+    Returns: The global and per account crawl budgets, how many crawls were refused,
+    block signal counts, backoff state, and the factor schedules are stretched by.
+    """
+    return CompactJSONResponse(governor.status())
+
+
+def budget_exceeded(e):
+    """Returns: A 429 HTTPException telling the client when to retry."""
+    return HTTPException(429, str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+
+def pool_full(e):
+    """Returns: A 503 HTTPException telling the client when a crawl worker may be free."""
+    return HTTPException(503, str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+
+@app.get("/maintenance")
+def maintenance_status() -> CompactJSONResponse:
+    """Returns: The report from the last maintenance run, or null if none has run."""
+    return CompactJSONResponse({"last_report": maintenance.last_report})
+
+
+@app.post("/maintenance/run")
+def maintenance_run() -> CompactJSONResponse:
+    """
+    Runs retention, orphan cleanup, incremental vacuum and ANALYZE now.
+    Waits for running crawls to finish first.
+    Returns: The maintenance report with database stats before and after.
+    """
+    return CompactJSONResponse(maintenance.run_now())
+
+
+@app.post("/maintenance/retention/{search_id}")
+def maintenance_retention(search_id: int, days: int | None = None) -> CompactJSONResponse:
+    """
+    Sets how many days a search is kept after it was last crawled.
+    Omit days to use the default RETENTION_DAYS, or use 0 to keep it forever.
+    Throws: HTTPException 404 if the search does not exist.
+    """
+    if not set_search_retention(search_id, days):
+        raise HTTPException(404, f"Search {search_id} not found.")
+    return CompactJSONResponse({"search_id": search_id, "retention_days": days})
+
+
+@app.get("/snapshots")
+def snapshots(city: str | None = None, category: str | None = None, query: str | None = None,
+              since: datetime | None = None, until: datetime | None = None, limit: int = 100) -> CompactJSONResponse:
+    """Returns: The stored page snapshots for a search, newest first."""
+    return CompactJSONResponse(find_snapshots(city, category, query, since, until, limit))
+
+
+@app.post("/snapshots/reparse")
+def snapshots_reparse(request: Request, city: str | None = None, category: str | None = None,
+                      query: str | None = None, since: datetime | None = None,
+                      until: datetime | None = None, limit: int = 100, store: bool = False) -> CompactJSONResponse:
+    """
+    Runs the current parser over stored snapshots, to check a selector fix
+    or recover listings that were missed, without crawling Facebook.
+    If store is true, parsed listings not yet in the database are added to their search.
+    Returns: The listings parsed per snapshot and the number stored.
+    """
+    reports = []
+    inserted = 0
+    for snapshot in find_snapshots(city, category, query, since, until, limit):
+        try:
+            parsed, _ = extract_listings(load_snapshot(snapshot["id"]))
+        except (KeyError, FileNotFoundError) as e:
+            logger.warning(f"Snapshot {snapshot['id']} could not be loaded: {e}")
+            continue
+
+        if store and parsed and snapshot["category"] != "test":
+            search_id = get_or_insert_search_criteria(snapshot["city"], snapshot["category"], snapshot["query"])
+            inserted += insert_new_results(search_id, parsed)
+
+        reports.append({
+            "id": snapshot["id"],
+            "timestamp": snapshot["timestamp"],
+            "city": snapshot["city"],
+            "category": snapshot["category"],
+            "query": snapshot["query"],
+            "listing_count": snapshot["listing_count"],
+            "parsed": parsed,
+        })
+
+    logger.info(f"Re-parsed {len(reports)} snapshots, inserted {inserted} listings.")
+    return json_response(request, {"snapshots": reports, "inserted": inserted})
+
+
+def api_crawl_job(job):
+    """Job handler for the API's queue workers. Crawls with run_crawl, then wakes event subscribers."""
+    result = crawl_job(job)
+    if result["search_id"] is not None:
+        broker.notify(result["search_id"])
+    return result
+
+
+def run_crawl(city, category, query, known_urls=None, stop_after=INCREMENTAL_STOP_AFTER):
+    """
+    Crawls in a worker process if the crawl pool is enabled, else in this process.
+    Each crawl is taken from the governor's budget, and its outcome is fed back,
+    so login walls, empty pages and timeouts slow crawling down.
+    With the pool, the budget is only taken once a worker is free.
+    Returns a list of ListingRecord
+    Throws: CrawlBudgetExceeded if the crawl must wait, CrawlPoolFull if every crawl worker is busy.
+    """
+    if category == "test":
+        return crawl_marketplace_logic(city, category, query, known_urls, stop_after)
+
+    try:
+        if crawl_pool.enabled:
+            with crawl_activity():
+                results = crawl_pool.crawl(
+                    city, category, query, known_urls, stop_after, before=lambda: governor.acquire(FB_USER)
+                )
+        else:
+            governor.acquire(FB_USER)
+            results = crawl_marketplace_logic(city, category, query, known_urls, stop_after)
+    except JobDeferred:
+        # Refused before crawling, so there is no outcome to record.
+        raise
+    except AssertionError:
+        governor.record(FB_USER, LOGIN_WALL)
+        raise
+    except CrawlTimeoutError:
+        governor.record(FB_USER, TIMEOUT)
+        raise
+    except Exception:
+        governor.record(FB_USER, ERROR)
+        raise
+    governor.record(FB_USER, OK if results else EMPTY)
+    return results
+
+
+def crawl_marketplace_logic(city, category, query, known_urls=None, stop_after=INCREMENTAL_STOP_AFTER):
+    """
+    If known_urls is given, scrolling stops once stop_after of them
+    are seen in a row in the feed.
+    Returns a list of ListingRecord
     """
     # logger.debug(f"Params: {city}, {category}, {query}")
     
@@ -136,99 +691,125 @@ def crawl_marketplace_logic(city, category, query):
     # Testing gui, remove later
     if category=="test":
         time.sleep(1)
-        return [{
-            "image": "https://scontent.fyyc8-1.fna.fbcdn.net/v/t45.5328-4/459002811_1615008492394078_3238608714812733174_n.jpg?stp=c0.43.261.261a_dst-jpg_p261x260&_nc_cat=111&ccb=1-7&_nc_sid=247b10&_nc_ohc=xmu2EIsIktQQ7kNvgF31Fam&_nc_ht=scontent.fyyc8-1.fna&_nc_gid=AzQb3MuKJAjgBnhI531M_H-&oh=00_AYA6PGkYXBpPw7PuF3-d_n4gp0LV7fw7qrylUGSOW47keQ&oe=66E564BA",
-            "title": "Apple iPad 7th Gen",
-            "price": "CA$120",
-            "url": "https://www.facebook.com/marketplace/item/1029513038667252/",
-            "location": city,
-            "is_new": True
-        }]
+        return [ListingRecord(
+            image = "https://scontent.fyyc8-1.fna.fbcdn.net/v/t45.5328-4/459002811_1615008492394078_3238608714812733174_n.jpg?stp=c0.43.261.261a_dst-jpg_p261x260&_nc_cat=111&ccb=1-7&_nc_sid=247b10&_nc_ohc=xmu2EIsIktQQ7kNvgF31Fam&_nc_ht=scontent.fyyc8-1.fna&_nc_gid=AzQb3MuKJAjgBnhI531M_H-&oh=00_AYA6PGkYXBpPw7PuF3-d_n4gp0LV7fw7qrylUGSOW47keQ&oe=66E564BA",
+            title = "Apple iPad 7th Gen",
+            price = "CA$120",
+            url = "https://www.facebook.com/marketplace/item/1029513038667252/",
+            location = city,
+            is_new = True
+        )]
 
     # Get listings based on the results from the url query.
+    from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
     try:
+
         # Initialize the session using Playwright.
-        with sync_playwright() as p:
+        with crawl_activity(), sync_playwright() as p:
             # Open a new browser page.
             logger.debug("Opening browser")
-            browser = p.firefox.launch(headless=False)
+            browser = p.firefox.launch(headless=BROWSER_HEADLESS)
             context = browser.new_context()
-            page = context.new_page()
             load_cookies(context)
+            page = open_marketplace_page(context, marketplace_url)
 
-            logger.debug(f"Opening {marketplace_url}")
-            page.goto(marketplace_url)
-
-            # Listen for dialog events and handle them
-            def handle_dialog(dialog):
-                logger.debug(f"Dialog detected with type: {dialog.type}")
-                dialog.dismiss()  # or dialog.accept() based on the scenario
-
-            page.on("dialog", handle_dialog)
-
-            # Attempt login if prompted
-            logged_in = True
-            login_attempts = 0
-            while login_attempts < 3 and page.locator("div#loginform").is_visible():
-                login_attempts += 1
-                logged_in = False
-                logged_in = attempt_login(page)
-                logger.debug(f"login status: {logged_in}")
-                page.wait_for_load_state("networkidle")
-            
-            if not logged_in and login_attempts >= 3:
-                logger.error("Could not login after 3 attempts.")
-                raise AssertionError("Failed to login to Facebook")
-            
-            logger.info("Finished login step.")
-
-            if not logged_in:
-                try:
-                    # close potential login popup
-                    page.wait_for_load_state("networkidle")
-                    close_button = page.query_selector('div[aria-label="Close"][role="button"]')
-                    if close_button.is_visible():
-                        close_button.click()
-                        logger.debug("Closed Login Popup.")
-                except AttributeError:
-                    pass
-            else:
-                save_cookies(context)
-            
             # TODO: Other popups are preventing scrolling.
             # i.e. "Allow facebook.com to send notifications" popup
 
             # Scroll down page to load more listings
             for _ in range(10):
+                if known_urls and count_known_in_a_row(page, known_urls) >= stop_after:
+                    logger.info(f"Found {stop_after} known listings in a row. Stopped scrolling.")
+                    break
                 page.keyboard.press("End")
                 logger.debug("Scroll...")
                 page.wait_for_load_state()
 
             page.wait_for_load_state()
             html = page.content()
-            soup = BeautifulSoup(html, "html.parser")
-
-            # Parse the listings
-            listings: list[element.Tag] = soup.find_all(
-                "div", class_=FBClassBullshit.LISTINGS.value
-            )
-            parsed = parse_listings(listings)
+            parsed, listings = extract_listings(html)
+            # Most listing elements not parsing, or none found, usually means the classes changed.
+            save_snapshot(city, category, query, html, len(parsed), parse_failed(len(parsed), len(listings)))
 
             logger.debug("Closing browser and returning JSON\n")
             browser.close()
             return parsed
         
+    except AssertionError:
+        raise
+    except PlaywrightTimeoutError as e:
+        logger.error(f"Timed out loading the page: {e}")
+        raise CrawlTimeoutError(f"Timed out loading the page. {e}")
     except Exception as e:
         logger.critical("Fatal crash when parsing browser page\n", exc_info=True)
         raise RuntimeError(f"Unexpected crash during parsing. {e}")
 
 
+def open_marketplace_page(context, url):
+    """
+    Opens url in a new tab of the browser context, logging in if the login form is shown.
+    Cookies are saved after a login, else the login popup is closed.
+    Returns: The page.
+    Throws: AssertionError if login failed 3 times.
+    """
+    page = context.new_page()
+    logger.debug(f"Opening {url}")
+    page.goto(url)
+
+    # Listen for dialog events and handle them
+    def handle_dialog(dialog):
+        logger.debug(f"Dialog detected with type: {dialog.type}")
+        dialog.dismiss()  # or dialog.accept() based on the scenario
+
+    page.on("dialog", handle_dialog)
+    login_if_prompted(page, context)
+    return page
+
+
+def login_if_prompted(page, context):
+    """
+    Logs in if the page shows the login form, i.e. after a reload once the session expired.
+    Cookies are only saved after logging in, so pages already logged in do not rewrite them.
+    Throws: AssertionError if login failed 3 times.
+    """
+    # Attempt login if prompted
+    logged_in = True
+    login_attempts = 0
+    while login_attempts < 3 and page.locator("div#loginform").is_visible():
+        login_attempts += 1
+        logged_in = False
+        logged_in = attempt_login(page)
+        logger.debug(f"login status: {logged_in}")
+        page.wait_for_load_state("networkidle")
+
+    if not logged_in and login_attempts >= 3:
+        logger.error("Could not login after 3 attempts.")
+        raise AssertionError("Failed to login to Facebook")
+
+    logger.info("Finished login step.")
+
+    if not logged_in:
+        try:
+            # close potential login popup
+            page.wait_for_load_state("networkidle")
+            close_button = page.query_selector('div[aria-label="Close"][role="button"]')
+            if close_button.is_visible():
+                close_button.click()
+                logger.debug("Closed Login Popup.")
+        except AttributeError:
+            pass
+    elif login_attempts:
+        save_cookies(context)
+
+
 def attempt_login(page):
     """
     Attempts to enter login info into the form. Assumes that the form exists,
     else, will timeout in 2 seconds.
     Returns: True if the login actions happened sucessfully, False otherwise.
     """
+    from playwright.sync_api import TimeoutError
+
     logger.info("Attempting to login...")
     try:
         page.locator("div#loginform").wait_for(timeout=2000, state="visible")
@@ -243,33 +824,64 @@ def attempt_login(page):
     return False
 
 
+def item_url(href):
+    """Returns: The listing URL without tracking parameters, as stored in the database."""
+    url_clean = href.split("?")[0].rstrip("/")
+    return f"{MARKETPLACE_BASE_URL}{url_clean}/"
+
+
+def count_known_in_a_row(page, known_urls):
+    """
+    Reads the item links currently in the feed, in page order.
+    Returns: The longest run of consecutive listings whose URL is in known_urls.
+    """
+    hrefs = page.eval_on_selector_all(
+        f'a[class="{FBClassBullshit.URL.value}"]',
+        "links => links.map(link => link.getAttribute('href'))"
+    )
+    longest = run = 0
+    seen = set()
+    for href in hrefs:
+        if not href or (url := item_url(href)) in seen:
+            continue
+        seen.add(url)
+        run = run + 1 if url in known_urls else 0
+        longest = max(longest, run)
+    return longest
+
+
+def extract_listings(html):
+    """
+    Finds the listing elements in a marketplace page and parses them.
+    Returns: (list of ListingRecord, list of listing elements)
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    listings = soup.find_all("div", class_=FBClassBullshit.LISTINGS.value)
+    return parse_listings(listings), listings
+
+
 def parse_listings(listings):
     """
     Parses a list of HTML listings and extracts relevant information.
     URL is required.
-    Returns: A list of dictionaries, each containing the listing data.
+    Returns: A list of ListingRecord, each containing the listing data.
     """
+    from bs4 import element
+
     logger.info("Parsing listings...")
     parsed = []
     for i, listing in enumerate(listings):
-        result: dict[str, str | list[str] | None] = {
-            "url": None,
-            "title": None,
-            "price": None,
-            "location": None,
-            "image": None,
-            "is_new": False
-        }
+        result = ListingRecord()
         # Get the item URL.
         if post_url := listing.find("a", class_=FBClassBullshit.URL.value):
             if isinstance(post_url, element.Tag):
-                url_part = post_url.get("href")
-                url_clean = url_part.split("/?")[0]
-                result["url"] = f"https://www.facebook.com{url_clean}/"
+                result.url = item_url(post_url.get("href"))
         else:
             logger.warning(f"Listing {i} URL is None")
 
-        if result["url"] is not None:
+        if result.url is not None:
             # Get the text Elements
             for item in (
                 FBClassBullshit.TITLE,
@@ -277,24 +889,22 @@ def parse_listings(listings):
                 FBClassBullshit.PRICE,
             ):
                 if html_text := listing.find("span", item.value):
-                    result[item.name.lower()] = html_text.text
+                    setattr(result, item.name.lower(), html_text.text)
 
             # Get the item image.
             if image := listing.find("img", class_=FBClassBullshit.IMAGE.value):
                 if isinstance(image, element.Tag):
-                    result["image"] = image.get("src")
+                    result.image = image.get("src")
 
             # Append the parsed data to the list.
-            if any(result.values()):
-                logger.debug(f"Found listing {i}: {result['title']}")
+            if any((result.url, result.title, result.price, result.location, result.image)):
+                logger.debug(f"Found listing {i}: {result.title}")
                 parsed.append(result)
             else:
+                # The page is stored as a failed snapshot by the crawl.
                 logger.warning(f"Couldn't parse listing number {i}")
                 if listing.string:
                     logger.debug(f"Listing {i} text: {listing.string}")
-                    with open("static/failed_listing.html", "a", encoding="utf-8") as file:
-                        file.write(listing.string)
-                        file.write("\n------------------\n")
                 else:
                     logger.debug(f"Listing {i} has no text")
 
@@ -302,13 +912,13 @@ def parse_listings(listings):
     return parsed
 
 
-def save_cookies(context, file="static/cookies.json"):
+def save_cookies(context, file=COOKIES_FILE):
     cookies = context.cookies()
     with open(file, "w") as f:
         json.dump(cookies, f)
         logger.info("Saved cookies to file.")
 
-def load_cookies(context, file="static/cookies.json"):
+def load_cookies(context, file=COOKIES_FILE):
     if os.path.exists(file):
         with open(file, "r") as f:
             cookies = json.load(f)
@@ -319,55 +929,15 @@ def load_cookies(context, file="static/cookies.json"):
 
 
 @app.get("/return_ip_information")
-def return_ip_information() -> JSONResponse:
-    """Does exactly what you'd think it'd do"""
-    response = {
-        "ip_address": "",
-        "country": "",
-        "location": "",
-        "isp": "",
-        "hostname": "",
-        "type": "",
-        "version": "",
-    }
-    # Initialize the session using Playwright.
-    with sync_playwright() as p:
-        # Open a new browser page.
-        browser = p.firefox.launch()
-        page = browser.new_page()
-        # Navigate to the URL.
-        page.goto("https://www.ipburger.com/")
-        # Wait for the page to load.
-        time.sleep(5)
-        # Get the HTML content of the page.
-        html = page.content()
-        # Beautify the HTML content.
-        soup = BeautifulSoup(html, "html.parser")
-        # Find the IP address.
-        if ip_address := soup.find("span", id="ipaddress1"):
-            response["ip_address"] = ip_address.text
-        # Find the country.
-        if country := soup.find("strong", id="country_fullname"):
-            response["ip_address"] = country.text
-        # Find the location.
-        if location := soup.find("strong", id="location"):
-            response["ip_address"] = location.text
-        # Find the ISP.
-        if isp := soup.find("strong", id="isp"):
-            response["ip_address"] = isp.text
-        # Find the Hostname.
-        if hostname := soup.find("strong", id="hostname"):
-            response["ip_address"] = hostname.text
-        # Find the Type.
-        if ip_type := soup.find("strong", id="ip_type"):
-            response["ip_address"] = ip_type.text
-        # Find the version.
-        if version := soup.find("strong", id="version"):
-            response["ip_address"] = version.text
-        # Close the browser.
-        browser.close()
-        # Return the IP information as JSON.
-        return JSONResponse(response)
+def return_ip_information(refresh: bool = False) -> JSONResponse:
+    """
+    The server's egress IP, country, location, ISP, hostname, type and IP version,
+    from IP_LOOKUP_URL. Cached for IP_LOOKUP_TTL seconds, refresh=true looks it up again.
+    """
+    try:
+        return JSONResponse(get_ip_information(refresh))
+    except RuntimeError as e:
+        raise HTTPException(500, str(e))
 
 
 if __name__ == "__main__":
@@ -377,7 +947,9 @@ if __name__ == "__main__":
     except Exception as e:
         logger.warning(f"Database Error\n{e}")
     print()
-    
+
+    import uvicorn
+
     # Run the app.
     uvicorn.run(
         # Specify the app as the FastAPI app.
@@ -0,0 +1,139 @@
+"""
+Description: Alert rule matching benchmark, the rule index vs checking every rule.
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.0
+Usage: python -m benchmarks.alert_matching [--rules 10000] [--listings 10000] [--linear-listings 200]
+
+Synthetic rules use keywords drawn from a skewed vocabulary, like real watch lists,
+with excludes, price ranges and locations on some. Matches from the index are checked
+against checking every rule for the first --linear-listings listings, and that linear
+scan is timed to estimate its cost for all listings.
+"""
+
+import argparse, random, sys, time
+
+from alerts import AlertIndex, _CompiledRule, _location_keys, normalize_text
+from models import parse_price
+
+CITIES = ["Calgary, AB", "Edmonton, AB", "Vancouver, BC", "Toronto, ON", "Montreal, QC",
+          "Ottawa, ON", "Winnipeg, MB", "Regina, SK", "Halifax, NS", "Victoria, BC"]
+BRANDS = ["apple", "samsung", "sony", "lg", "dell", "lenovo", "ikea", "dyson", "nike", "honda",
+          "toyota", "canon", "nikon", "bose", "trek", "specialized", "lego", "nintendo", "xbox", "makita"]
+ITEMS = ["iphone", "galaxy", "tv", "laptop", "monitor", "desk", "chair", "sofa", "bike", "camera",
+         "lens", "headphones", "speaker", "drill", "switch", "console", "table", "dresser", "tires", "stroller"]
+WORDS = ["pro", "max", "mini", "used", "new", "black", "white", "wood", "leather", "vintage",
+         "broken", "parts", "case", "bundle", "kids", "electric", "gaming", "4k", "wireless", "large"]
+
+
+def vocabulary(size, rng):
+    """Returns: size words, the common ones first."""
+    words = BRANDS + ITEMS + WORDS
+    while len(words) < size:
+        words.append(f"{rng.choice(ITEMS)}{len(words)}")
+    return words
+
+
+def skewed(rng, words):
+    """A word from a Zipf like distribution, so common words are in many titles and rules."""
+    return rng.choices(words, cum_weights=_cumulative_weights(len(words)))[0]
+
+
+_weights = {}
+
+def _cumulative_weights(size):
+    if size not in _weights:
+        total, weights = 0.0, []
+        for rank in range(size):
+            total += 1 / (rank + 20)
+            weights.append(total)
+        _weights[size] = weights
+    return _weights[size]
+
+
+def synthetic_rules(count, words, rng):
+    rules = []
+    for i in range(count):
+        include = sorted({skewed(rng, words) for _ in range(rng.choice((1, 1, 2, 2, 3)))}) if rng.random() > 0.05 else []
+        low = rng.choice((None, 0, 50, 100, 200, 500))
+        rules.append({
+            "id": i + 1,
+            "ntfy_topic": f"topic-{i % 500}",
+            "include_keywords": include,
+            "exclude_keywords": [rng.choice(("broken", "parts", "case"))] if rng.random() < 0.3 else [],
+            "min_price": low,
+            "max_price": (low or 0) + rng.choice((100, 500, 2000)) if rng.random() < 0.6 else None,
+            "locations": rng.sample(CITIES, rng.randint(1, 3)) if rng.random() < 0.3 else [],
+        })
+    return rules
+
+
+def synthetic_listings(count, words, rng):
+    return [
+        {
+            "title": " ".join(skewed(rng, words) for _ in range(rng.randint(3, 8))).title(),
+            "price": f"CA${rng.randint(0, 3000):,}" if rng.random() > 0.05 else "Free",
+            "location": rng.choice(CITIES),
+        }
+        for _ in range(count)
+    ]
+
+
+def linear_match(compiled, listing):
+    """Check every rule, finding each keyword in the title on its own."""
+    title = f" {normalize_text(listing['title'])} "
+    price = parse_price(listing["price"])
+    locations = _location_keys(listing["location"])
+    matched = []
+    for rule in compiled:
+        keywords = {keyword for keyword in rule.include | rule.exclude if f" {keyword} " in title}
+        if rule.matches(keywords, price, locations):
+            matched.append(rule.rule["id"])
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, default=10000)
+    parser.add_argument("--listings", type=int, default=10000)
+    parser.add_argument("--linear-listings", type=int, default=200, help="Listings also matched by checking every rule")
+    parser.add_argument("--vocabulary", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    rules = synthetic_rules(args.rules, words, rng)
+    listings = synthetic_listings(args.listings, words, rng)
+
+    start = time.perf_counter()
+    index = AlertIndex(rules)
+    compile_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = [index.match(listing["title"], listing["price"], listing["location"]) for listing in listings]
+    index_seconds = time.perf_counter() - start
+    total = sum(len(matched) for matched in matches)
+
+    sample = listings[:args.linear_listings]
+    compiled = [_CompiledRule(rule) for rule in rules]
+    start = time.perf_counter()
+    linear = [linear_match(compiled, listing) for listing in sample]
+    linear_seconds = (time.perf_counter() - start) / max(len(sample), 1) * len(listings)
+
+    wrong = sum(sorted(rule["id"] for rule in matches[i]) != sorted(linear[i]) for i in range(len(sample)))
+    print(f"{args.rules} rules, {args.listings} listings, {total} matches "
+          f"({total / len(listings):.1f} per listing)")
+    print(f"Index compiled in {compile_seconds * 1000:.0f} ms")
+    print(f"{'':<10}{'seconds':>10}{'listings/s':>12}{'us/listing':>12}")
+    print(f"{'index':<10}{index_seconds:>10.2f}{len(listings) / index_seconds:>12.0f}{index_seconds / len(listings) * 1e6:>12.0f}")
+    print(f"{'linear':<10}{linear_seconds:>10.2f}{len(listings) / linear_seconds:>12.0f}{linear_seconds / len(listings) * 1e6:>12.0f}"
+          f"  (estimated from {len(sample)} listings)")
+    print(f"\nIndex {linear_seconds / index_seconds:.0f}x faster. {wrong} of {len(sample)} sampled listings differ.")
+    if wrong:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
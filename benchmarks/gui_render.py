@@ -0,0 +1,129 @@
+"""
+Description: GUI render benchmark, every listing on each rerun vs paged cards and the table view.
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.0
+Usage: python -m benchmarks.gui_render [--listings 1000] [--repeat 5]
+
+Runs gui.py with Streamlit's AppTest and the listings already in session state,
+as after a search. Reports the first render, a rerun with the same results,
+and moving to the next page, with the number of elements and images sent to the browser.
+The old view rendered a header, two columns and an image for every listing on every rerun.
+"""
+
+import argparse, os, statistics, time
+
+from streamlit.testing.v1 import AppTest
+
+GUI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gui.py")
+
+
+def synthetic_results(count):
+    """Returns: count listings as the GUI receives them from the API."""
+    return [
+        {
+            "url": f"https://www.facebook.com/marketplace/item/{1000000000000000 + i}/",
+            "title": f"Synthetic listing number {i}",
+            "price": f"CA${i % 900 + 10}",
+            "location": "Calgary, AB",
+            "image": f"https://scontent.example.net/v/t45.5328-4/{i}_n.jpg",
+            "is_new": i % 10 == 0,
+            "id": i + 1,
+            "timestamp": f"2024-09-01T00:{i // 60 % 60:02}:{i % 60:02}Z",
+        }
+        for i in range(count)
+    ]
+
+
+def old_view():
+    """The previous display_results, run as its own script."""
+    import streamlit as st
+
+    for i, item in enumerate(st.session_state.results):
+        st.header(item.get("title"))
+        col = st.columns(2)
+        with col[0]:
+            if img_url := item.get("image"):
+                st.image(img_url)
+        with col[1]:
+            if item.get("is_new"):
+                st.header("New!")
+            st.write(item.get("price"))
+            st.write(item.get("location"))
+            st.write(item.get("url"))
+            if timestamp := item.get("timestamp"):
+                st.write(f"Found at: {timestamp}")
+        if i + 1 < len(st.session_state.results):
+            st.write("----")
+
+
+def count_elements(node):
+    """Returns: (elements, images) in the rendered tree."""
+    children = getattr(node, "children", {})
+    elements = int(not children)
+    images = int(node.type == "imgs")
+    for child in children.values():
+        child_elements, child_images = count_elements(child)
+        elements += child_elements
+        images += child_images
+    return elements, images
+
+
+def new_app(script, results, view=None):
+    at = AppTest.from_function(script, default_timeout=300) if callable(script) else AppTest.from_file(script, default_timeout=300)
+    for key, value in {
+        "results": results, "results_version": 1, "page": 0, "params": None, "search_id": None,
+        "subscriber": "gui-benchmark", "subscription_id": None, "events": None, "last_crawled": None,
+    }.items():
+        at.session_state[key] = value
+    if view:
+        at.session_state["view"] = view
+    return at
+
+
+def timed(run):
+    start = time.perf_counter()
+    at = run()
+    elapsed = time.perf_counter() - start
+    assert not at.exception, at.exception
+    return elapsed, at
+
+
+def measure(name, script, results, repeat, view=None, next_page=False):
+    rows = []
+    for _ in range(repeat):
+        at = new_app(script, results, view)
+        first, at = timed(at.run)
+        rerun, at = timed(at.run)
+        row = {"first": first, "rerun": rerun, "elements": count_elements(at._tree)}
+        if next_page:
+            button = next(button for button in at.button if button.label == "Next")
+            row["next"], at = timed(button.click().run)
+        rows.append(row)
+
+    elements, images = rows[-1]["elements"]
+    median = lambda key: f"{statistics.median(row[key] for row in rows) * 1000:>10.0f}" if key in rows[0] else f"{'-':>10}"
+    print(f"{name:<14}{median('first')}{median('rerun')}{median('next')}{elements:>10}{images:>8}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listings", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = synthetic_results(args.listings)
+    print(f"{args.listings} listings, median of {args.repeat} runs")
+    print(f"{'view':<14}{'first ms':>10}{'rerun ms':>10}{'next ms':>10}{'elements':>10}{'images':>8}")
+    old = measure("old (all)", old_view, results, args.repeat)
+    cards = measure("paged cards", GUI, results, args.repeat, next_page=True)
+    measure("table", GUI, results, args.repeat, view="Table")
+
+    speedup = statistics.median(row["rerun"] for row in old) / statistics.median(row["rerun"] for row in cards)
+    print(f"\nPaged cards rerun {speedup:.1f}x faster than rendering every listing.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Description: End-to-end load test of the API against the local mock Marketplace.
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.0
+Usage: python -m benchmarks.load_test [--concurrency 1 2 4 8] [--requests 16] [--endpoint new_results]
+
+Starts mock_marketplace.py and the API (python app.py) with a temporary database,
+crawling the mock in a headless browser, then runs one phase per concurrency level
+and reports crawls per second and p50/p95/p99 latency of each phase.
+Crawls refused with 503 while every crawl worker is busy are retried after Retry-After,
+and counted as busy. During each phase, non-crawl endpoints such as /health and /results
+are probed, and their p50/p99 show whether crawls stall the rest of the API.
+Use --api-url or --mock-url to test servers that are already running.
+--category test checks the harness and API overhead without a browser.
+Exits with status 1 if a phase has no successful crawls.
+"""
+
+import argparse, math, os, socket, subprocess, sys, tempfile, threading, time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ENDPOINTS = {
+    "crawl_marketplace": "/crawl_marketplace",
+    "new_results": "/crawl_marketplace/new_results",
+}
+
+# Non-crawl endpoints probed during each phase.
+PROBE_PATHS = ("/health", "/results/1", "/governor", "/crawl_pool")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, server, timeout=60.0):
+    """Poll url until it answers, or raise if the server exits or the timeout passes."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"Server for {url} exited with status {server.returncode}.")
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not answer within {timeout} seconds.")
+
+
+def start_mock(directory):
+    port = free_port()
+    log = open(os.path.join(directory, "mock.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, "mock_marketplace.py", "--port", str(port)],
+        stdout=log, stderr=subprocess.STDOUT
+    )
+    url = f"http://127.0.0.1:{port}"
+    wait_until_up(f"{url}/mock/config", server)
+    return server, url
+
+
+def start_api(directory, mock_url, crawl_workers):
+    port = free_port()
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "DATABASE": os.path.join(directory, "load_test.db"),
+        "COOKIES_FILE": os.path.join(directory, "cookies.json"),
+        "SNAPSHOT_DIR": os.path.join(directory, "snapshots"),
+        "MARKETPLACE_BASE_URL": mock_url,
+        "BROWSER_HEADLESS": "true",
+        "MAINTENANCE_INTERVAL_HOURS": "0",
+        "CRAWL_WORKERS": str(crawl_workers),
+        "FB_USER": "load-test@example.com",
+        "FB_PASSWORD": "load-test",
+    }
+    log = open(os.path.join(directory, "api.log"), "w")
+    server = subprocess.Popen([sys.executable, "app.py"], env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    wait_until_up(f"{url}/health", server)
+    return server, url
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def probe(api_url, interval, stop):
+    """
+    Request PROBE_PATHS in turn every interval seconds until stop is set.
+    Returns: Sorted latencies in ms of the answered requests, and the count that failed or took over 10 seconds.
+    """
+    session = requests.Session()
+    latencies, failures, i = [], 0, 0
+    while not stop.wait(interval):
+        start = time.perf_counter()
+        try:
+            # 404 is an answer too, i.e. /results/1 before the first crawl is stored.
+            answered = session.get(api_url + PROBE_PATHS[i % len(PROBE_PATHS)], timeout=10).status_code < 500
+        except requests.RequestException:
+            answered = False
+        if answered:
+            latencies.append((time.perf_counter() - start) * 1000)
+        else:
+            failures += 1
+        i += 1
+    return sorted(latencies), failures
+
+
+def run_phase(api_url, args, concurrency):
+    """
+    Send args.requests crawl requests with concurrency at a time, while probing the other endpoints.
+    Returns: (wall seconds, latencies in ms of successful crawls, error count, busy count,
+    probe latencies in ms, probe failure count)
+    """
+    local = threading.local()
+    url = api_url + ENDPOINTS[args.endpoint]
+    busy = []
+
+    def crawl(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        params = {
+            "city": args.city,
+            "category": args.category,
+            "query": f"query=load{i % args.searches}",
+        }
+        if args.endpoint == "new_results":
+            params["incremental"] = str(args.incremental).lower()
+        start = time.perf_counter()
+        while True:
+            try:
+                response = local.session.get(url, params=params, timeout=args.timeout)
+            except requests.RequestException:
+                return False, (time.perf_counter() - start) * 1000
+            if response.status_code != 503 or time.perf_counter() - start > args.timeout:
+                return response.ok, (time.perf_counter() - start) * 1000
+            # Every crawl worker is busy.
+            busy.append(1)
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+
+    stop = threading.Event()
+    with ThreadPoolExecutor(1) as prober:
+        probed = prober.submit(probe, api_url, args.probe_interval, stop)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            outcomes = list(pool.map(crawl, range(args.requests)))
+        wall = time.perf_counter() - start
+        stop.set()
+        probe_latencies, probe_failures = probed.result()
+
+    latencies = sorted(ms for ok, ms in outcomes if ok)
+    return wall, latencies, len(outcomes) - len(latencies), len(busy), probe_latencies, probe_failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=16, help="Crawl requests in each phase")
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="new_results")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--searches", type=int, default=4, help="Different searches to spread requests over")
+    parser.add_argument("--city", default="calgary")
+    parser.add_argument("--category", default="search")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds per request")
+    parser.add_argument("--probe-interval", type=float, default=0.1, help="Seconds between non-crawl requests")
+    parser.add_argument("--crawl-workers", type=int, default=0, help="CRAWL_WORKERS for the started API")
+    parser.add_argument("--latency-ms", type=float, default=None, help="Mock page latency")
+    parser.add_argument("--error-rate", type=float, default=None, help="Mock page failure rate")
+    parser.add_argument("--api-url", default=None, help="Use a running API instead of starting one")
+    parser.add_argument("--mock-url", default=None, help="Use a running mock instead of starting one")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="load_test-")
+    servers = []
+    try:
+        mock_url = args.mock_url
+        if mock_url is None:
+            mock, mock_url = start_mock(directory)
+            servers.append(mock)
+        api_url = args.api_url
+        if api_url is None:
+            api, api_url = start_api(directory, mock_url, args.crawl_workers)
+            servers.append(api)
+
+        mock_config = {}
+        if args.latency_ms is not None:
+            mock_config["latency_ms"] = args.latency_ms
+        if args.error_rate is not None:
+            mock_config["error_rate"] = args.error_rate
+        requests.post(f"{mock_url}/mock/config", params=mock_config).raise_for_status()
+        requests.post(f"{mock_url}/mock/reset").raise_for_status()
+
+        print(f"API {api_url}, mock {mock_url}, logs in {directory}")
+        print(f"{args.requests} requests per phase to {ENDPOINTS[args.endpoint]}")
+        print(
+            f"{'concurrency':>12}{'ok':>6}{'errors':>8}{'busy':>6}{'crawls/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+            f"{'p99 ms':>10}{'other p50':>11}{'other p99':>11}{'other fail':>12}"
+        )
+        failed_phase = False
+        for concurrency in args.concurrency:
+            wall, latencies, errors, busy, other, other_failures = run_phase(api_url, args, concurrency)
+            failed_phase |= not latencies
+            print(
+                f"{concurrency:>12}{len(latencies):>6}{errors:>8}{busy:>6}{len(latencies) / wall:>10.2f}"
+                f"{percentile(latencies, 50):>10.0f}{percentile(latencies, 95):>10.0f}{percentile(latencies, 99):>10.0f}"
+                f"{percentile(other, 50):>11.1f}{percentile(other, 99):>11.1f}{other_failures:>12}"
+            )
+
+        print(f"\nMock requests: {requests.get(f'{mock_url}/mock/stats').json()}")
+        if failed_phase:
+            print("A phase had no successful crawls.")
+            sys.exit(1)
+    finally:
+        for server in reversed(servers):
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
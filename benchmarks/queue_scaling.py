@@ -0,0 +1,86 @@
+"""
+Description: Job queue throughput with 1 to N worker processes on one machine.
+Date Created: 2026-10-18
+Date Modified: 2026-10-18
+Author: SPolton
+Version: 1.0.0
+Usage: python -m benchmarks.queue_scaling [--workers 1 2 4 8] [--jobs 64] [--job-seconds 0.25]
+
+Each job simulates a crawl by sleeping, so the numbers show the queue's
+overhead and how throughput scales with workers, not browser speed.
+Uses a temporary database. Exits with status 1 if the largest worker count
+is less than --min-speedup times faster than one worker.
+"""
+
+import argparse, multiprocessing, os, sys, tempfile, time
+
+
+def simulated_crawl(job):
+    """Job handler that stands in for a crawl."""
+    time.sleep(float(os.environ["QUEUE_BENCH_JOB_SECONDS"]))
+    return {"result_count": 0, "new_count": 0}
+
+
+def run_round(workers, jobs):
+    """Returns: Jobs per second with the given number of worker processes."""
+    from jobs import enqueue_job, job_stats
+    from worker import run_worker_process
+
+    for i in range(jobs):
+        enqueue_job("bench", "search", f"query={workers}-{i}")
+
+    start = time.perf_counter()
+    processes = [
+        multiprocessing.Process(
+            target=run_worker_process,
+            args=(f"bench-{workers}-{i}", simulated_crawl, True, 0.05)
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    stats = job_stats()
+    if stats["queued"] or stats["running"] or stats["dead"]:
+        raise RuntimeError(f"Jobs left unfinished: {stats}")
+    return jobs / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--jobs", type=int, default=64)
+    parser.add_argument("--job-seconds", type=float, default=0.25)
+    parser.add_argument("--min-speedup", type=float, default=None,
+                        help="Defaults to half the largest worker count")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ["DATABASE"] = os.path.join(directory, "queue_bench.db")
+    os.environ["QUEUE_BENCH_JOB_SECONDS"] = str(args.job_seconds)
+
+    from database import init_db, get_engine
+    init_db()
+    get_engine().dispose()
+
+    print(f"{args.jobs} jobs of {args.job_seconds}s each")
+    print(f"{'workers':>8}{'jobs/s':>10}{'speedup':>10}")
+    baseline = None
+    throughput = None
+    for workers in args.workers:
+        throughput = run_round(workers, args.jobs)
+        baseline = baseline or throughput
+        print(f"{workers:>8}{throughput:>10.2f}{throughput / baseline:>9.2f}x")
+
+    min_speedup = args.min_speedup or max(args.workers) / 2
+    if throughput / baseline < min_speedup:
+        print(f"\nThroughput did not scale: {throughput / baseline:.2f}x < {min_speedup:.2f}x")
+        sys.exit(1)
+    print("\nThroughput scales with the number of workers.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Description: Listing serialization benchmark, ORM dicts with stdlib json vs ListingRecord with orjson.
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.1
+Usage: python -m benchmarks.serialization [--listings 5000] [--repeat 5]
+"""
+
+import argparse, gzip, json, time, tracemalloc
+
+from datetime import datetime, timedelta
+
+from database import Listing
+from models import ListingRecord
+from responses import CompactJSONResponse, COMPRESS_LEVEL
+
+
+def synthetic_records(count):
+    """Returns: count ListingRecord as they would be read from the database."""
+    start = datetime(2024, 9, 1)
+    return [
+        ListingRecord(
+            url = f"https://www.facebook.com/marketplace/item/{1000000000000000 + i}/",
+            title = f"Synthetic listing number {i}",
+            price = f"CA${i % 900 + 10}",
+            location = "Calgary, AB",
+            image = f"https://scontent.example.net/v/t45.5328-4/{i}_n.jpg?stp=c0.43.261.261a_dst-jpg_p261x260",
+            is_new = i % 10 == 0,
+            id = i + 1,
+            search_id = 1,
+            order = i + 1,
+            timestamp = start + timedelta(seconds=i),
+        )
+        for i in range(count)
+    ]
+
+
+def listing_to_dict(listing):
+    """The removed Listing.to_dict, which the endpoints used before ListingRecord."""
+    json_friendly_time = listing.timestamp.astimezone().strftime("%y-%m-%d %H:%M:%S%z %Z")
+    return {
+        "id": listing.id,
+        "search_id": listing.search_id,
+        "order": listing.order,
+        "url": listing.url,
+        "title": listing.title,
+        "price": listing.price,
+        "location": listing.location,
+        "image": listing.image,
+        "is_new": listing.is_new,
+        "timestamp": json_friendly_time
+    }
+
+
+def orm_path(records):
+    """The previous path: ORM objects, Listing.to_dict, then stdlib json as in JSONResponse."""
+    orm = [
+        Listing(
+            id=r.id, search_id=r.search_id, order=r.order, url=r.url, title=r.title,
+            price=r.price, location=r.location, image=r.image, is_new=r.is_new, timestamp=r.timestamp
+        )
+        for r in records
+    ]
+    content = [listing_to_dict(listing) for listing in orm]
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def record_path(records):
+    """The current path: ListingRecord rendered by CompactJSONResponse."""
+    return CompactJSONResponse(records).body
+
+
+def measure(func, records, repeat):
+    """Returns: (best seconds, peak traced bytes, body) for func over records."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = func(records)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(records)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Listing serialization benchmark")
+    parser.add_argument("--listings", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = synthetic_records(args.listings)
+    print(f"{args.listings} listings, best of {args.repeat}")
+    print(f"{'path':<22}{'time':>10}{'peak mem':>12}{'body':>12}{'gzip':>12}")
+    for name, func in (("ORM + json", orm_path), ("ListingRecord + orjson", record_path)):
+        seconds, peak, body = measure(func, records, args.repeat)
+        compressed = len(gzip.compress(body, compresslevel=COMPRESS_LEVEL))
+        print(f"{name:<22}{seconds * 1000:>8.1f}ms{peak / 1024:>10.0f}KB{len(body) / 1024:>10.0f}KB{compressed / 1024:>10.0f}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Description: Import-time and startup benchmark for the API and GUI helpers.
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.0
+Usage: python -m benchmarks.startup [--max-import-ms 1200] [--max-startup-ms 3000] [--repeat 5]
+
+Reports `python -X importtime` results for app.py and the GUI helper modules,
+checks that heavy subsystems are not loaded at import, and times how long the
+API takes to answer /health after the process starts.
+Import times are the median of --repeat fresh interpreters, since single runs vary by 30% or more.
+FastAPI and SQLAlchemy make up most of the import budget (about 400 and 350 ms here).
+The API needs both to serve any request, so they are loaded at import.
+Exits with status 1 if a budget is exceeded or a lazy subsystem was loaded.
+"""
+
+import argparse, socket, subprocess, sys, time
+from urllib.request import urlopen
+from urllib.error import URLError
+
+# Modules that must only be imported when they are first needed.
+LAZY_MODULES = {
+    "app": ["playwright", "bs4", "requests", "sqlalchemy.ext.asyncio", "asyncpg", "aiosqlite", "pandas"],
+    "api_utils": ["requests"],
+    "notify": ["requests"],
+}
+
+
+def import_time(module, repeat=1):
+    """
+    Import a module in repeat fresh interpreters with -X importtime.
+    Returns: (median cumulative microseconds for module, list of (cumulative_us, name) for
+    its direct imports in the median run)
+    """
+    runs = sorted(_import_time(module) for _ in range(max(repeat, 1)))
+    return runs[len(runs) // 2]
+
+
+def _import_time(module):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    )
+    total = 0
+    direct = []
+    children = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        # Each nesting level adds two spaces of indentation to the name.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # Nested imports are printed before their parent, so the direct imports
+        # of module are the ones listed since the previous top level import.
+        if depth == 1:
+            children.append((int(cumulative_us), name.strip()))
+        elif depth == 0:
+            if name.strip() == module:
+                total = int(cumulative_us)
+                direct = sorted(children, reverse=True)
+            children = []
+    return total, direct
+
+
+def loaded_lazy_modules(module):
+    """Returns: The lazily loaded modules that were imported anyway by importing module."""
+    check = (
+        "import sys, {0}\n"
+        "print(' '.join(m for m in {1!r} if m in sys.modules))"
+    ).format(module, LAZY_MODULES[module])
+    proc = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    return proc.stdout.split()
+
+
+def startup_time(timeout=30.0):
+    """
+    Start the API with uvicorn and poll /health.
+    Returns: Milliseconds from process start until the first successful response.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as res:
+                    if res.status == 200:
+                        return (time.perf_counter() - start) * 1000
+            except (URLError, ConnectionError):
+                time.sleep(0.01)
+        raise RuntimeError(f"API did not answer /health within {timeout} seconds.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-import-ms", type=float, default=1200, help="Budget for importing app.py")
+    parser.add_argument("--max-startup-ms", type=float, default=3000, help="Budget for first /health response")
+    parser.add_argument("--top", type=int, default=10, help="Number of direct imports to list")
+    parser.add_argument("--repeat", type=int, default=5, help="Imports to take the median of")
+    parser.add_argument("--skip-server", action="store_true", help="Only measure imports")
+    args = parser.parse_args()
+
+    failures = []
+    for module in LAZY_MODULES:
+        total, direct = import_time(module, args.repeat)
+        print(f"\nimport {module}: {total / 1000:.1f} ms cumulative (median of {args.repeat})")
+        for cumulative_us, name in direct[:args.top]:
+            print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+        if module == "app" and total / 1000 > args.max_import_ms:
+            failures.append(f"import app took {total / 1000:.1f} ms (budget {args.max_import_ms} ms)")
+        if loaded := loaded_lazy_modules(module):
+            failures.append(f"import {module} loaded {', '.join(loaded)}")
+
+    if not args.skip_server:
+        elapsed = startup_time()
+        print(f"\nFirst /health response after {elapsed:.1f} ms")
+        if elapsed > args.max_startup_ms:
+            failures.append(f"startup took {elapsed:.1f} ms (budget {args.max_startup_ms} ms)")
+
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("\nAll startup budgets met.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Description: Supervised pool of crawl worker processes, recycled by crawl count or memory and killed on timeout
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.2.1
+"""
+
+import multiprocessing, os, queue, signal, threading, time
+
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from jobs import JobDeferred
+from models import ListingRecord
+
+load_dotenv()
+# Worker processes for crawls. 0 crawls inside the API process.
+CRAWL_WORKERS = int(getenv("CRAWL_WORKERS", 0))
+# A worker is replaced after this many crawls, or once its memory use, with its browser, is above the limit.
+CRAWL_WORKER_MAX_CRAWLS = int(getenv("CRAWL_WORKER_MAX_CRAWLS", 20))
+CRAWL_WORKER_MAX_RSS_MB = float(getenv("CRAWL_WORKER_MAX_RSS_MB", 1024))
+# Seconds a client or job is told to wait when every worker is busy.
+CRAWL_POOL_RETRY_AFTER = float(getenv("CRAWL_POOL_RETRY_AFTER", 5))
+# Seconds before a crawl, with its browser, is killed.
+CRAWL_TIMEOUT = float(getenv("CRAWL_TIMEOUT", 300))
+
+# Seconds between memory samples of a worker's process tree during a crawl.
+_RSS_SAMPLE_SECONDS = 1
+
+logger = getLogger(__name__)
+
+
+class CrawlTimeoutError(RuntimeError):
+    """A page or the whole crawl took too long, which often means the account is being throttled."""
+
+
+class CrawlPoolFull(JobDeferred):
+    """
+    Every crawl worker is busy. Crawls are refused rather than waited for, so
+    waiting requests do not hold the API's threads. Queued jobs are deferred.
+    """
+
+
+# Listing fields sent back from a worker, in ListingRecord field order.
+_COMPACT_FIELDS = ("url", "title", "price", "location", "image")
+
+
+def _proc_stats():
+    """
+    Returns: The parent pid and resident pages of every process by pid, read from /proc,
+    or None without /proc.
+    """
+    try:
+        pids = os.listdir("/proc")
+    except OSError:
+        return None
+    stats = {}
+    for pid in pids:
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                # Fields after the command name, which may contain spaces: state, ppid, ... rss is the 22nd.
+                fields = stat.read().rsplit(")", 1)[1].split()
+            stats[int(pid)] = (int(fields[1]), int(fields[21]))
+        except (OSError, ValueError, IndexError):
+            continue
+    return stats
+
+
+def _process_tree(pid, stats):
+    """
+    Returns: pid and all its descendants found in stats. They are followed by parent pid,
+    since the browser Playwright starts is detached into its own process group.
+    """
+    children = {}
+    for child, (ppid, _) in stats.items():
+        children.setdefault(ppid, []).append(child)
+    tree, stack = [], [pid]
+    while stack:
+        tree.append(current := stack.pop())
+        stack.extend(children.get(current, ()))
+    return tree
+
+
+def _tree_rss_mb(pid):
+    """
+    Returns: The resident memory in MB of a process and its descendants, such as a worker
+    and its browser, or None without /proc or if the process is gone.
+    """
+    stats = _proc_stats()
+    if not stats or pid not in stats:
+        return None
+    return sum(stats[tree_pid][1] for tree_pid in _process_tree(pid, stats)) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _rss_mb():
+    """Returns: The resident memory of this process in MB."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Peak, in KB on Linux
+
+
+def _worker_main(conn):
+    """
+    Worker process loop: receive crawl arguments, crawl, and send back the
+    listings as tuples, or the error. None tells the worker to exit.
+    """
+    from app import crawl_marketplace_logic
+
+    while (args := conn.recv()) is not None:
+        try:
+            results = crawl_marketplace_logic(*args)
+            compact = [tuple(getattr(record, field) for field in _COMPACT_FIELDS) for record in results]
+            conn.send(("ok", compact, _rss_mb()))
+        except AssertionError as e:
+            conn.send(("auth", str(e), _rss_mb()))
+        except CrawlTimeoutError as e:
+            conn.send(("timeout", str(e), _rss_mb()))
+        except Exception as e:
+            conn.send(("error", str(e), _rss_mb()))
+
+
+class _WorkerHandle:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.crawls = 0
+        self.rss_mb = 0.0
+
+    def _descendants(self):
+        """Returns: The pids of the worker's descendants, such as the browser and its content processes."""
+        stats = _proc_stats()
+        if not stats or self.process.pid not in stats:
+            return []
+        return _process_tree(self.process.pid, stats)[1:]
+
+    @staticmethod
+    def _kill_pids(pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def kill(self):
+        """Kill the worker and all its descendants, such as the browser."""
+        # Found before the worker dies, since its orphans are then adopted by another process.
+        descendants = self._descendants()
+        self.process.kill()
+        self._kill_pids(descendants)
+        self.process.join()
+        self.conn.close()
+
+    def retire(self):
+        """Ask the worker to exit, and kill it and any descendants left behind if it does not."""
+        descendants = self._descendants()
+        try:
+            self.conn.send(None)
+            self.process.join(5)
+        except (BrokenPipeError, OSError):
+            pass
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self._kill_pids(descendants)
+            self.conn.close()
+
+
+class CrawlPool:
+    """
+    Runs crawl_marketplace_logic in up to size worker processes. Crawls are refused
+    with CrawlPoolFull while every worker is busy. Workers are started when first needed.
+    A worker's memory is that of its process tree, sampled during each crawl,
+    since the browser it starts holds most of it.
+    """
+
+    def __init__(self, size=CRAWL_WORKERS, max_crawls=CRAWL_WORKER_MAX_CRAWLS,
+                 max_rss_mb=CRAWL_WORKER_MAX_RSS_MB, timeout=CRAWL_TIMEOUT):
+        self.size = size
+        self.max_crawls = max_crawls
+        self.max_rss_mb = max_rss_mb
+        self.timeout = timeout
+        # spawn, since forking the threaded API process is unsafe.
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self.stats = {"crawls": 0, "recycled": 0, "killed": 0, "rejected": 0}
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def _acquire(self):
+        if not self._slots.acquire(blocking=False):
+            self.stats["rejected"] += 1
+            raise CrawlPoolFull(CRAWL_POOL_RETRY_AFTER, f"All {self.size} crawl workers are busy.")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            handle = _WorkerHandle(self._context)
+            with self._lock:
+                self._workers.add(handle)
+            logger.info(f"Started crawl worker process {handle.process.pid}.")
+            return handle
+
+    def _release(self, handle, reusable):
+        if reusable and handle.crawls < self.max_crawls and handle.rss_mb < self.max_rss_mb:
+            self._idle.put(handle)
+        else:
+            with self._lock:
+                self._workers.discard(handle)
+            if reusable:
+                logger.info(
+                    f"Recycling crawl worker {handle.process.pid} after {handle.crawls} crawls "
+                    f"at {handle.rss_mb:.0f} MB."
+                )
+                self.stats["recycled"] += 1
+                handle.retire()
+        self._slots.release()
+
+    def crawl(self, city, category, query, known_urls=None, stop_after=None, before=None):
+        """
+        Run a crawl in a worker process. before() is called once a worker is reserved,
+        i.e. to take from the crawl budget only for crawls that will run.
+        Returns: A list of ListingRecord.
+        Throws: CrawlPoolFull if every worker is busy, AssertionError on login failure,
+        CrawlTimeoutError on timeout, RuntimeError on crash, or what before() raises.
+        """
+        handle = self._acquire()
+        if before is not None:
+            try:
+                before()
+            except BaseException:
+                # The worker did nothing, so it is kept for the next crawl.
+                self._release(handle, True)
+                raise
+        reusable = False
+        try:
+            args = (city, category, query, known_urls) + ((stop_after,) if stop_after is not None else ())
+            handle.conn.send(args)
+            deadline = time.monotonic() + self.timeout
+            peak_mb = 0.0
+            while not handle.conn.poll(min(_RSS_SAMPLE_SECONDS, max(deadline - time.monotonic(), 0))):
+                peak_mb = max(peak_mb, _tree_rss_mb(handle.process.pid) or 0.0)
+                if time.monotonic() >= deadline:
+                    logger.error(f"Crawl timed out after {self.timeout} seconds. Killing worker {handle.process.pid}.")
+                    self.stats["killed"] += 1
+                    handle.kill()
+                    raise CrawlTimeoutError(f"Crawl timed out after {self.timeout} seconds.")
+
+            status, payload, worker_mb = handle.conn.recv()
+            tree_mb = _tree_rss_mb(handle.process.pid)
+            if tree_mb is None and not peak_mb:
+                # No /proc, so only the worker's own memory is known.
+                handle.rss_mb = worker_mb
+            else:
+                handle.rss_mb = max(peak_mb, tree_mb or 0.0)
+            handle.crawls += 1
+            self.stats["crawls"] += 1
+            reusable = True
+        except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+            logger.error(f"Crawl worker {handle.process.pid} died: {e}")
+            handle.kill()
+            raise RuntimeError("Crawl worker process crashed.")
+        finally:
+            self._release(handle, reusable)
+
+        if status == "auth":
+            raise AssertionError(payload)
+        if status == "timeout":
+            raise CrawlTimeoutError(payload)
+        if status == "error":
+            raise RuntimeError(payload)
+        return [ListingRecord(*values) for values in payload]
+
+    def status(self):
+        """Returns: Pool settings, worker processes and counters."""
+        with self._lock:
+            workers = [
+                {"pid": handle.process.pid, "crawls": handle.crawls, "rss_mb": round(handle.rss_mb, 1)}
+                for handle in self._workers
+            ]
+        return {"size": self.size, "workers": workers, **self.stats}
+
+    def shutdown(self):
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for handle in workers:
+            handle.retire()
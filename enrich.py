@@ -0,0 +1,159 @@
+"""
+Description: Enrich new listings with details from their item pages, using parallel browser tabs
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.2
+"""
+
+import re, threading, time
+
+from collections import deque
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from database import get_unenriched_urls, save_listing_details
+from governor import CrawlBudgetExceeded, ERROR, LOGIN_WALL, OK, TIMEOUT
+from models import FBDetailSelector
+
+load_dotenv()
+ENRICH_DETAILS = getenv("ENRICH_DETAILS", "false").lower() == "true"
+# Item pages loaded at the same time, each in its own tab.
+ENRICH_CONCURRENCY = int(getenv("ENRICH_CONCURRENCY", 4))
+# Seconds an enrichment run may take. Listings left over are enriched after the next crawl of their search.
+ENRICH_BUDGET = float(getenv("ENRICH_BUDGET", 60))
+
+logger = getLogger(__name__)
+
+# URLs being enriched right now, so overlapping crawls do not open them twice.
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def parse_listing_detail(url, html):
+    """
+    Extracts the description, seller, listed at time and images from an item page.
+    Returns: A dictionary with the ListingDetail columns.
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    detail = {"url": url, "description": None, "seller": None, "listed_at": None, "images": []}
+
+    if description := soup.select_one(FBDetailSelector.DESCRIPTION.value):
+        detail["description"] = description.get("content")
+    if seller := soup.select_one(FBDetailSelector.SELLER.value):
+        detail["seller"] = seller.get_text(strip=True) or None
+    if listed_at := re.search(FBDetailSelector.LISTED_AT.value, soup.get_text(" ")):
+        detail["listed_at"] = listed_at.group(1)
+
+    images = [meta.get("content") for meta in soup.select(FBDetailSelector.IMAGE.value)]
+    images += [img.get("src") for img in soup.select(FBDetailSelector.GALLERY.value)]
+    # Keep the first of each image, in page order.
+    detail["images"] = list(dict.fromkeys(src for src in images if src))
+    return detail
+
+
+def _record(governor, account, outcome):
+    if governor is not None:
+        governor.record(account, outcome)
+
+
+def _claim(urls):
+    """Returns: The urls that are not enriched or being enriched, now marked in flight."""
+    with _in_flight_lock:
+        claimed = [url for url in get_unenriched_urls(urls) if url not in _in_flight]
+        _in_flight.update(claimed)
+    return claimed
+
+
+def _outcome(tab):
+    """
+    Returns: The governor outcome of an item page, a block signal if it shows a login form.
+    A page without details is OK, since sold or plain listings have none.
+    """
+    return LOGIN_WALL if "/login" in tab.url else OK
+
+
+def enrich_listings(urls, prepare_context=None, concurrency=ENRICH_CONCURRENCY, budget=ENRICH_BUDGET,
+                    governor=None, account=None):
+    """
+    Opens each listing URL without details in up to concurrency tabs of one
+    browser context, and stores the details keyed by URL.
+    Stops starting new pages once the budget (seconds) is spent.
+    prepare_context(context) can be used to load cookies.
+    With a governor, each page is taken from the account's enrichment budget, apart from
+    its crawls, and its outcome is recorded. No more pages are started once it is exhausted.
+    Returns: The number of listings enriched.
+    """
+    urls = _claim(list(dict.fromkeys(urls)))
+    if not urls:
+        return 0
+
+    from playwright.sync_api import sync_playwright, TimeoutError
+
+    deadline = time.monotonic() + budget
+    pending = deque(urls)
+    details = []
+    logger.info(f"Enriching {len(urls)} listings with {concurrency} tabs.")
+    try:
+        with sync_playwright() as p:
+            browser = p.firefox.launch()
+            context = browser.new_context()
+            if prepare_context:
+                prepare_context(context)
+            tabs = [context.new_page() for _ in range(min(concurrency, len(urls)))]
+
+            refused = False
+            while pending and not refused and time.monotonic() < deadline:
+                # Start loading a page in every tab, only waiting for the navigation
+                # to commit, so the pages load in parallel.
+                loading = []
+                for tab in tabs:
+                    if not pending:
+                        break
+                    if governor is not None:
+                        try:
+                            governor.acquire_page(account)
+                        except CrawlBudgetExceeded as e:
+                            logger.info(f"Enrichment paused by its budget: {e}")
+                            refused = True
+                            break
+                    url = pending.popleft()
+                    try:
+                        timeout = max(deadline - time.monotonic(), 0.001) * 1000
+                        tab.goto(url, wait_until="commit", timeout=timeout)
+                        loading.append((tab, url))
+                    except TimeoutError:
+                        logger.warning(f"Timed out opening {url}")
+                        _record(governor, account, TIMEOUT)
+                    except Exception:
+                        _record(governor, account, ERROR)
+                        raise
+
+                for tab, url in loading:
+                    try:
+                        timeout = max(deadline - time.monotonic(), 0.001) * 1000
+                        tab.wait_for_load_state("domcontentloaded", timeout=timeout)
+                        detail = parse_listing_detail(url, tab.content())
+                        details.append(detail)
+                        _record(governor, account, _outcome(tab))
+                    except TimeoutError:
+                        logger.warning(f"Timed out loading {url}")
+                        _record(governor, account, TIMEOUT)
+                    except Exception:
+                        _record(governor, account, ERROR)
+                        raise
+
+            browser.close()
+    except Exception as e:
+        logger.error(f"Listing enrichment failed: {e}", exc_info=True)
+    finally:
+        save_listing_details(details)
+        with _in_flight_lock:
+            _in_flight.difference_update(urls)
+
+    if pending:
+        logger.info(f"Enrichment budget spent, {len(pending)} listings left for later.")
+    return len(details)
@@ -0,0 +1,169 @@
+"""
+Description: Server-sent events of new listings for each search, with one change watcher per watched search
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.1
+"""
+
+import asyncio
+
+from dataclasses import replace
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+import orjson
+
+from database import get_results_after_id_async, get_search_state_async
+from responses import ORJSON_OPTIONS
+
+load_dotenv()
+# Seconds between checks for results stored by other processes, such as worker.py.
+EVENTS_POLL_INTERVAL = float(getenv("EVENTS_POLL_INTERVAL", 2))
+# Seconds between keep-alive comments on idle streams.
+EVENTS_KEEPALIVE = float(getenv("EVENTS_KEEPALIVE", 15))
+# Events waiting for a slow client. Further events are dropped for that client.
+EVENTS_QUEUE_SIZE = 100
+
+logger = getLogger(__name__)
+
+
+def format_event(search_id, state, new):
+    """
+    An SSE update event. The event id is the highest listing id stored for the search,
+    so a client that reconnects with Last-Event-ID only receives listings stored since.
+    Copies of the listings are marked new, so the caller's records are left as they are.
+    Returns: The event as bytes.
+    """
+    new = [replace(listing, is_new=True) for listing in new]
+    data = orjson.dumps({
+        "search_id": search_id,
+        "last_crawled": state["last_crawled"],
+        "last_changed": state["last_changed"],
+        "count": state["count"],
+        "new": new,
+    }, option=ORJSON_OPTIONS)
+    return b"id: %d\nevent: update\ndata: %s\n\n" % (state["max_id"], data)
+
+
+class _Watch:
+    """Subscriber queues of one search, and the task watching it for changes."""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.wake = asyncio.Event()
+        self.task = None
+
+
+class EventBroker:
+    """
+    Sends an update event to every subscriber of a search when it is crawled or its
+    stored results change. Each search with subscribers has one watcher task that reads
+    the search's state every poll_interval, or at once after notify(search_id).
+    Events are encoded once and shared by all subscribers, and idle streams only
+    hold an asyncio queue, so viewers are cheap.
+    """
+
+    def __init__(self, poll_interval=EVENTS_POLL_INTERVAL, keepalive=EVENTS_KEEPALIVE):
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self._loop = None
+        self._watches = {}
+
+    def notify(self, search_id):
+        """Check a search for changes now instead of at the next poll. Safe to call from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake, search_id)
+
+    def _wake(self, search_id):
+        if watch := self._watches.get(search_id):
+            watch.wake.set()
+
+    def subscriber_count(self):
+        """Returns: The number of open streams for each watched search."""
+        return {search_id: len(watch.subscribers) for search_id, watch in self._watches.items()}
+
+    def _subscribe(self, search_id):
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+        if (watch := self._watches.get(search_id)) is None:
+            watch = self._watches[search_id] = _Watch()
+            watch.task = asyncio.create_task(self._watch(search_id, watch))
+        watch.subscribers.add(queue)
+        return queue
+
+    def _unsubscribe(self, search_id, queue):
+        watch = self._watches.get(search_id)
+        if watch is None or queue not in watch.subscribers:
+            return
+        watch.subscribers.discard(queue)
+        if not watch.subscribers:
+            watch.task.cancel()
+            del self._watches[search_id]
+
+    async def _watch(self, search_id, watch):
+        state = await get_search_state_async(search_id)
+        while state is not None:
+            try:
+                await asyncio.wait_for(watch.wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            watch.wake.clear()
+
+            try:
+                current = await get_search_state_async(search_id)
+                if current is None or current == state:
+                    state = current
+                    continue
+                new = []
+                if current["max_id"] > state["max_id"]:
+                    new = await get_results_after_id_async(search_id, state["max_id"])
+                state = current
+            except Exception as e:
+                logger.error(f"Watching search {search_id} failed: {e}")
+                continue
+
+            event = format_event(search_id, state, new)
+            for queue in watch.subscribers:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    logger.warning(f"Dropped an event for a slow subscriber of search {search_id}.")
+
+        # The search was deleted, so its streams are ended, and a later subscriber starts a new watch.
+        if self._watches.get(search_id) is watch:
+            del self._watches[search_id]
+        for queue in watch.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        watch.subscribers.clear()
+        logger.info(f"Search {search_id} no longer exists. Stopped watching it.")
+
+    async def stream(self, search_id, last_id=None):
+        """
+        Yields SSE messages for a search until the client disconnects or the search
+        is deleted. If last_id is given, listings stored after it are sent first.
+        """
+        queue = self._subscribe(search_id)
+        try:
+            # Client reconnect delay in milliseconds.
+            yield b"retry: 5000\n\n"
+            if last_id is not None:
+                state = await get_search_state_async(search_id)
+                if state is not None and state["max_id"] > last_id:
+                    new = await get_results_after_id_async(search_id, last_id)
+                    yield format_event(search_id, state, new)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._unsubscribe(search_id, queue)
@@ -0,0 +1,237 @@
+"""
+Description: Stream stored listings and searches to NDJSON, CSV or Parquet
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.1
+Usage: python export.py results --format csv --search-id 1 --since 2024-09-01 -o results.csv
+"""
+
+import argparse, csv, io, orjson, sys
+
+from datetime import datetime, timezone
+from logging import getLogger
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.types import Boolean, DateTime, Float, Integer
+
+from database import get_engine, to_db_time, Listing, SearchCriteria
+
+logger = getLogger(__name__)
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Columns exported per table. Results include the search they belong to.
+EXPORT_TABLES = {
+    "results": (
+        Listing.id, Listing.search_id, SearchCriteria.city, SearchCriteria.category,
+        SearchCriteria.query, Listing.order, Listing.url, Listing.title, Listing.price,
+        Listing.location, Listing.image, Listing.is_new, Listing.timestamp, Listing.deal_score
+    ),
+    "search_criteria": (
+        SearchCriteria.id, SearchCriteria.city, SearchCriteria.category,
+        SearchCriteria.query, SearchCriteria.timestamp
+    ),
+}
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def check_export(table, fmt):
+    """
+    Validate the export table and format before streaming starts.
+    Throws: ValueError if either is unknown, or Parquet is requested without pyarrow.
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table '{table}'. Choose from {', '.join(EXPORT_TABLES)}.")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'. Choose from {', '.join(EXPORT_FORMATS)}.")
+    if fmt == "parquet":
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError("Parquet export requires pyarrow. Install it with 'pip install pyarrow'.")
+
+
+def iter_batches(table="results", search_id=None, since=None, until=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Read rows with a server side cursor, batch_size rows at a time,
+    using a session separate from the one used by scrapes.
+    Filters on search_id and the row timestamp (since inclusive, until exclusive).
+    Yields: Lists of row tuples in the column order of EXPORT_TABLES[table].
+    """
+    columns = EXPORT_TABLES[table]
+    model = Listing if table == "results" else SearchCriteria
+
+    stmt = select(*columns)
+    if table == "results":
+        stmt = stmt.join(SearchCriteria, Listing.search_id == SearchCriteria.id)
+        if search_id is not None:
+            stmt = stmt.where(Listing.search_id == search_id)
+    elif search_id is not None:
+        stmt = stmt.where(SearchCriteria.id == search_id)
+    if since is not None:
+        stmt = stmt.where(model.timestamp >= to_db_time(since))
+    if until is not None:
+        stmt = stmt.where(model.timestamp < to_db_time(until))
+    stmt = stmt.order_by(model.id).execution_options(yield_per=batch_size)
+
+    row_count = 0
+    with Session(get_engine()) as session:
+        for partition in session.execute(stmt).partitions():
+            row_count += len(partition)
+            yield partition
+    logger.info(f"Exported {row_count} rows from '{table}'.")
+
+
+def _ndjson_chunks(names, batches):
+    for batch in batches:
+        yield b"".join(
+            orjson.dumps(dict(zip(names, row)), option=orjson.OPT_NAIVE_UTC) + b"\n"
+            for row in batch
+        )
+
+
+def _csv_chunks(names, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for batch in batches:
+        writer.writerows(
+            [
+                value.replace(tzinfo=timezone.utc).isoformat() if isinstance(value, datetime) else value
+                for value in row
+            ]
+            for row in batch
+        )
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """Writable file object that hands written bytes back out in chunks."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _parquet_schema(columns):
+    import pyarrow as pa
+
+    fields = []
+    for column in columns:
+        if isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(column.type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp("us", tz="UTC")
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.key, arrow_type))
+    return pa.schema(fields)
+
+
+def _parquet_chunks(columns, batches):
+    """Each batch is written as one row group, then flushed out of the sink."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema(columns)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for batch in batches:
+            arrays = [
+                pa.array([row[i] for row in batch], type=field.type)
+                for i, field in enumerate(schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def export_stream(table="results", fmt="ndjson", search_id=None, since=None, until=None,
+                  batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Stream a table in the given format. Only one batch is held in memory at a time.
+    Yields: Chunks of bytes.
+    Throws: ValueError from check_export.
+    """
+    check_export(table, fmt)
+    columns = EXPORT_TABLES[table]
+    batches = iter_batches(table, search_id, since, until, batch_size)
+
+    if fmt == "ndjson":
+        return _ndjson_chunks([column.key for column in columns], batches)
+    if fmt == "csv":
+        return _csv_chunks([column.key for column in columns], batches)
+    return _parquet_chunks(columns, batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export stored listings or searches.")
+    parser.add_argument("table", choices=EXPORT_TABLES.keys())
+    parser.add_argument("-f", "--format", choices=EXPORT_FORMATS.keys(), default="ndjson")
+    parser.add_argument("-s", "--search-id", type=int)
+    parser.add_argument("--since", type=datetime.fromisoformat, help="ISO date or datetime, inclusive")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="ISO date or datetime, exclusive")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("-o", "--output", help="Output file. Defaults to stdout for ndjson and csv.")
+    args = parser.parse_args()
+
+    if args.format == "parquet" and not args.output:
+        parser.error("--output is required for parquet.")
+
+    try:
+        chunks = export_stream(args.table, args.format, args.search_id, args.since, args.until, args.batch_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Description: Crawl budget shared by the API and worker processes, with token buckets and adaptive backoff on block signals
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.1
+"""
+
+import json, time
+
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from database import _insert, get_engine, CrawlBudget
+from jobs import JobDeferred
+
+load_dotenv()
+# Crawls per minute across all accounts and processes, and how many can run back to back. 0 disables the limit.
+CRAWL_BUDGET_PER_MINUTE = float(getenv("CRAWL_BUDGET_PER_MINUTE", 6))
+CRAWL_BUDGET_BURST = float(getenv("CRAWL_BUDGET_BURST", 3))
+# Crawls per minute for each Facebook account.
+ACCOUNT_BUDGET_PER_MINUTE = float(getenv("ACCOUNT_BUDGET_PER_MINUTE", 4))
+ACCOUNT_BUDGET_BURST = float(getenv("ACCOUNT_BUDGET_BURST", 3))
+# Item pages opened by enrichment per minute for each account. They have a budget of their own,
+# so enrichment does not use up the crawls.
+ENRICH_PAGES_PER_MINUTE = float(getenv("ENRICH_PAGES_PER_MINUTE", 30))
+ENRICH_PAGES_BURST = float(getenv("ENRICH_PAGES_BURST", 10))
+# Block signals in a row before an account backs off.
+BLOCK_SIGNAL_THRESHOLD = int(getenv("BLOCK_SIGNAL_THRESHOLD", 2))
+# First backoff in seconds. Doubles with each further signal, up to the maximum.
+BACKOFF_BASE_SECONDS = float(getenv("BACKOFF_BASE_SECONDS", 60))
+BACKOFF_MAX_SECONDS = float(getenv("BACKOFF_MAX_SECONDS", 3600))
+
+# Crawl outcomes. All but OK and ERROR are block signals.
+OK = "ok"
+LOGIN_WALL = "login_wall"
+EMPTY = "empty"
+TIMEOUT = "timeout"
+ERROR = "error"
+BLOCK_SIGNALS = (LOGIN_WALL, EMPTY, TIMEOUT)
+
+# Key of the global bucket's row, and the prefixes of each account's crawl and enrichment rows.
+GLOBAL_KEY = "global"
+ACCOUNT_KEY_PREFIX = "account:"
+ENRICH_KEY_PREFIX = "enrich:"
+# Attempts to update the budget when other threads or processes update it at the same time.
+BUDGET_UPDATE_ATTEMPTS = 10
+# Columns changed by acquire and record.
+_STATE_COLUMNS = ("tokens", "updated_at", "signals", "backoff_level", "blocked_until", "outcomes", "refused")
+
+logger = getLogger(__name__)
+
+
+class CrawlBudgetExceeded(JobDeferred):
+    """A crawl was refused. Queued jobs are deferred by retry_after seconds instead of failing."""
+
+
+class TokenBucket:
+    """Allows capacity crawls at once, refilled at per_minute. The tokens are kept in a CrawlBudget row."""
+
+    def __init__(self, per_minute, capacity):
+        self.per_minute = per_minute
+        self.capacity = max(capacity, 1)
+
+    def refill(self, state, now):
+        """Add the tokens refilled since the row's updated_at to state."""
+        tokens = self.capacity if state["tokens"] is None else state["tokens"]
+        if self.per_minute > 0 and state["updated_at"] is not None:
+            tokens = min(self.capacity, tokens + max(now - state["updated_at"], 0) * self.per_minute / 60)
+        state["tokens"] = tokens
+        state["updated_at"] = now
+
+    def wait_time(self, state):
+        """Returns: Seconds until a token is available, 0 if one is available now."""
+        if self.per_minute <= 0 or state["tokens"] >= 1:
+            return 0.0
+        return (1 - state["tokens"]) * 60 / self.per_minute
+
+    def take(self, state):
+        if self.per_minute > 0:
+            state["tokens"] -= 1
+
+    def status(self, state, now):
+        state = dict(state)
+        self.refill(state, now)
+        return {
+            "tokens": round(state["tokens"], 2) if self.per_minute > 0 else None,
+            "capacity": self.capacity,
+            "per_minute": self.per_minute,
+        }
+
+
+def _account_key(account):
+    return f"{ACCOUNT_KEY_PREFIX}{account or ''}"
+
+
+def _enrich_key(account):
+    return f"{ENRICH_KEY_PREFIX}{account or ''}"
+
+
+def _label(account):
+    """Account names are usually emails. Only the start is shown in the status."""
+    return f"{account[:3]}***" if account and len(account) > 3 else account or "default"
+
+
+def _new_state(key):
+    return {
+        "key": key, "tokens": None, "updated_at": None, "signals": 0, "backoff_level": 0,
+        "blocked_until": 0.0, "outcomes": json.dumps({outcome: 0 for outcome in (OK, ERROR) + BLOCK_SIGNALS}),
+        "refused": 0, "version": 0,
+    }
+
+
+class CrawlGovernor:
+    """
+    Decides whether a crawl may start. A crawl needs a token from the global bucket
+    and from its account's bucket, and its account must not be backing off.
+    After BLOCK_SIGNAL_THRESHOLD block signals in a row (login walls, pages without
+    listings, timeouts), the account pauses for BACKOFF_BASE_SECONDS, doubling with
+    each further signal. The first crawl after a pause is a probe: another signal
+    backs off again at once, and each successful crawl lowers the level by one.
+    Schedules are stretched by schedule_stretch() while any account is backing off.
+    Item pages opened by enrichment take from a separate bucket per account, with acquire_page().
+    The state is kept in the crawl_budgets table and changed with a version check,
+    so API threads and every worker.py process take from one budget.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(CRAWL_BUDGET_PER_MINUTE, CRAWL_BUDGET_BURST)
+        self.account_bucket = TokenBucket(ACCOUNT_BUDGET_PER_MINUTE, ACCOUNT_BUDGET_BURST)
+        self.enrich_bucket = TokenBucket(ENRICH_PAGES_PER_MINUTE, ENRICH_PAGES_BURST)
+
+    def _change(self, keys, change):
+        """
+        Read and lock the rows of keys, creating missing ones, and call change(states, now), which
+        changes the states in place. The rows are written in one transaction, only if no other thread
+        or process changed them since they were read. Otherwise it starts over.
+        Returns: What change returns.
+        Throws: RuntimeError if the rows kept changing for BUDGET_UPDATE_ATTEMPTS attempts.
+        """
+        with Session(get_engine()) as session:
+            for _ in range(BUDGET_UPDATE_ATTEMPTS):
+                # Row locks make concurrent changes wait their turn where the database has them,
+                # such as PostgreSQL. The version check covers the others.
+                rows = session.execute(
+                    select(CrawlBudget.__table__)
+                    .where(CrawlBudget.key.in_(keys))
+                    .order_by(CrawlBudget.key)
+                    .with_for_update()
+                ).mappings()
+                states = {row["key"]: dict(row) for row in rows}
+                if missing := [key for key in keys if key not in states]:
+                    session.execute(
+                        _insert(CrawlBudget)
+                        .values([_new_state(key) for key in missing])
+                        .on_conflict_do_nothing(index_elements=["key"])
+                    )
+                    session.commit()
+                    continue
+
+                now = time.time()
+                result = change(states, now)
+                for key in keys:
+                    updated = session.execute(
+                        update(CrawlBudget)
+                        .where(CrawlBudget.key == key, CrawlBudget.version == states[key]["version"])
+                        .values(**{column: states[key][column] for column in _STATE_COLUMNS},
+                                version=states[key]["version"] + 1)
+                    ).rowcount
+                    if not updated:
+                        session.rollback()
+                        break
+                else:
+                    session.commit()
+                    return result
+        raise RuntimeError("The crawl budget was changed by too many crawls at once.")
+
+    def acquire(self, account=None):
+        """
+        Take a crawl from the budget.
+        Throws: CrawlBudgetExceeded with retry_after if the crawl must wait.
+        """
+        account_key = _account_key(account)
+
+        def take(states, now):
+            shared, state = states[GLOBAL_KEY], states[account_key]
+            self.bucket.refill(shared, now)
+            self.account_bucket.refill(state, now)
+            if state["blocked_until"] > now:
+                shared["refused"] += 1
+                return CrawlBudgetExceeded(
+                    state["blocked_until"] - now,
+                    f"Crawling paused after repeated block signals. Retry in {state['blocked_until'] - now:.0f} seconds."
+                )
+            wait = max(self.bucket.wait_time(shared), self.account_bucket.wait_time(state))
+            if wait > 0:
+                shared["refused"] += 1
+                return CrawlBudgetExceeded(wait, f"Crawl budget exhausted. Retry in {wait:.0f} seconds.")
+            self.bucket.take(shared)
+            self.account_bucket.take(state)
+
+        # The refusal is raised after it is counted.
+        if (refused := self._change((GLOBAL_KEY, account_key), take)) is not None:
+            raise refused
+
+    def acquire_page(self, account=None):
+        """
+        Take an item page from the account's enrichment budget. Crawl tokens are not used,
+        but pages wait while the account is backing off.
+        Throws: CrawlBudgetExceeded with retry_after if the page must wait.
+        """
+        account_key, page_key = _account_key(account), _enrich_key(account)
+
+        def take(states, now):
+            state, pages = states[account_key], states[page_key]
+            self.enrich_bucket.refill(pages, now)
+            if state["blocked_until"] > now:
+                pages["refused"] += 1
+                return CrawlBudgetExceeded(
+                    state["blocked_until"] - now,
+                    f"Crawling paused after repeated block signals. Retry in {state['blocked_until'] - now:.0f} seconds."
+                )
+            if (wait := self.enrich_bucket.wait_time(pages)) > 0:
+                pages["refused"] += 1
+                return CrawlBudgetExceeded(wait, f"Enrichment budget exhausted. Retry in {wait:.0f} seconds.")
+            self.enrich_bucket.take(pages)
+
+        if (refused := self._change((account_key, page_key), take)) is not None:
+            raise refused
+
+    def record(self, account, outcome):
+        """Feed back the outcome of a crawl taken with acquire."""
+        account_key = _account_key(account)
+
+        def count(states, now):
+            state = states[account_key]
+            outcomes = json.loads(state["outcomes"])
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            state["outcomes"] = json.dumps(outcomes)
+            if outcome == OK:
+                state["signals"] = 0
+                state["backoff_level"] = max(state["backoff_level"] - 1, 0)
+                return None
+            if outcome not in BLOCK_SIGNALS:
+                return None
+
+            state["signals"] += 1
+            if state["signals"] < BLOCK_SIGNAL_THRESHOLD:
+                return None
+            backoff = BACKOFF_BASE_SECONDS * 2 ** state["backoff_level"]
+            if backoff < BACKOFF_MAX_SECONDS:
+                state["backoff_level"] += 1
+            backoff = min(backoff, BACKOFF_MAX_SECONDS)
+            state["blocked_until"] = now + backoff
+            return state["signals"], backoff
+
+        if (paused := self._change((account_key,), count)) is not None:
+            signals, backoff = paused
+            logger.warning(
+                f"{signals} block signals in a row for account {_label(account)}, "
+                f"last {outcome}. Pausing crawls for {backoff:.0f} seconds."
+            )
+
+    def schedule_stretch(self):
+        """Returns: The factor to multiply schedule intervals by, 1 unless an account is backing off."""
+        with Session(get_engine()) as session:
+            level = session.scalar(
+                select(func.max(CrawlBudget.backoff_level)).where(CrawlBudget.key.startswith(ACCOUNT_KEY_PREFIX))
+            )
+        return 2 ** (level or 0)
+
+    def status(self):
+        """Returns: The global and per account budgets, backoff state, outcome counts and enrichment budgets."""
+        with Session(get_engine()) as session:
+            rows = {row["key"]: dict(row) for row in session.execute(select(CrawlBudget.__table__)).mappings()}
+        now = time.time()
+        shared = rows.get(GLOBAL_KEY, _new_state(GLOBAL_KEY))
+        states = {key: state for key, state in rows.items() if key.startswith(ACCOUNT_KEY_PREFIX)}
+        enrichment = {
+            _label(key.removeprefix(ENRICH_KEY_PREFIX)): {
+                **self.enrich_bucket.status(state, now),
+                "refused": state["refused"],
+            }
+            for key, state in rows.items() if key.startswith(ENRICH_KEY_PREFIX)
+        }
+        accounts = {
+            _label(key.removeprefix(ACCOUNT_KEY_PREFIX)): {
+                **self.account_bucket.status(state, now),
+                "block_signals": state["signals"],
+                "backoff_level": state["backoff_level"],
+                "backoff_remaining": round(max(state["blocked_until"] - now, 0), 1),
+                "outcomes": json.loads(state["outcomes"]),
+            }
+            for key, state in states.items()
+        }
+        level = max((state["backoff_level"] for state in states.values()), default=0)
+        return {
+            "global": self.bucket.status(shared, now),
+            "accounts": accounts,
+            "refused": shared["refused"],
+            "schedule_stretch": 2 ** level,
+            "enrichment": enrichment,
+        }
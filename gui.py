@@ -1,22 +1,23 @@
 """
 Description: This file hosts the web GUI for the Facebook Marketplace Scraper.
 Date Created: 2024-01-24
-Date Modified: 2024-09-11
+Date Modified: 2026-10-19
 Author: Harminder Nijjar (v1.0.0)
 Modified by: SPolton
-Version: 1.5.7
+Version: 1.9.1
 Usage: streamlit run gui.py
 """
 
 import streamlit as st
-import time, logging
-from sys import stdout
+import logging, math, uuid
+
+from datetime import datetime
 
 from api_utils import *
-from notify import send_ntfy
 
 from cities import CITIES
 from models import CATEGORIES, SORT, CONDITION
+from price_stats import describe_deal
 
 
 logging.basicConfig(
@@ -27,76 +28,125 @@ logging.basicConfig(
 st_logger = logging.getLogger("gui")
 st_logger.setLevel(logging.INFO)
 
+# Seconds between checks for events received from the API.
+EVENT_CHECK_SECONDS = 2
+# Listings rendered per page in the card view. The table view scrolls through all of them.
+RESULTS_PAGE_SIZE = 20
+VIEWS = ("Cards", "Table")
+
 
 # Keep state across re-execution.
 state = st.session_state
 if "results" not in state:
     st_logger.debug("Init state.")
     state.results = []
+    # Changes whenever results do, so cached rendering inputs are rebuilt.
+    state.results_version = 0
+    state.page = 0
     state.params = None
-    state.scheduled = False
-    state.frequency = 300  # 5 Minutes
-    state.duration = 0
-    state.cancel_pressed = False
+    state.search_id = None
+    # This session's subscription in the API, and the events of its search.
+    state.subscriber = f"gui-{uuid.uuid4().hex[:12]}"
+    state.subscription_id = None
+    state.events = None
+    state.last_crawled = None
 else:
-    if state.scheduled and state.duration > 0:
-        # Clear countdown_timer from terminal
-        stdout.write(f"\rCanceled.{" "*30}\r")
     st_logger.debug("Rerun: State is already defined.")
 
 
-def start_schedule(frequency=None):
-    """Set state 'scheduled' to True and 'duration' to frequency input."""
-    if not frequency:
-        frequency = state.frequency
-    if not state.scheduled:
-        st_logger.debug("Creating cancel button for schedule.")
-        state.cancel_pressed = cancel.button("Cancel Schedule")
-    state.scheduled = True
-    state.frequency = frequency
-    state.duration = frequency
-    st_logger.info(f"Schedule set for duration {state.duration}")
-
-def stop_schedule():
-    """Set state 'scheduled' to False, 'duration' to 0, and clear cancel button."""
-    state.scheduled = False
-    state.duration = 0
-    cancel.empty()
-    st_logger.debug("Schedule Stopped.")
-
-def countdown_timer(countdown_message):
+def set_results(results, first_page=False):
+    """Replace the results shown. Use this instead of assigning state.results, so the view is rebuilt."""
+    state.results = results
+    state.results_version += 1
+    if first_page:
+        state.page = 0
+
+def follow_search(search_id, message=st.empty()):
+    """Show the stored results of a search, then follow its new listings from the API's events."""
+    stop_following()
+    state.search_id = search_id
+    set_results(get_all_stored_results(search_id), first_page=True)
+    last_id = max((item["id"] for item in state.results), default=0)
+    state.events = EventSubscription(search_id, last_id).start()
+    message.info("Following the search. New listings will appear here as they are found.")
+
+def stop_following():
+    """Stop receiving events for the current search."""
+    if state.events is not None:
+        state.events.stop()
+        state.events = None
+
+def track_search(params, frequency=None, ntfy_topic=None, message=st.empty()):
+    """
+    Subscribe this session to the search, crawled every frequency seconds if given,
+    with new listings sent to ntfy_topic by the API. Other sessions following the
+    same search share its crawls. Without a schedule, one crawl is queued now.
+    """
+    try:
+        subscription = subscribe(params, state.subscriber, frequency, ntfy_topic)
+        if state.subscription_id not in (None, subscription["id"]):
+            unsubscribe(state.subscription_id)
+        state.subscription_id = subscription["id"]
+        search_id = subscription["search_id"]
+        if schedule := subscription["schedule"]:
+            st_logger.info(f"Search {search_id} is crawled every {schedule['interval_seconds']} seconds.")
+        else:
+            queue_crawl(params)
+        follow_search(search_id, message)
+    except RuntimeError as e:
+        message.error(str(e))
+
+def stop_tracking(message=st.empty()):
+    """Delete this session's subscription. The search's schedule stops if no one else follows it."""
+    try:
+        if state.subscription_id is not None:
+            unsubscribe(state.subscription_id)
+    except RuntimeError as e:
+        message.error(str(e))
+    state.subscription_id = None
+    stop_following()
+    st_logger.debug("Tracking Stopped.")
+
+def apply_updates():
     """
-    Sets state.duration equal to state.frequency and clears
-    the countdown message, then enters a loop that decrements
-    state.duration to 0 and updates the countdown message.
-    Returns when state 'duration' reaches 0.
-    \nFunction copied and modified from:
-    https://github.com/wftanya/facebook-marketplace-scraper/commits/main/gui.py
+    Add the listings from new events to the results, marking them new.
+    If the result count no longer matches, such as after stale listings were
+    removed, the stored results are fetched again (a cheap 304 if unchanged).
+    Returns: The number of new listings.
     """
-    st_logger.debug("Starting countdown timer:")
-    countdown_message.empty()
-    while state.duration > 0:
-        mins, secs = divmod(state.duration, 60)
-        timeformat = '{:02d}:{:02d}'.format(mins, secs)
-        time_message = f"Time until next auto scrape: {timeformat}"
-        countdown_message.text(time_message)
-        stdout.write(f"\r{time_message}")
-        stdout.flush()
-        time.sleep(1)
-        state.duration -= 1
-    stdout.write(f"\rComplete!{" "*len(time_message)}\n")
-
-
-def find_results(params, message=st.empty(), show_new=False):
-    """Call API for listings and return the results."""
+    events = state.events.poll()
+    if not events:
+        return 0
+
+    new_listings = []
+    for event in events:
+        known = {item["url"] for item in state.results}
+        fresh = [item for item in event["new"] if item["url"] not in known]
+        for item in state.results:
+            item["is_new"] = False
+        new_listings = fresh + new_listings
+        set_results(fresh + state.results)
+        state.last_crawled = event["last_crawled"]
+
+    if events[-1]["count"] != len(state.results):
+        fresh_urls = {item["url"] for item in new_listings}
+        try:
+            results = get_all_stored_results(state.search_id)
+            for item in results:
+                item["is_new"] = item["url"] in fresh_urls
+            set_results(results)
+        except RuntimeError as e:
+            st_logger.warning(f"Could not fetch stored results: {e}")
+    return len(new_listings)
+
+
+def find_results(params, message=st.empty()):
+    """Call API to crawl once for listings, without tracking, and return the results."""
     results = []
     if params:
         message.info("Attempting to find listings...")
         try:
-            if show_new:
-                results = get_crawl_results(params, API_URL_CRAWL_NEW)
-            else:
-                results = get_crawl_results(params, API_URL_CRAWL)
+            results = get_crawl_results(params, API_URL_CRAWL)
             message.info(f"Number of results: {len(results)}")
 
         except RuntimeError as e:
@@ -104,52 +154,115 @@ def find_results(params, message=st.empty(), show_new=False):
     st_logger.info(f"Recieved {len(results)} results.")
     return results
 
-def notify_new(results, ntfy_topic, notify_limit=None):
-    """Send a notification per result containing 'is_new' = True."""
-    new_count = 0
-    for item in results:
-        if item.get("is_new"):
-            new_count += 1
-            if notify_limit is None or new_count <= notify_limit:
-                title = f"New Listing: {item.get("price")}"
-                message = f"{item.get("title")}"
-                send_ntfy(ntfy_topic, message, title, link=item.get("url"), img=item.get("image"))
-
-    if notify_limit and new_count > notify_limit:
-        title = "Additional New Listings"
-        message = f"View {new_count-notify_limit} more in streamlit."
-        send_ntfy(ntfy_topic, message, title)
-    
-    st_logger.info(f"Found {new_count} new results.")
-    return new_count
-
-def display_results(results, message=st.empty()):
-    """List all the results and update info message with total."""
-    new_count = 0
-    # Iterate over the session results to display each item.
-    for i, item in enumerate(results):
+# Rendering inputs are cached by results_key(). Arguments starting with _ are not hashed,
+# so a rerun with unchanged results does not hash or rebuild them.
+def results_key():
+    """Returns: A key for this session's current results. The cache is shared by all sessions."""
+    return (state.subscriber, state.results_version)
+
+def format_found_at(timestamp):
+    """Returns: The ISO UTC timestamp of a listing from the API in local time, i.e. "24-09-01 14:05:09-0600 MDT"."""
+    if not timestamp:
+        return None
+    try:
+        return datetime.fromisoformat(timestamp).astimezone().strftime("%y-%m-%d %H:%M:%S%z %Z")
+    except ValueError:
+        return timestamp
+
+@st.cache_data(max_entries=16)
+def results_page(key, page, page_size, _results):
+    """Returns: The title, image and details text of each listing on a page of results."""
+    cards = []
+    for item in _results[page * page_size:(page + 1) * page_size]:
+        details = [f"**{item.get('price')}**", f"{item.get('location')}", f"{item.get('url')}"]
+        if found_at := format_found_at(item.get("timestamp")):
+            details.append(f"Found at: {found_at}")
+        if deal := describe_deal(item.get("deal_score")):
+            details.append(f"Deal: {deal}")
+        cards.append({
+            "title": item.get("title"),
+            "image": item.get("image"),
+            "is_new": bool(item.get("is_new")),
+            "details": "  \n".join(details),
+        })
+    return cards
+
+@st.cache_data(max_entries=4)
+def results_table(key, _results):
+    """Returns: The results as a DataFrame for the table view."""
+    import pandas as pd
+
+    return pd.DataFrame([
+        {
+            "image": item.get("image"),
+            "title": item.get("title"),
+            "price": item.get("price"),
+            "location": item.get("location"),
+            "new": bool(item.get("is_new")),
+            "deal": None if item.get("deal_score") is None else item["deal_score"] * 100,
+            "found_at": format_found_at(item.get("timestamp")),
+            "url": item.get("url"),
+        }
+        for item in _results
+    ], columns=["image", "title", "price", "location", "new", "deal", "found_at", "url"])
+
+def change_page(step):
+    state.page += step
+
+def display_cards(results):
+    """Render one page of listings, with buttons to move between pages."""
+    pages = max(math.ceil(len(results) / RESULTS_PAGE_SIZE), 1)
+    state.page = min(max(state.page, 0), pages - 1)
+
+    for i, card in enumerate(results_page(results_key(), state.page, RESULTS_PAGE_SIZE, results)):
         try:
-            st.header(item.get("title"))
+            st.subheader(card["title"])
             col = st.columns(2)
             with col[0]:
-                if img_url := item.get("image"):
-                    st.image(img_url)
+                if card["image"]:
+                    st.image(card["image"])
             with col[1]:
-                if item.get("is_new"):
-                    new_count += 1
-                    st.header("New!")
-                st.write(item.get("price"))
-                st.write(item.get("location"))
-                st.write(item.get("url"))
-                if timestamp := item.get("timestamp"):
-                    st.write(f"Found at: {timestamp}")
-
+                if card["is_new"]:
+                    st.subheader("New!")
+                st.markdown(card["details"])
         except Exception as e:
-            st.error(f"Error displaying listing {i+1}: {e}")
-        finally:
-            if i+1 < len(results):
-                st.write("----")
-    
+            st.error(f"Error displaying listing {state.page * RESULTS_PAGE_SIZE + i + 1}: {e}")
+        st.divider()
+
+    if pages > 1:
+        col = st.columns([1, 2, 1])
+        col[0].button("Previous", on_click=change_page, args=(-1,), disabled=state.page == 0)
+        col[1].caption(f"Page {state.page + 1} of {pages}")
+        col[2].button("Next", on_click=change_page, args=(1,), disabled=state.page == pages - 1)
+
+def display_table(results):
+    """Render all the listings as a compact table. Only the rows scrolled into view are drawn."""
+    st.dataframe(
+        results_table(results_key(), results),
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "image": st.column_config.ImageColumn("Image"),
+            "title": st.column_config.TextColumn("Title"),
+            "price": st.column_config.TextColumn("Price"),
+            "location": st.column_config.TextColumn("Location"),
+            "new": st.column_config.CheckboxColumn("New"),
+            "deal": st.column_config.NumberColumn("Deal", help="Below the search's median price", format="%.0f%%"),
+            "found_at": st.column_config.TextColumn("Found At"),
+            "url": st.column_config.LinkColumn("URL"),
+        },
+    )
+
+def display_results(results, message=st.empty()):
+    """Show the results as pages of cards or as a table, and update info message with total."""
+    if results:
+        view = st.radio("View", VIEWS, horizontal=True, key="view", label_visibility="collapsed")
+        if view == "Table":
+            display_table(results)
+        else:
+            display_cards(results)
+
+    new_count = sum(1 for item in results if item.get("is_new"))
     mes_parts = []
     if len(results) > 0:
         mes_parts.append(f"Total results: {len(results)}")
@@ -160,6 +273,19 @@ def display_results(results, message=st.empty()):
         message.info(mes_info)
         st_logger.info(f"Display: {mes_info}")
 
+def live_results():
+    """
+    Results display. While following a search, this fragment reruns on its own
+    every EVENT_CHECK_SECONDS to apply new events, without rerunning the page.
+    """
+    if state.events is not None:
+        apply_updates()
+        if state.last_crawled:
+            st.caption(f"Last scrape: {state.last_crawled}")
+    results_message = st.empty()
+    with st.expander("Results", True):
+        display_results(state.results, results_message)
+
 # Create a title for the web app.
 st.title("Facebook Marketplace Scraper")
 
@@ -211,6 +337,7 @@ with col[0]:
         ntfy_topic = st.text_input("ntfy Topic", value="new_fb_listing_test", disabled=not show_new).strip()
 with col[1]:
     set_schedule = st.checkbox("Schedule")
+    frequency = None
     if set_schedule:
         frequency = st.number_input("Frequency in seconds", min_value=5, format="%d", value=60, disabled=not set_schedule)
 
@@ -219,12 +346,9 @@ with col[0]:
     submit_pressed = st.button("Submit", disabled=error_present)
 with col[1]:
     cancel = st.empty()
-    if state.scheduled:
-        state.cancel_pressed = cancel.button("Cancel Schedule")
-    else:
-        state.cancel_pressed = False
+    cancel_shown = state.subscription_id is not None
+    cancel_pressed = cancel.button("Stop Tracking") if cancel_shown else False
 
-countdown_message = st.empty()
 message = st.empty()
 
 
@@ -234,32 +358,24 @@ if submit_pressed:
     # Get params and encode the url for api
     state.params = format_crawl_params(city, category, query, sort,
                                 min_price, max_price, condition_values)
-    state.results = find_results(state.params, message, show_new)
-    notify_new(state.results, ntfy_topic, 2)
-    
-    if set_schedule:
-        start_schedule(frequency)
+
+    if show_new or set_schedule:
+        # Scheduled searches are always tracked, so results can be sent as events.
+        track_search(state.params, frequency, ntfy_topic, message)
     else:
-        stop_schedule()
-
-elif state.cancel_pressed:
-    st_logger.info("Cancel Pressed.")
-    stop_schedule()
-
-results_container = st.expander("Results", True)
-with results_container:
-    display_results(state.results, message)
-
-# Scheduled task
-while state.scheduled:
-    countdown_timer(countdown_message) # Wait for timer to finish.
-    
-    countdown_message.text("Scraping...")
-    results = find_results(state.params, message, show_new)
-    new_count = notify_new(results, ntfy_topic)
-
-    start_schedule()
-    if len(results) > 0 and new_count > 0:
-        # Rerun to keep results display updated.
-        state.results = results
-        st.rerun()
\ No newline at end of file
+        stop_tracking(message)
+        set_results(find_results(state.params, message), first_page=True)
+
+    if state.subscription_id is None:
+        cancel.empty()
+    elif not cancel_shown:
+        st_logger.debug("Creating stop button for subscription.")
+        cancel.button("Stop Tracking")
+
+elif cancel_pressed:
+    st_logger.info("Stop Pressed.")
+    stop_tracking(message)
+    cancel.empty()
+
+refresh = EVENT_CHECK_SECONDS if state.events is not None else None
+st.fragment(live_results, run_every=refresh)()
@@ -0,0 +1,89 @@
+"""
+Description: Egress IP information from a lookup service, with a pooled HTTP client and a cache
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.0
+"""
+
+import ipaddress, threading, time
+
+from datetime import datetime, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+# JSON IP lookup service with ipinfo.io style fields. mock_marketplace.py serves a stub at /mock/ip.
+IP_LOOKUP_URL = getenv("IP_LOOKUP_URL", "https://ipinfo.io/json")
+# Seconds a lookup is reused before asking the service again.
+IP_LOOKUP_TTL = float(getenv("IP_LOOKUP_TTL", 300))
+IP_LOOKUP_TIMEOUT = float(getenv("IP_LOOKUP_TIMEOUT", 5))
+
+logger = getLogger(__name__)
+
+# One connection pool for lookups, and the last lookup with when it was made.
+_http = None
+_cached = None
+_cached_at = 0.0
+_lock = threading.Lock()
+
+
+def _get_http():
+    global _http
+    if _http is None:
+        import requests  # Imported on first lookup to keep API startup fast.
+        _http = requests.Session()
+    return _http
+
+
+def parse_ip_information(data):
+    """
+    Map a lookup service's answer to the fields of /return_ip_information.
+    Accepts ipinfo.io fields, and the names used by ip-api.com and ipapi.co where they differ.
+    Returns: A dictionary of ip_address, country, location, isp, hostname, type and version.
+    """
+    ip = data.get("ip") or data.get("query") or ""
+    location = ", ".join(
+        str(part) for part in (data.get("city"), data.get("region") or data.get("regionName")) if part
+    )
+    try:
+        version = f"IPv{ipaddress.ip_address(ip).version}"
+    except ValueError:
+        version = ""
+    return {
+        "ip_address": ip,
+        "country": data.get("country_name") or data.get("country") or "",
+        "location": location,
+        "isp": data.get("org") or data.get("isp") or "",
+        "hostname": data.get("hostname") or data.get("reverse") or "",
+        "type": data.get("type") or "",
+        "version": version,
+    }
+
+
+def get_ip_information(refresh=False):
+    """
+    The public IP address the server's requests leave from, and what the lookup service knows of it.
+    Lookups are cached for IP_LOOKUP_TTL seconds. Concurrent callers share one lookup.
+    Returns: The fields of parse_ip_information, with checked_at and cached.
+    Throws: RuntimeError if the lookup service cannot be reached.
+    """
+    global _cached, _cached_at
+    with _lock:
+        if not refresh and _cached is not None and time.monotonic() - _cached_at < IP_LOOKUP_TTL:
+            return {**_cached, "cached": True}
+
+        import requests
+        try:
+            response = _get_http().get(IP_LOOKUP_URL, timeout=IP_LOOKUP_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"IP lookup at {IP_LOOKUP_URL} failed: {e}")
+            raise RuntimeError(f"IP lookup failed: {e}")
+
+        _cached = {**parse_ip_information(data), "checked_at": datetime.now(timezone.utc).isoformat()}
+        _cached_at = time.monotonic()
+        logger.info(f"Egress IP is {_cached['ip_address']}.")
+        return {**_cached, "cached": False}
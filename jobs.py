@@ -0,0 +1,270 @@
+"""
+Description: Durable crawl job queue stored in the database, with leases, heartbeats, retries and dead-lettering
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.2.1
+"""
+
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import and_, func, select, text, update
+from sqlalchemy.orm import Session
+
+from database import _insert, get_engine, ACTIVE_JOB_CONDITION, CrawlJob
+from models import canonical_search
+
+load_dotenv()
+JOB_MAX_ATTEMPTS = int(getenv("JOB_MAX_ATTEMPTS", 3))
+# Seconds a claimed job belongs to a worker without a heartbeat.
+JOB_LEASE_SECONDS = float(getenv("JOB_LEASE_SECONDS", 120))
+# Seconds before the first retry. Doubles with each failed attempt.
+JOB_RETRY_BACKOFF = float(getenv("JOB_RETRY_BACKOFF", 30))
+
+# Job states. Failed jobs go back to queued until they run out of attempts, then dead.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+logger = getLogger(__name__)
+
+
+class JobDeferred(Exception):
+    """Raised by a job handler to put the job back for retry_after seconds without using an attempt."""
+
+    def __init__(self, retry_after, message=""):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _now():
+    """Job times are naive UTC, set by the queue rather than the database server."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _job_dict(job):
+    return {column.name: getattr(job, column.name) for column in CrawlJob.__table__.columns}
+
+
+def enqueue_job(city, category, query, incremental=False, delay=0, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Add a crawl job, available after delay seconds. If the same search is
+    already queued or running, that job is returned instead of adding another.
+    The insert and the check are one statement on the unique index of active jobs,
+    so concurrent enqueues from several nodes add one job.
+    The job crawls the query as given, and is keyed by its canonical form.
+    Returns: The job id.
+    """
+    crawl_query = query
+    city, category, query = canonical_search(city, category, query)
+    with Session(get_engine()) as session:
+        # The active job can finish between the insert and the select, so try again.
+        for _ in range(3):
+            now = _now()
+            stmt = (
+                _insert(CrawlJob)
+                .values(
+                    city = city,
+                    category = category,
+                    query = query,
+                    crawl_query = crawl_query,
+                    incremental = incremental,
+                    status = QUEUED,
+                    attempts = 0,
+                    max_attempts = max_attempts,
+                    available_at = now + timedelta(seconds=delay),
+                    created_at = now,
+                )
+                .on_conflict_do_nothing(
+                    index_elements=["city", "category", "query"], index_where=text(ACTIVE_JOB_CONDITION)
+                )
+                .returning(CrawlJob.id)
+            )
+            job_id = session.scalar(stmt)
+            if job_id is not None:
+                logger.info(f"Enqueued crawl job {job_id}.")
+            else:
+                job_id = session.scalar(
+                    select(CrawlJob.id).where(
+                        CrawlJob.city == city,
+                        CrawlJob.category == category,
+                        CrawlJob.query == query,
+                        CrawlJob.status.in_((QUEUED, RUNNING)),
+                    )
+                )
+            session.commit()
+            if job_id is not None:
+                return job_id
+        raise RuntimeError(f"Could not enqueue a crawl job for {city}/{category}?{query}.")
+
+
+def _release_expired_leases(session, now):
+    """Jobs whose worker stopped sending heartbeats are retried, or dead-lettered."""
+    expired = and_(CrawlJob.status == RUNNING, CrawlJob.lease_expires < now)
+    session.execute(
+        update(CrawlJob)
+        .where(expired, CrawlJob.attempts >= CrawlJob.max_attempts)
+        .values(status=DEAD, lease_owner=None, finished_at=now, last_error="Lease expired")
+    )
+    session.execute(
+        update(CrawlJob)
+        .where(expired)
+        .values(status=QUEUED, lease_owner=None, available_at=now, last_error="Lease expired")
+    )
+    session.commit()
+
+
+def claim_job(worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Claim the oldest available job for worker_id. Safe with many workers in
+    many processes: a job is only claimed if its row is still available when updated.
+    Returns: The claimed job as a dictionary, or None if no job is available.
+    """
+    with Session(get_engine()) as session:
+        now = _now()
+        _release_expired_leases(session, now)
+
+        candidates = session.scalars(
+            select(CrawlJob.id)
+            .where(CrawlJob.status == QUEUED, CrawlJob.available_at <= now)
+            .order_by(CrawlJob.available_at, CrawlJob.id)
+            .limit(5)
+        ).all()
+
+        for job_id in candidates:
+            claimed = session.execute(
+                update(CrawlJob)
+                .where(CrawlJob.id == job_id, CrawlJob.status == QUEUED)
+                .values(
+                    status = RUNNING,
+                    lease_owner = worker_id,
+                    lease_expires = now + timedelta(seconds=lease_seconds),
+                    heartbeat_at = now,
+                    attempts = CrawlJob.attempts + 1,
+                )
+            ).rowcount
+            session.commit()
+            if claimed:
+                logger.info(f"Worker {worker_id} claimed job {job_id}.")
+                return _job_dict(session.get(CrawlJob, job_id))
+    return None
+
+
+def heartbeat(job_id, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Extend the lease of a running job.
+    Returns: False if the worker no longer holds the lease.
+    """
+    with Session(get_engine()) as session:
+        now = _now()
+        extended = session.execute(
+            update(CrawlJob)
+            .where(CrawlJob.id == job_id, CrawlJob.lease_owner == worker_id, CrawlJob.status == RUNNING)
+            .values(heartbeat_at=now, lease_expires=now + timedelta(seconds=lease_seconds))
+        ).rowcount
+        session.commit()
+        return extended > 0
+
+
+def complete_job(job_id, worker_id, search_id=None, result_count=None, new_count=None):
+    """Mark a job done. Returns: False if the worker no longer holds the lease."""
+    with Session(get_engine()) as session:
+        completed = session.execute(
+            update(CrawlJob)
+            .where(CrawlJob.id == job_id, CrawlJob.lease_owner == worker_id, CrawlJob.status == RUNNING)
+            .values(
+                status = DONE,
+                finished_at = _now(),
+                lease_owner = None,
+                search_id = search_id,
+                result_count = result_count,
+                new_count = new_count,
+                last_error = None,
+            )
+        ).rowcount
+        session.commit()
+        return completed > 0
+
+
+def fail_job(job_id, worker_id, error):
+    """
+    Record a failed attempt. The job is retried after an exponential backoff,
+    or dead-lettered once it has used max_attempts.
+    Returns: The new job status, or None if the worker no longer holds the lease.
+    """
+    with Session(get_engine()) as session:
+        job = session.get(CrawlJob, job_id)
+        if job is None or job.lease_owner != worker_id or job.status != RUNNING:
+            return None
+
+        now = _now()
+        job.lease_owner = None
+        job.last_error = str(error)
+        if job.attempts >= job.max_attempts:
+            job.status = DEAD
+            job.finished_at = now
+            logger.error(f"Job {job_id} failed {job.attempts} times and was dead-lettered: {error}")
+        else:
+            job.status = QUEUED
+            job.available_at = now + timedelta(seconds=JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+            logger.warning(f"Job {job_id} failed on attempt {job.attempts}, retrying at {job.available_at}: {error}")
+        session.commit()
+        return job.status
+
+
+def defer_job(job_id, worker_id, delay, reason=None):
+    """
+    Put a running job back in the queue for delay seconds. The claim's attempt is returned.
+    Returns: False if the worker no longer holds the lease.
+    """
+    with Session(get_engine()) as session:
+        deferred = session.execute(
+            update(CrawlJob)
+            .where(CrawlJob.id == job_id, CrawlJob.lease_owner == worker_id, CrawlJob.status == RUNNING)
+            .values(
+                status = QUEUED,
+                lease_owner = None,
+                attempts = CrawlJob.attempts - 1,
+                available_at = _now() + timedelta(seconds=delay),
+                last_error = reason,
+            )
+        ).rowcount
+        session.commit()
+        return deferred > 0
+
+
+def retry_dead_job(job_id):
+    """Move a dead-lettered job back to the queue with fresh attempts. Returns: True if it was dead."""
+    with Session(get_engine()) as session:
+        retried = session.execute(
+            update(CrawlJob)
+            .where(CrawlJob.id == job_id, CrawlJob.status == DEAD)
+            .values(status=QUEUED, attempts=0, available_at=_now(), finished_at=None)
+        ).rowcount
+        session.commit()
+        return retried > 0
+
+
+def get_job(job_id):
+    """Returns: The job as a dictionary, or None."""
+    with Session(get_engine()) as session:
+        job = session.get(CrawlJob, job_id)
+        return _job_dict(job) if job else None
+
+
+def job_stats():
+    """Returns: The number of jobs in each state, and how many queued jobs are available now."""
+    with Session(get_engine()) as session:
+        stats = {status: 0 for status in (QUEUED, RUNNING, DONE, DEAD)}
+        for status, count in session.execute(select(CrawlJob.status, func.count()).group_by(CrawlJob.status)):
+            stats[status] = count
+        stats["available"] = session.scalar(
+            select(func.count())
+            .select_from(CrawlJob)
+            .where(CrawlJob.status == QUEUED, CrawlJob.available_at <= _now())
+        )
+        return stats
@@ -0,0 +1,316 @@
+"""
+Description: Live watch of hot searches, with a resident browser tab per search refreshed in place
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.1
+"""
+
+import threading, time
+
+from collections import OrderedDict
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from governor import CrawlBudgetExceeded, EMPTY, ERROR, LOGIN_WALL, OK, TIMEOUT
+from models import FBClassBullshit, ListingRecord, MARKETPLACE_URL
+
+load_dotenv()
+# Searches with a resident tab. Watching another search closes the least recently used one.
+LIVE_WATCH_MAX_TABS = int(getenv("LIVE_WATCH_MAX_TABS", 3))
+# Seconds between refreshes of a watched search, unless the watch sets its own.
+LIVE_WATCH_INTERVAL = float(getenv("LIVE_WATCH_INTERVAL", 60))
+LIVE_WATCH_MIN_INTERVAL = float(getenv("LIVE_WATCH_MIN_INTERVAL", 10))
+# Scrolls after each refresh. The newest listings are at the top of the feed.
+LIVE_WATCH_SCROLLS = int(getenv("LIVE_WATCH_SCROLLS", 1))
+# Seconds between checks for due watches.
+LIVE_WATCH_TICK = 1
+
+logger = getLogger(__name__)
+
+# Reads the listing elements of the feed in page order, as app.parse_listings does.
+# Listings whose path is in known only return their path, so the diff against the
+# last snapshot happens in the page and only new listings are sent back.
+_READ_FEED = """
+([selectors, known]) => {
+    known = new Set(known);
+    const paths = new Set(), added = [];
+    const text = (listing, selector) => listing.querySelector(selector)?.textContent ?? null;
+    for (const listing of document.querySelectorAll(selectors.listing)) {
+        const href = listing.querySelector(selectors.url)?.getAttribute("href");
+        if (!href) continue;
+        const path = href.split("?")[0].replace(/\\/+$/, "");
+        if (paths.has(path)) continue;
+        paths.add(path);
+        if (known.has(path)) continue;
+        added.push({
+            path: path,
+            title: text(listing, selectors.title),
+            price: text(listing, selectors.price),
+            location: text(listing, selectors.location),
+            image: listing.querySelector(selectors.image)?.getAttribute("src") ?? null,
+        });
+    }
+    return {paths: [...paths], added: added};
+}
+"""
+
+_SELECTORS = {
+    "listing": f'div[class="{FBClassBullshit.LISTINGS.value}"]',
+    "url": f'a[class="{FBClassBullshit.URL.value}"]',
+    "title": f'span[class="{FBClassBullshit.TITLE.value}"]',
+    "price": f'span[class="{FBClassBullshit.PRICE.value}"]',
+    "location": f'span[class="{FBClassBullshit.LOCATION.value}"]',
+    "image": f'img[class="{FBClassBullshit.IMAGE.value}"]',
+}
+
+
+class _LiveTab:
+    """A watched search, its resident page and the listing paths seen in it at the last refresh."""
+
+    def __init__(self, search_id, city, category, query, interval):
+        self.search_id = search_id
+        self.url = MARKETPLACE_URL.format(city, category, query)
+        self.interval = interval
+        self.page = None
+        self.known = set()
+        self.next_run = 0.0
+        self.opened_at = None
+        self.refreshes = 0
+        self.new_count = 0
+        self.last_refresh = None
+        self.last_error = None
+
+    def status(self):
+        return {
+            "search_id": self.search_id,
+            "url": self.url,
+            "interval": self.interval,
+            "resident": self.page is not None,
+            "refreshes": self.refreshes,
+            "new_count": self.new_count,
+            "listings_in_page": len(self.known),
+            "next_run_in": round(max(self.next_run - time.monotonic(), 0), 1),
+            "last_refresh_ms": self.last_refresh,
+            "last_error": self.last_error,
+        }
+
+
+class LiveWatcher:
+    """
+    Keeps a tab open for each watched search on a daemon thread, which owns the browser,
+    since Playwright's sync API only works on the thread that started it.
+    The first visit navigates and logs in like a crawl. Each later refresh reloads the
+    resident tab, scrolls LIVE_WATCH_SCROLLS times and reads the feed in the page,
+    where listings are compared with the paths seen at the last refresh.
+    Only listings not seen before are passed to on_listings(search_id, listings).
+    At most max_tabs searches are watched. Watching or renewing a search makes it the
+    most recently used, and the least recently used search is dropped when over the cap.
+    Refreshes take from the crawl budget like crawls do, and are skipped while it is exhausted.
+    """
+
+    def __init__(self, on_listings, governor=None, account=None, max_tabs=LIVE_WATCH_MAX_TABS,
+                 tick=LIVE_WATCH_TICK):
+        self.on_listings = on_listings
+        self.governor = governor
+        self.account = account
+        self.max_tabs = max(max_tabs, 1)
+        self.tick = tick
+        self.evicted = 0
+        # Watched searches, least recently used first.
+        self._tabs = OrderedDict()
+        # Dropped searches whose tab the watcher thread still has to close.
+        self._closing = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # Held while the watcher thread is started or replaced.
+        self._thread_lock = threading.Lock()
+
+    def watch(self, search_id, city, category, query, interval=None):
+        """Watch a search, or renew its watch. Safe to call from any thread."""
+        interval = max(interval or LIVE_WATCH_INTERVAL, LIVE_WATCH_MIN_INTERVAL)
+        with self._lock:
+            if (tab := self._tabs.get(search_id)) is not None:
+                tab.interval = interval
+                self._tabs.move_to_end(search_id)
+            else:
+                self._tabs[search_id] = _LiveTab(search_id, city, category, query, interval)
+                logger.info(f"Live watching search {search_id} every {interval:g} seconds.")
+            while len(self._tabs) > self.max_tabs:
+                _, evicted = self._tabs.popitem(last=False)
+                self._closing.append(evicted)
+                self.evicted += 1
+                logger.info(f"Stopped live watching search {evicted.search_id}, the least recently used.")
+        self._start()
+
+    def _start(self):
+        """Start the watcher thread unless it is running. A stopped thread is waited for first."""
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                if not self._stop.is_set():
+                    return
+                # Stopped but still closing its browser, so only one thread ever owns the tabs.
+                # Not under _lock, which the thread takes while it stops.
+                self._thread.join()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="live-watch", daemon=True)
+            self._thread.start()
+
+    def unwatch(self, search_id):
+        """
+        Stop watching a search and close its tab. Safe to call from any thread.
+        Returns: False if the search was not watched.
+        """
+        with self._lock:
+            if (tab := self._tabs.pop(search_id, None)) is None:
+                return False
+            self._closing.append(tab)
+        logger.info(f"Stopped live watching search {search_id}.")
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        """Returns: The watched searches, most recently used first, and the tab cap."""
+        with self._lock:
+            tabs = [tab.status() for tab in reversed(self._tabs.values())]
+        return {"max_tabs": self.max_tabs, "evicted": self.evicted, "watches": tabs}
+
+    def _close_dropped(self):
+        with self._lock:
+            closing, self._closing = self._closing, []
+        for tab in closing:
+            self._close(tab)
+
+    def _close(self, tab):
+        if tab.page is not None:
+            try:
+                tab.page.close()
+            except Exception as e:
+                logger.debug(f"Closing the tab of search {tab.search_id} failed: {e}")
+            tab.page = None
+
+    def _run(self):
+        from playwright.sync_api import sync_playwright
+        from app import BROWSER_HEADLESS, load_cookies
+
+        logger.info("Live watch started.")
+        with sync_playwright() as p:
+            browser = context = None
+            try:
+                while not self._stop.is_set():
+                    self._close_dropped()
+                    with self._lock:
+                        tabs = list(self._tabs.values())
+                    if not tabs:
+                        # Nothing left to watch, so the browser is closed until the next watch.
+                        if browser is not None:
+                            browser.close()
+                            browser = context = None
+                        self._stop.wait(self.tick)
+                        continue
+
+                    if browser is None or not browser.is_connected():
+                        for tab in tabs:
+                            tab.page = None
+                        try:
+                            browser = p.firefox.launch(headless=BROWSER_HEADLESS)
+                            context = browser.new_context()
+                            load_cookies(context)
+                        except Exception as e:
+                            logger.error(f"Live watch could not start the browser: {e}")
+                            browser = None
+                            for tab in tabs:
+                                tab.last_error = f"Could not start the browser. {e}"
+                            self._stop.wait(LIVE_WATCH_MIN_INTERVAL)
+                            continue
+
+                    now = time.monotonic()
+                    for tab in sorted(tabs, key=lambda tab: tab.next_run):
+                        if tab.next_run > now or self._stop.is_set():
+                            break
+                        self._refresh(context, tab)
+                        # Dropped tabs are closed between refreshes, not after a full round.
+                        self._close_dropped()
+                    self._stop.wait(self.tick)
+            finally:
+                with self._lock:
+                    for tab in [*self._tabs.values(), *self._closing]:
+                        tab.page = None
+                    self._closing = []
+                if browser is not None and browser.is_connected():
+                    browser.close()
+        logger.info("Live watch stopped.")
+
+    def _refresh(self, context, tab):
+        """Open or refresh the tab of a search and pass on its new listings."""
+        from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+        from app import crawl_activity, item_url, login_if_prompted, open_marketplace_page
+
+        tab.next_run = time.monotonic() + tab.interval
+        with self._lock:
+            watched = self._tabs.get(tab.search_id) is tab
+        if not watched:
+            return
+        try:
+            if self.governor is not None:
+                self.governor.acquire(self.account)
+        except CrawlBudgetExceeded as e:
+            tab.next_run = time.monotonic() + max(e.retry_after, self.tick)
+            tab.last_error = str(e)
+            return
+
+        start = time.perf_counter()
+        outcome = ERROR
+        try:
+            with crawl_activity():
+                if tab.page is None or tab.page.is_closed():
+                    tab.page = open_marketplace_page(context, tab.url)
+                    tab.known = set()
+                    tab.opened_at = time.time()
+                else:
+                    tab.page.reload()
+                    login_if_prompted(tab.page, context)
+                for _ in range(LIVE_WATCH_SCROLLS):
+                    tab.page.keyboard.press("End")
+                    tab.page.wait_for_load_state()
+
+                feed = tab.page.evaluate(_READ_FEED, [_SELECTORS, list(tab.known)])
+            outcome = OK if feed["paths"] else EMPTY
+            tab.known = set(feed["paths"])
+            added = [
+                ListingRecord(
+                    url = item_url(listing["path"]),
+                    title = listing["title"],
+                    price = listing["price"],
+                    location = listing["location"],
+                    image = listing["image"],
+                    is_new = True,
+                )
+                for listing in feed["added"]
+            ]
+            tab.refreshes += 1
+            tab.new_count += len(added)
+            tab.last_error = None
+            if added:
+                self.on_listings(tab.search_id, added)
+            logger.debug(f"Live watch of search {tab.search_id}: {len(feed['paths'])} listings, {len(added)} new.")
+        except AssertionError as e:
+            outcome = LOGIN_WALL
+            tab.last_error = str(e)
+            self._close(tab)
+        except PlaywrightTimeoutError as e:
+            outcome = TIMEOUT
+            tab.last_error = f"Timed out loading the page. {e}"
+            self._close(tab)
+        except Exception as e:
+            logger.error(f"Live watch of search {tab.search_id} failed: {e}", exc_info=True)
+            tab.last_error = str(e)
+            self._close(tab)
+        finally:
+            tab.last_refresh = round((time.perf_counter() - start) * 1000)
+            if self.governor is not None:
+                self.governor.record(self.account, outcome)
@@ -0,0 +1,263 @@
+"""
+Description: Retention, orphan cleanup, incremental VACUUM (SQLite) and ANALYZE for the database
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.5.1
+Usage: python maintenance.py
+"""
+
+import os, threading, time
+
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import delete, func, or_, select
+from sqlalchemy.orm import Session
+
+from database import (
+    DATABASE, DATABASE_BACKEND, get_engine, CrawlJob, Listing, ListingDetail, Schedule, SearchCriteria,
+    SearchStats, Subscription
+)
+from jobs import DEAD, DONE
+from snapshots import expire_snapshots, remove_snapshot_files
+
+load_dotenv()
+# Days a search is kept after it was last crawled, unless the search sets retention_days.
+RETENTION_DAYS = int(getenv("RETENTION_DAYS", 30))
+# Days finished and dead-lettered crawl jobs are kept. 0 keeps them forever.
+JOB_RETENTION_DAYS = int(getenv("JOB_RETENTION_DAYS", 7))
+# Hours between scheduled runs. 0 disables the scheduler.
+MAINTENANCE_INTERVAL_HOURS = float(getenv("MAINTENANCE_INTERVAL_HOURS", 24))
+# Free pages released per incremental vacuum step, and the pause between steps.
+VACUUM_STEP_PAGES = int(getenv("VACUUM_STEP_PAGES", 256))
+VACUUM_STEP_PAUSE = float(getenv("VACUUM_STEP_PAUSE", 0.2))
+# Longest time to wait for running crawls to finish before giving up on a run.
+MAINTENANCE_MAX_WAIT = float(getenv("MAINTENANCE_MAX_WAIT", 600))
+
+logger = getLogger(__name__)
+
+# auto_vacuum modes returned by PRAGMA auto_vacuum.
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def database_stats(connection):
+    """Returns: A dictionary with the database size, and fragmentation on SQLite."""
+    if DATABASE_BACKEND == "postgresql":
+        return {"database_bytes": connection.exec_driver_sql("SELECT pg_database_size(current_database())").scalar()}
+    if DATABASE_BACKEND != "sqlite":
+        return {}
+    page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+    page_count = connection.exec_driver_sql("PRAGMA page_count").scalar()
+    freelist_count = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    return {
+        "database_bytes": _file_size(DATABASE) + _file_size(f"{DATABASE}-wal"),
+        "file_bytes": _file_size(DATABASE),
+        "wal_bytes": _file_size(f"{DATABASE}-wal"),
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist_count,
+        "used_bytes": (page_count - freelist_count) * page_size,
+        "free_bytes": freelist_count * page_size,
+        "fragmentation": round(freelist_count / page_count, 4) if page_count else 0.0,
+    }
+
+
+def remove_expired(session, now=None):
+    """
+    Delete searches that were not crawled within their retention period, along with their listings,
+    and listings, schedules, subscriptions and statistics that no longer have a search.
+    Listing details of URLs no search has anymore, snapshots older than SNAPSHOT_RETENTION_DAYS, and
+    crawl jobs finished or dead-lettered more than JOB_RETENTION_DAYS ago, are deleted too.
+    Snapshot files are removed after the commit.
+    Returns: A dictionary with the number of searches, listings, details, snapshots and jobs deleted.
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    last_active = func.coalesce(SearchCriteria.last_crawled, SearchCriteria.timestamp)
+
+    expired_ids = []
+    rows = session.execute(select(SearchCriteria.id, SearchCriteria.retention_days, last_active))
+    for search_id, retention_days, last_activity in rows:
+        days = RETENTION_DAYS if retention_days is None else retention_days
+        if days > 0 and last_activity is not None and last_activity < now - timedelta(days=days):
+            expired_ids.append(search_id)
+
+    deleted_listings = 0
+    if expired_ids:
+        deleted_listings += session.execute(
+            delete(Listing).where(Listing.search_id.in_(expired_ids))
+        ).rowcount
+        session.execute(delete(SearchCriteria).where(SearchCriteria.id.in_(expired_ids)))
+
+    # Schedules, subscriptions and statistics of searches that no longer exist.
+    session.execute(delete(Schedule).where(~Schedule.search_id.in_(select(SearchCriteria.id))))
+    session.execute(delete(Subscription).where(~Subscription.search_id.in_(select(SearchCriteria.id))))
+    session.execute(delete(SearchStats).where(~SearchStats.search_id.in_(select(SearchCriteria.id))))
+
+    # Orphaned listings, such as those left by manual deletes.
+    deleted_listings += session.execute(
+        delete(Listing).where(or_(
+            Listing.search_id.is_(None),
+            ~Listing.search_id.in_(select(SearchCriteria.id))
+        ))
+    ).rowcount
+
+    # Details of listings no search has anymore, old snapshots and old finished jobs.
+    deleted_details = session.execute(
+        delete(ListingDetail).where(~ListingDetail.url.in_(select(Listing.url).where(Listing.url.is_not(None))))
+    ).rowcount
+
+    snapshot_paths = expire_snapshots(session, now)
+
+    deleted_jobs = 0
+    if JOB_RETENTION_DAYS > 0:
+        deleted_jobs = session.execute(
+            delete(CrawlJob).where(
+                CrawlJob.status.in_((DONE, DEAD)),
+                CrawlJob.finished_at < now - timedelta(days=JOB_RETENTION_DAYS),
+            )
+        ).rowcount
+    session.commit()
+    remove_snapshot_files(snapshot_paths)
+    return {
+        "deleted_searches": len(expired_ids),
+        "deleted_listings": deleted_listings,
+        "deleted_details": deleted_details,
+        "deleted_snapshots": len(snapshot_paths),
+        "deleted_jobs": deleted_jobs,
+    }
+
+
+def _wait_until_idle(is_busy, deadline):
+    """Returns: True once is_busy() is False, or False if the deadline passed first."""
+    while is_busy():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(1)
+    return True
+
+
+def run_maintenance(is_busy=lambda: False):
+    """
+    Apply retention, remove orphans, release free pages with incremental
+    vacuum and refresh query planner statistics with ANALYZE.
+    Vacuum and checkpoints are SQLite only. Other databases vacuum themselves,
+    such as PostgreSQL's autovacuum.
+    Waits for is_busy() to return False before starting and between vacuum steps,
+    so crawls are not stalled waiting for the write lock.
+    Returns: A report with the database stats before and after the run.
+    """
+    deadline = time.monotonic() + MAINTENANCE_MAX_WAIT
+    report = {"started": datetime.now(timezone.utc).isoformat(), "completed": False}
+    if not _wait_until_idle(is_busy, deadline):
+        logger.warning("Maintenance skipped, crawls did not finish in time.")
+        report["skipped"] = "busy"
+        return report
+
+    engine = get_engine()
+    # VACUUM and auto_vacuum changes cannot run inside a transaction.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        report["before"] = database_stats(connection)
+
+        with Session(bind=connection) as session:
+            report.update(remove_expired(session))
+        logger.info(
+            f"Retention removed {report['deleted_searches']} searches, {report['deleted_listings']} listings, "
+            f"{report['deleted_details']} listing details, {report['deleted_snapshots']} snapshots "
+            f"and {report['deleted_jobs']} old jobs."
+        )
+
+        if DATABASE_BACKEND == "sqlite":
+            report["released_pages"] = _incremental_vacuum(connection, is_busy, deadline)
+
+        if _wait_until_idle(is_busy, deadline):
+            connection.exec_driver_sql("ANALYZE")
+            report["analyzed"] = True
+
+        if DATABASE_BACKEND == "sqlite":
+            # Move the write-ahead log back into the database file.
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        report["after"] = database_stats(connection)
+
+    report["completed"] = True
+    before, after = report["before"], report["after"]
+    summary = f"Size {before.get('database_bytes')} -> {after.get('database_bytes')} bytes"
+    if "fragmentation" in before:
+        summary += f", fragmentation {before['fragmentation']:.2%} -> {after['fragmentation']:.2%}"
+    logger.info(f"Maintenance complete. {summary}.")
+    return report
+
+
+def _incremental_vacuum(connection, is_busy, deadline):
+    """
+    Release the SQLite database's free pages in steps of VACUUM_STEP_PAGES.
+    Returns: The number of pages released.
+    """
+    if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != AUTO_VACUUM_INCREMENTAL:
+        # One time conversion. Only takes effect after a full VACUUM.
+        logger.info("Enabling incremental auto_vacuum with a full VACUUM.")
+        connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+
+    # The sqlite3 module only steps a pragma once, which frees a single page.
+    # executescript runs it to completion.
+    dbapi_connection = connection.connection.dbapi_connection
+    free_before = free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    while free_pages > 0:
+        if not _wait_until_idle(is_busy, deadline):
+            logger.warning(f"Incremental vacuum paused with {free_pages} free pages left.")
+            break
+        dbapi_connection.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+        free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if free_pages > 0:
+            time.sleep(VACUUM_STEP_PAUSE)
+    return free_before - free_pages
+
+
+class MaintenanceScheduler:
+    """Runs run_maintenance every interval_hours on a daemon thread."""
+
+    def __init__(self, is_busy=lambda: False, interval_hours=MAINTENANCE_INTERVAL_HOURS):
+        self.is_busy = is_busy
+        self.interval = interval_hours * 3600
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            logger.info("Maintenance scheduler disabled.")
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="maintenance", daemon=True)
+            self._thread.start()
+            logger.info(f"Maintenance scheduled every {self.interval / 3600:g} hours.")
+
+    def stop(self):
+        self._stop.set()
+
+    def run_now(self):
+        """Run maintenance on the calling thread. Only one run happens at a time."""
+        with self._lock:
+            try:
+                self.last_report = run_maintenance(self.is_busy)
+            except Exception as e:
+                logger.error(f"Maintenance failed: {e}", exc_info=True)
+                self.last_report = {"completed": False, "error": str(e)}
+            return self.last_report
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_now()
+
+
+if __name__ == "__main__":
+    import json
+    print(json.dumps(run_maintenance(), indent=2))
@@ -0,0 +1,334 @@
+"""
+Description: Local mock of Facebook Marketplace for end-to-end and load tests, with infinite scroll, a login form,
+    and configurable latency and failures, plus a stub IP lookup
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.1.0
+Usage: python mock_marketplace.py [--port 8100] [--pages static/snapshots]
+    then start the API with MARKETPLACE_BASE_URL=http://127.0.0.1:8100
+"""
+
+import argparse, asyncio, glob, html, logging, os, random, zlib
+
+from dataclasses import asdict, dataclass, fields
+from os import getenv
+from urllib.parse import parse_qs, quote
+from dotenv import load_dotenv
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
+
+from models import FBClassBullshit
+
+load_dotenv()
+MOCK_HOST = getenv("MOCK_HOST", "127.0.0.1")
+MOCK_PORT = int(getenv("MOCK_PORT", 8100))
+# Recorded pages to serve: .html files, or .html.zst snapshots. Listings are generated if there are none.
+MOCK_PAGES_DIR = getenv("MOCK_PAGES_DIR", "static/mock_pages")
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "mock_session"
+
+
+@dataclass
+class MockSettings:
+    """Behaviour of the mock. Can be changed while running with POST /mock/config."""
+
+    latency_ms: float = float(getenv("MOCK_LATENCY_MS", 200))
+    jitter_ms: float = float(getenv("MOCK_JITTER_MS", 100))
+    # Fraction of page loads answered with a server error, a login wall or a page without listings.
+    error_rate: float = float(getenv("MOCK_ERROR_RATE", 0))
+    login_wall_rate: float = float(getenv("MOCK_LOGIN_WALL_RATE", 0))
+    empty_rate: float = float(getenv("MOCK_EMPTY_RATE", 0))
+    # Show the login form until the browser has logged in.
+    login_required: bool = getenv("MOCK_LOGIN_REQUIRED", "true").lower() == "true"
+    page_size: int = int(getenv("MOCK_PAGE_SIZE", 24))
+    # Scroll pages in each feed.
+    pages: int = int(getenv("MOCK_SCROLL_PAGES", 10))
+    # Generated listings added to the top of a feed each time it is loaded.
+    new_per_load: int = int(getenv("MOCK_NEW_PER_LOAD", 2))
+
+    def update(self, params):
+        """Set fields from string values. Returns: The names of the fields set."""
+        updated = []
+        for field in fields(self):
+            if field.name in params:
+                value = params[field.name]
+                if field.type is bool:
+                    value = value.lower() == "true"
+                setattr(self, field.name, field.type(value))
+                updated.append(field.name)
+        return updated
+
+
+settings = MockSettings()
+stats = {}
+# Newest generated listing number for each search, so feeds grow as they are crawled.
+_feed_heads = {}
+# Listing elements from recorded pages, as HTML.
+_recorded = []
+
+app = FastAPI(title="Mock Marketplace")
+
+
+FEED_SCRIPT = """
+<script>
+const feed = document.getElementById("feed");
+let nextPage = 1, loading = false, finished = false;
+window.addEventListener("scroll", async () => {
+    if (loading || finished || window.innerHeight + window.scrollY < document.body.scrollHeight - 400) return;
+    loading = true;
+    const response = await fetch(feed.dataset.next + "&page=" + nextPage);
+    if (response.ok) {
+        const listings = await response.text();
+        if (listings.trim()) {
+            feed.insertAdjacentHTML("beforeend", listings);
+            nextPage += 1;
+        } else {
+            finished = true;
+        }
+    }
+    loading = false;
+});
+</script>
+"""
+
+LOGIN_FORM = """
+<div id="loginform">
+  <form method="post" action="/mock/login?next={next}">
+    <input name="email" type="text">
+    <input name="pass" type="password">
+    <button name="login" type="submit">Log in</button>
+  </form>
+</div>
+"""
+
+
+def _count(name):
+    stats[name] = stats.get(name, 0) + 1
+
+
+def _page(body, title="Marketplace"):
+    return (
+        f"<!DOCTYPE html><html><head><title>{title}</title>"
+        "<style>#feed > div { min-height: 320px; }</style></head>"
+        f"<body><div role=\"main\">{body}</div></body></html>"
+    )
+
+
+def _login_page(next_url):
+    return _page(LOGIN_FORM.format(next=quote(next_url, safe="")), "Log in to Facebook")
+
+
+async def _delay():
+    latency = settings.latency_ms + random.uniform(-settings.jitter_ms, settings.jitter_ms)
+    await asyncio.sleep(max(latency, 0) / 1000)
+
+
+def _generated_listing(key, number, city):
+    """Returns: A listing element with the same classes as the Marketplace feed."""
+    item_id = 10**15 + zlib.crc32(key.encode()) * 10**5 + number
+    rng = random.Random(item_id)
+    price = rng.randrange(5, 2000, 5)
+    return (
+        f'<div class="{FBClassBullshit.LISTINGS.value}">'
+        f'<a class="{FBClassBullshit.URL.value}" href="/marketplace/item/{item_id}/?ref=search&amp;referral_code=null">'
+        f'<img class="{FBClassBullshit.IMAGE.value}" src="https://picsum.photos/seed/{item_id}/261/260">'
+        f'<span class="{FBClassBullshit.PRICE.value}">CA${price}</span>'
+        f'<span class="{FBClassBullshit.TITLE.value}">Mock listing {number}</span>'
+        f'<span class="{FBClassBullshit.LOCATION.value}">{html.escape(city)}</span>'
+        f'</a></div>'
+    )
+
+
+def _feed_listings(key, city, page, head):
+    """Returns: The listing elements on one scroll page of a feed, newest first."""
+    start = page * settings.page_size
+    if _recorded:
+        return _recorded[start:start + settings.page_size]
+    if page >= settings.pages:
+        return []
+    numbers = range(head - start, max(head - start - settings.page_size, 0), -1)
+    return [_generated_listing(key, number, city) for number in numbers]
+
+
+def _search_key(city, category, query):
+    return f"{city}/{category}?{query}"
+
+
+def _blocked(request, next_url):
+    """
+    Returns: A response for a failed page load, a login wall if not logged in,
+    or None to serve the page.
+    """
+    roll = random.random()
+    if roll < settings.error_rate:
+        _count("errors")
+        return Response("Something went wrong", status_code=500)
+    roll -= settings.error_rate
+    logged_in = request.cookies.get(SESSION_COOKIE) is not None
+    if (settings.login_required and not logged_in) or roll < settings.login_wall_rate:
+        _count("login_walls")
+        return HTMLResponse(_login_page(next_url))
+    roll -= settings.login_wall_rate
+    if roll < settings.empty_rate:
+        _count("empty_pages")
+        return HTMLResponse(_page('<div id="feed"></div>'))
+    return None
+
+
+@app.get("/marketplace/{city}/{category}")
+async def feed(request: Request, city: str, category: str) -> Response:
+    """The first page of a search feed. More listings load as the page is scrolled."""
+    _count("feeds")
+    await _delay()
+    query = request.url.query
+    if blocked := _blocked(request, f"/marketplace/{city}/{category}?{query}"):
+        return blocked
+
+    key = _search_key(city, category, query)
+    head = _feed_heads.get(key, settings.pages * settings.page_size) + settings.new_per_load
+    _feed_heads[key] = head
+    listings = "".join(_feed_listings(key, city, 0, head))
+    next_url = html.escape(f"/mock/feed/{city}/{category}?{query}")
+    return HTMLResponse(_page(f'<div id="feed" data-next="{next_url}">{listings}</div>{FEED_SCRIPT}'))
+
+
+@app.get("/mock/feed/{city}/{category}")
+async def feed_page(request: Request, city: str, category: str, page: int) -> Response:
+    """Listing elements for one scroll page, or an empty body after the last page."""
+    _count("scrolls")
+    await _delay()
+    if random.random() < settings.error_rate:
+        _count("errors")
+        return Response(status_code=500)
+
+    # The feed script adds &page= to the search query.
+    query = request.url.query.rsplit("&page=", 1)[0]
+    key = _search_key(city, category, query)
+    head = _feed_heads.get(key, settings.pages * settings.page_size)
+    return HTMLResponse("".join(_feed_listings(key, city, page, head)))
+
+
+@app.get("/marketplace/item/{item_id}/")
+async def item(item_id: int) -> Response:
+    """An item page with the details read by enrich.py."""
+    _count("items")
+    await _delay()
+    return HTMLResponse(
+        "<!DOCTYPE html><html><head>"
+        f'<meta name="description" content="Description of mock item {item_id}.">'
+        f'<meta property="og:image" content="https://picsum.photos/seed/{item_id}/600/600">'
+        "</head><body><div role=\"main\">"
+        f'<a href="/marketplace/profile/{item_id % 1000}/">Seller {item_id % 1000}</a>'
+        "<span>Listed 3 days ago in Mock City</span>"
+        "</div></body></html>"
+    )
+
+
+@app.get("/login/device-based/regular/login/")
+async def login_page(next: str = "/marketplace/") -> Response:
+    return HTMLResponse(_login_page(next))
+
+
+@app.post("/mock/login")
+async def login(request: Request, next: str = "/marketplace/") -> Response:
+    """Accepts any email and password that are filled in."""
+    await _delay()
+    form = parse_qs((await request.body()).decode())
+    if not form.get("email") or not form.get("pass"):
+        _count("failed_logins")
+        return HTMLResponse(_login_page(next))
+
+    _count("logins")
+    response = RedirectResponse(next, status_code=303)
+    response.set_cookie(SESSION_COOKIE, os.urandom(8).hex())
+    return response
+
+
+@app.get("/mock/ip")
+async def ip_lookup(request: Request) -> JSONResponse:
+    """Stub IP lookup service, with the fields of ipinfo.io."""
+    _count("ip_lookups")
+    return JSONResponse({
+        "ip": request.client.host if request.client else "127.0.0.1",
+        "hostname": "localhost",
+        "city": "Calgary",
+        "region": "Alberta",
+        "country": "CA",
+        "loc": "51.0501,-114.0853",
+        "org": "AS0 Mock ISP",
+        "timezone": "America/Edmonton",
+    })
+
+
+@app.get("/mock/config")
+async def get_config() -> JSONResponse:
+    return JSONResponse(asdict(settings))
+
+
+@app.post("/mock/config")
+async def set_config(request: Request) -> JSONResponse:
+    """Change settings with query parameters, i.e. /mock/config?latency_ms=500&error_rate=0.1"""
+    updated = settings.update(request.query_params)
+    logger.info(f"Updated mock settings: {updated}")
+    return JSONResponse(asdict(settings))
+
+
+@app.get("/mock/stats")
+async def get_stats() -> JSONResponse:
+    """Returns: Requests served by kind, including failures."""
+    return JSONResponse({**stats, "recorded_listings": len(_recorded)})
+
+
+@app.post("/mock/reset")
+async def reset() -> JSONResponse:
+    """Clear the stats, and start every feed from its first listings again."""
+    stats.clear()
+    _feed_heads.clear()
+    return JSONResponse({})
+
+
+def load_recorded_pages(directory=MOCK_PAGES_DIR):
+    """
+    Reads the listing elements from the .html pages and .html.zst snapshots in directory.
+    Returns: The number of listings loaded.
+    """
+    from bs4 import BeautifulSoup
+
+    paths = sorted(glob.glob(os.path.join(directory, "*.html")) + glob.glob(os.path.join(directory, "*.html.zst")))
+    _recorded.clear()
+    for path in paths:
+        with open(path, "rb") as file:
+            content = file.read()
+        if path.endswith(".zst"):
+            import zstandard
+            content = zstandard.ZstdDecompressor().decompress(content)
+        soup = BeautifulSoup(content.decode("utf-8"), "html.parser")
+        _recorded.extend(str(listing) for listing in soup.find_all("div", class_=FBClassBullshit.LISTINGS.value))
+    if paths:
+        logger.info(f"Loaded {len(_recorded)} recorded listings from {len(paths)} pages in {directory}.")
+    return len(_recorded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the mock Marketplace server.")
+    parser.add_argument("--host", default=MOCK_HOST)
+    parser.add_argument("--port", type=int, default=MOCK_PORT)
+    parser.add_argument("--pages", default=MOCK_PAGES_DIR, help="Directory of recorded pages or snapshots")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    load_recorded_pages(args.pages)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
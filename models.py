@@ -1,16 +1,26 @@
 """Models and Constants"""
 
+import re
+
+from dataclasses import dataclass
+from datetime import datetime
 from enum import Enum
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+# Point crawls at another server, such as mock_marketplace.py, i.e. http://127.0.0.1:8100
+MARKETPLACE_BASE_URL = getenv("MARKETPLACE_BASE_URL", "https://www.facebook.com").rstrip("/")
 
-LOGIN_URL = "https://www.facebook.com/login/device-based/regular/login/"
+LOGIN_URL = MARKETPLACE_BASE_URL + "/login/device-based/regular/login/"
 
 # Params: City, Category, Query
 # Set City as "category" for generic (no city)
 # Set Category as "search" for any
 # Example Query: "query=iphone&sortBy=creation_time_descend"
-MARKETPLACE_URL = "https://www.facebook.com/marketplace/{0}/{1}?{2}"
+MARKETPLACE_URL = MARKETPLACE_BASE_URL + "/marketplace/{0}/{1}?{2}"
 
-CATEGORIES_URL = "https://www.facebook.com/marketplace/categories"
+CATEGORIES_URL = MARKETPLACE_BASE_URL + "/marketplace/categories"
 
 # For URL: replace(" ", "").lower()
 CATEGORIES = [
@@ -58,6 +68,94 @@ CONDITION = [
     "Used Fair"
 ]
 
+# Query params holding prices, and condition lists.
+_PRICE_PARAMS = ("minPrice", "maxPrice")
+_CONDITION_RANK = {condition.replace(" ", "_").lower(): i for i, condition in enumerate(CONDITION)}
+
+def _split_query(query):
+    """
+    Split an unencoded query string on "&" and the first "=" of each part, without
+    decoding "+" or "%", since the search text is as the user typed it.
+    A part without "=" is an "&" in the previous value, i.e. "query=AT&T phone".
+    Returns: A list of [key, value] pairs in order.
+    """
+    pairs = []
+    for part in (query or "").split("&"):
+        key, sep, value = part.partition("=")
+        if sep and key.strip():
+            pairs.append([key.strip(), value])
+        elif pairs:
+            pairs[-1][1] += "&" + part
+        elif part.strip():
+            pairs.append([part.strip(), ""])
+    return pairs
+
+def canonical_query(query):
+    """
+    Normalize a Marketplace query string, so searches that mean the same thing
+    share one key: params sorted by name, empty values and prices that are not
+    above 0 dropped, the search text lowercased with single spaces, and conditions
+    deduplicated in CONDITION order. Values are not decoded, and prices are kept
+    as given, so different searches never share a key.
+    Only use it as the key of a search. Crawl with the query as given.
+    Returns: The query string, unencoded like format_crawl_params builds it.
+    """
+    params = {}
+    for key, value in _split_query(query):
+        value = " ".join(value.split())
+        if key == "query":
+            value = value.lower()
+        elif key in _PRICE_PARAMS:
+            try:
+                if not float(value) > 0:
+                    continue
+            except ValueError:
+                continue
+        elif key == "itemCondition":
+            conditions = {part.strip().lower() for part in value.split(",") if part.strip()}
+            value = ",".join(sorted(conditions, key=lambda c: (_CONDITION_RANK.get(c, len(CONDITION)), c)))
+        if value != "":
+            params[key] = value
+    return "&".join(f"{key}={params[key]}" for key in sorted(params))
+
+def canonical_search(city, category, query):
+    """Returns: (city, category, query) normalized, the key of a search in the database."""
+    return (city or "").strip().lower(), (category or "").strip().lower(), canonical_query(query)
+
+_PRICE_NUMBER = re.compile(r"\d[\d,]*(?:\.\d+)?")
+
+def parse_price(price):
+    """
+    The amount of a listing's price text, i.e. "CA$1,200" is 1200.0 and "Free" is 0.0.
+    Discounted listings show the new price first, "CA$50CA$60", so the first amount is used.
+    Returns: The price as a float, or None if it has no amount.
+    """
+    if not price:
+        return None
+    if match := _PRICE_NUMBER.search(price):
+        return float(match.group().replace(",", ""))
+    return 0.0 if "free" in price.lower() else None
+
+@dataclass(slots=True)
+class ListingRecord:
+    """
+    A single listing, from parsing the page through to the API response.
+    Fields after is_new are only set once the listing is stored in the database.
+    Field order matches the columns selected by database.LISTING_COLUMNS.
+    """
+    url: str | None = None
+    title: str | None = None
+    price: str | None = None
+    location: str | None = None
+    image: str | None = None
+    is_new: bool = False
+    id: int | None = None
+    search_id: int | None = None
+    order: int | None = None
+    timestamp: datetime | None = None
+    deal_score: float | None = None
+
+
 class FBClassBullshit(Enum):
     """Where to find these elements in the HTML"""
 
@@ -78,3 +176,14 @@ class FBClassBullshit(Enum):
         "x1sur9pj xkrqix3 x1lku1pv"
     )
     LOCATION = "x1lliihq x6ikm8r x10wlt62 x1n2onr6 xlyipyv xuxw1ft x1j85h84"
+
+
+class FBDetailSelector(Enum):
+    """CSS selectors for the listing details on an item page"""
+
+    DESCRIPTION = 'meta[name="description"]'
+    IMAGE = 'meta[property="og:image"]'
+    GALLERY = 'div[role="main"] img[src*="scontent"]'
+    SELLER = 'a[href*="/marketplace/profile/"]'
+    # Matched against the page text, i.e. "Listed 3 days ago in Calgary, AB"
+    LISTED_AT = r"Listed (.+? ago)"
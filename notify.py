@@ -1,16 +1,22 @@
-import os, requests
+import os
 
 from dotenv import load_dotenv
 from logging import getLogger
 
+from price_stats import describe_deal
+
 load_dotenv()
 ntfy_server = os.getenv("NTFY_SERVER", "https://ntfy.sh")
+# Listings with at least this deal score are sent with high priority, i.e. 0.3 is 30% below median.
+DEAL_PRIORITY_SCORE = float(os.getenv("DEAL_PRIORITY_SCORE", 0.3))
 
 logger = getLogger(__name__)
 
 def send_ntfy(topic, message, title=None, priority=None, link=None, img=None):
     """Send a notification with ntfy."""
     if topic and message:
+        import requests  # Imported on first notification to keep GUI startup fast.
+
         ntfy_url = f'{ntfy_server}/{topic}'
         
         headers = {}
@@ -30,4 +36,23 @@ def send_ntfy(topic, message, title=None, priority=None, link=None, img=None):
         else:
             logger.error(f"Failed to send ntfy notification: {response.status_code} - {response.text}")
     else:
-        logger.warning("ntfy notification not sent. Topic and/or Message is empty.")
\ No newline at end of file
+        logger.warning("ntfy notification not sent. Topic and/or Message is empty.")
+
+def notify_listings(topic, listings, limit=None, more_text="View {} more in streamlit."):
+    """
+    Send a notification per listing (ListingRecord or dictionary), up to limit,
+    then one notification counting the rest. Listings with a deal score say how far
+    they are below the search's median price, and good deals are sent with high priority.
+    """
+    for listing in listings[:limit]:
+        get = listing.get if isinstance(listing, dict) else lambda field: getattr(listing, field, None)
+        title = f"New Listing: {get('price')}"
+        priority = None
+        if deal := describe_deal(score := get("deal_score")):
+            title += f" ({deal})"
+            if score >= DEAL_PRIORITY_SCORE:
+                priority = 4
+        send_ntfy(topic, f"{get('title')}", title, priority, link=get("url"), img=get("image"))
+
+    if limit is not None and len(listings) > limit:
+        send_ntfy(topic, more_text.format(len(listings) - limit), "Additional New Listings")
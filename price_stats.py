@@ -0,0 +1,120 @@
+"""
+Description: Mergeable price sketch for per search statistics, and deal scores of listings
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.0
+"""
+
+import json, math
+
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+# Relative error of the price quantiles. 0.01 means a median of $100 is reported as $99 to $101.
+PRICE_SKETCH_ACCURACY = float(getenv("PRICE_SKETCH_ACCURACY", 0.01))
+# Priced listings a search needs before its new listings get a deal score.
+DEAL_MIN_LISTINGS = int(getenv("DEAL_MIN_LISTINGS", 10))
+
+# Quantiles reported by the stats endpoint.
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+class PriceSketch:
+    """
+    Histogram of prices in buckets that grow by a constant factor, so any quantile
+    is within PRICE_SKETCH_ACCURACY of the true value whatever the price range.
+    Free listings have their own bucket. Sketches are merged by adding bucket counts,
+    so a crawl's new listings are added without reading the search's listings again.
+    """
+
+    def __init__(self, accuracy=PRICE_SKETCH_ACCURACY, buckets=None, zero_count=0):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = buckets or {}
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def add(self, price, count=1):
+        if price <= 0:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(price) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        """Add the counts of another sketch with the same accuracy."""
+        if other.accuracy != self.accuracy:
+            raise ValueError(f"Cannot merge sketches of accuracy {other.accuracy} and {self.accuracy}.")
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q):
+        """Returns: The price at quantile q (0 to 1), or None if the sketch is empty."""
+        count = self.count
+        if count == 0:
+            return None
+        rank = q * (count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # Middle of the bucket (gamma^(index-1), gamma^index], in relative terms.
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_json(self):
+        return json.dumps({
+            "accuracy": self.accuracy,
+            "zero": self.zero_count,
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        """Returns: The sketch stored by to_json, or an empty sketch for None."""
+        if not data:
+            return cls()
+        data = json.loads(data)
+        buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch = cls(data["accuracy"], buckets, data["zero"])
+        if sketch.accuracy != PRICE_SKETCH_ACCURACY:
+            # Re-bucket into the configured accuracy, at the accuracy of the old sketch.
+            rebucketed = cls()
+            rebucketed.zero_count = sketch.zero_count
+            for index, count in buckets.items():
+                rebucketed.add(2 * sketch.gamma ** index / (sketch.gamma + 1), count)
+            sketch = rebucketed
+        return sketch
+
+
+def deal_score(price, median):
+    """
+    How far a price is below the search's median price, i.e. 0.3 is 30% below
+    and -0.5 is 50% above. Free listings score 1.
+    Returns: The score rounded to 3 places, or None without a price or median.
+    """
+    if price is None or not median:
+        return None
+    return round((median - price) / median, 3)
+
+
+def describe_deal(score):
+    """Returns: The score as text for notifications, i.e. "30% below median", or None."""
+    if score is None:
+        return None
+    if score >= 1:
+        return "Free"
+    if score > 0:
+        return f"{score:.0%} below median"
+    if score < 0:
+        return f"{-score:.0%} above median"
+    return "At median"
@@ -0,0 +1,123 @@
+"""
+Description: orjson backed API responses with optional compression
+Date Created: 2026-10-18
+Date Modified: 2026-10-18
+Author: SPolton
+Version: 1.1.0
+"""
+
+import gzip, orjson
+
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from os import getenv
+from dotenv import load_dotenv
+from fastapi import Request
+from fastapi.responses import Response
+
+# brotli is optional. Without it, large responses are compressed with gzip.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+# Bodies smaller than this are sent uncompressed.
+COMPRESS_MIN_BYTES = int(getenv("COMPRESS_MIN_BYTES", 16384))
+COMPRESS_LEVEL = int(getenv("COMPRESS_LEVEL", 5))
+
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Pick the content encoding for a response from the Accept-Encoding header.
+    Returns: "br", "gzip" or None.
+    """
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = params.replace(" ", "").partition("q=")[2]
+        try:
+            if quality and float(quality) == 0:
+                continue  # Explicitly refused
+        except ValueError:
+            pass
+        accepted.add(coding.strip())
+
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CompactJSONResponse(Response):
+    """
+    JSON response rendered with orjson. Dataclasses such as ListingRecord and
+    datetimes are serialized directly, with naive datetimes treated as UTC.
+    If an encoding is given, bodies of at least COMPRESS_MIN_BYTES are compressed.
+    """
+    media_type = "application/json"
+
+    def __init__(self, content, status_code=200, headers=None, encoding=None, **kwargs):
+        self.encoding = encoding
+        self.content_encoding = None
+        super().__init__(content, status_code, headers, **kwargs)
+        if self.content_encoding:
+            self.headers["content-encoding"] = self.content_encoding
+            self.headers["vary"] = "Accept-Encoding"
+
+    def render(self, content) -> bytes:
+        body = orjson.dumps(content, option=ORJSON_OPTIONS)
+        if self.encoding and len(body) >= COMPRESS_MIN_BYTES:
+            if self.encoding == "br":
+                body = brotli.compress(body, quality=COMPRESS_LEVEL)
+            else:
+                body = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+            self.content_encoding = self.encoding
+        return body
+
+
+def json_response(request: Request, content, status_code=200, headers=None):
+    """Returns: A CompactJSONResponse compressed according to the request's Accept-Encoding."""
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    return CompactJSONResponse(content, status_code, headers, encoding=encoding)
+
+
+def cache_validators(key, changed):
+    """
+    ETag and Last-Modified headers for a resource that last changed at changed (naive UTC).
+    The ETag is weak, since the body may be sent compressed or not.
+    Cache-Control no-cache makes clients revalidate on every use.
+    Returns: A dictionary of headers.
+    """
+    changed = changed.replace(tzinfo=timezone.utc)
+    version = int(changed.timestamp() * 1_000_000)
+    return {
+        "ETag": f'W/"{key}-{version:x}"',
+        "Last-Modified": format_datetime(changed, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+
+def is_not_modified(request: Request, validators):
+    """
+    Compare the request's If-None-Match, or If-Modified-Since if there is none,
+    with the validators from cache_validators.
+    Returns: True if the client's copy is current and a 304 can be sent.
+    """
+    if if_none_match := request.headers.get("if-none-match"):
+        etag = validators["ETag"].removeprefix("W/")
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+
+    if if_modified_since := request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return parsedate_to_datetime(validators["Last-Modified"]) <= since
+    return False
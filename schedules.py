@@ -0,0 +1,161 @@
+"""
+Description: Recurring crawls stored in the database, queued as jobs by a thread in the API
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.2.1
+"""
+
+import threading
+
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from database import get_engine, get_or_insert_search_criteria, Schedule, SearchCriteria
+from jobs import enqueue_job
+
+load_dotenv()
+# Shortest interval between scheduled crawls of a search, in seconds.
+SCHEDULE_MIN_INTERVAL = int(getenv("SCHEDULE_MIN_INTERVAL", 5))
+# Seconds between checks for due schedules.
+SCHEDULE_TICK = float(getenv("SCHEDULE_TICK", 1))
+
+logger = getLogger(__name__)
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _schedule_dict(schedule, search):
+    return {
+        "id": schedule.id,
+        "search_id": schedule.search_id,
+        "city": search.city,
+        "category": search.category,
+        "query": search.query,
+        "interval_seconds": schedule.interval_seconds,
+        "incremental": schedule.incremental,
+        "next_run_at": schedule.next_run_at,
+        "last_enqueued_at": schedule.last_enqueued_at,
+    }
+
+
+def set_schedule(city, category, query, interval_seconds, incremental=False, run_now=True):
+    """
+    Crawl a search every interval_seconds, starting now if run_now. A search has one
+    schedule, so scheduling it again changes the interval.
+    Returns: The schedule as a dictionary, including its search_id.
+    """
+    interval_seconds = max(int(interval_seconds), SCHEDULE_MIN_INTERVAL)
+    search_id = get_or_insert_search_criteria(city, category, query)
+    now = _now()
+    with Session(get_engine()) as session:
+        schedule = session.scalar(select(Schedule).where(Schedule.search_id == search_id))
+        if schedule is None:
+            schedule = Schedule(search_id=search_id, created_at=now)
+            session.add(schedule)
+        schedule.interval_seconds = interval_seconds
+        schedule.incremental = incremental
+        schedule.next_run_at = now if run_now else now + timedelta(seconds=interval_seconds)
+        session.commit()
+        logger.info(f"Search {search_id} scheduled every {interval_seconds} seconds.")
+        return _schedule_dict(schedule, session.get(SearchCriteria, search_id))
+
+
+def delete_schedule(schedule_id):
+    """Returns: True if the schedule existed."""
+    with Session(get_engine()) as session:
+        schedule = session.get(Schedule, schedule_id)
+        if schedule is None:
+            return False
+        session.delete(schedule)
+        session.commit()
+        logger.info(f"Deleted schedule {schedule_id}.")
+        return True
+
+
+def get_schedule(search_id):
+    """Returns: The schedule of a search as a dictionary, or None."""
+    with Session(get_engine()) as session:
+        row = session.execute(
+            select(Schedule, SearchCriteria)
+            .join(SearchCriteria, SearchCriteria.id == Schedule.search_id)
+            .where(Schedule.search_id == search_id)
+        ).first()
+        return _schedule_dict(*row) if row else None
+
+
+def get_schedules():
+    """Returns: All schedules as dictionaries, soonest first."""
+    with Session(get_engine()) as session:
+        rows = session.execute(
+            select(Schedule, SearchCriteria)
+            .join(SearchCriteria, SearchCriteria.id == Schedule.search_id)
+            .order_by(Schedule.next_run_at)
+        )
+        return [_schedule_dict(schedule, search) for schedule, search in rows]
+
+
+def enqueue_due_schedules(now=None, stretch=1):
+    """
+    Queue a crawl job for each schedule that is due, and set its next run
+    interval_seconds * stretch later. A schedule is only queued if its next_run_at
+    is unchanged when updated, so several API processes can run this at once.
+    Returns: The number of jobs queued.
+    """
+    now = now or _now()
+    queued = 0
+    with Session(get_engine()) as session:
+        due = session.execute(
+            select(Schedule, SearchCriteria)
+            .join(SearchCriteria, SearchCriteria.id == Schedule.search_id)
+            .where(Schedule.next_run_at <= now)
+        ).all()
+        for schedule, search in due:
+            claimed = session.execute(
+                update(Schedule)
+                .where(Schedule.id == schedule.id, Schedule.next_run_at == schedule.next_run_at)
+                .values(
+                    next_run_at = now + timedelta(seconds=schedule.interval_seconds * stretch),
+                    last_enqueued_at = now,
+                )
+            ).rowcount
+            session.commit()
+            if claimed:
+                enqueue_job(search.city, search.category, search.crawl_query or search.query, schedule.incremental)
+                queued += 1
+    return queued
+
+
+class ScheduleRunner:
+    """
+    Queues due schedules every tick seconds on a daemon thread.
+    Intervals are multiplied by stretch(), such as the crawl governor's backoff factor.
+    """
+
+    def __init__(self, tick=SCHEDULE_TICK, stretch=lambda: 1):
+        self.tick = tick
+        self.stretch = stretch
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="schedules", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.tick):
+            try:
+                enqueue_due_schedules(stretch=self.stretch())
+            except Exception as e:
+                logger.error(f"Queueing scheduled crawls failed: {e}", exc_info=True)
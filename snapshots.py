@@ -0,0 +1,229 @@
+"""
+Description: zstd compressed store of crawled pages, indexed by search and time, for offline re-parsing
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.2.2
+"""
+
+import os, time, uuid
+
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+from database import get_engine, to_db_time, Snapshot
+
+load_dotenv()
+# off: no snapshots, page: the full page HTML, feed: only the main element with the feed.
+# Pages that fail to parse are stored whatever the mode, so the selectors can be fixed later.
+SNAPSHOT_MODE = getenv("SNAPSHOT_MODE", "off").lower()
+SNAPSHOT_DIR = getenv("SNAPSHOT_DIR", "static/snapshots")
+# Oldest snapshots are deleted once the store is larger than this.
+SNAPSHOT_MAX_MB = float(getenv("SNAPSHOT_MAX_MB", 200))
+# Days snapshots are kept by maintenance. 0 keeps them until the size cap.
+SNAPSHOT_RETENTION_DAYS = int(getenv("SNAPSHOT_RETENTION_DAYS", 30))
+SNAPSHOT_LEVEL = int(getenv("SNAPSHOT_LEVEL", 10))
+# A page failed to parse when no listing parsed, or less than this share of its listing elements did.
+# Placeholders and ads without a link are common, so a few misses are not a failure.
+SNAPSHOT_FAILED_PARSE_RATIO = float(getenv("SNAPSHOT_FAILED_PARSE_RATIO", 0.5))
+
+SNAPSHOT_MODES = ("off", "page", "feed")
+# Stored only the elements matching FBClassBullshit.LISTINGS, which is nothing once the classes change.
+_DEPRECATED_MODES = {"listings": "feed"}
+# Mode of the snapshots of pages that failed to parse.
+FAILED = "failed"
+
+logger = getLogger(__name__)
+
+
+def snapshot_mode():
+    """Returns: SNAPSHOT_MODE, with deprecated modes replaced and unknown modes as off."""
+    if SNAPSHOT_MODE in _DEPRECATED_MODES:
+        return _DEPRECATED_MODES[SNAPSHOT_MODE]
+    if SNAPSHOT_MODE not in SNAPSHOT_MODES:
+        logger.warning(f"Unknown SNAPSHOT_MODE '{SNAPSHOT_MODE}'. Snapshots are off.")
+        return "off"
+    return SNAPSHOT_MODE
+
+
+def snapshots_enabled():
+    return snapshot_mode() != "off"
+
+
+def feed_html(html):
+    """
+    Returns: The page's main element, which holds the feed whatever its class names,
+    or the whole page if it has none.
+    """
+    from bs4 import BeautifulSoup
+
+    main = BeautifulSoup(html, "html.parser").find(attrs={"role": "main"})
+    return str(main) if main is not None else html
+
+
+def parse_failed(parsed_count, element_count):
+    """Returns: True if a page parsed too few of its listing elements, see SNAPSHOT_FAILED_PARSE_RATIO."""
+    return parsed_count == 0 or parsed_count < element_count * SNAPSHOT_FAILED_PARSE_RATIO
+
+
+def save_snapshot(city, category, query, html, listing_count, failed=False):
+    """
+    Compress and store the page (or its feed, depending on SNAPSHOT_MODE), then delete
+    the oldest snapshots if the store is over SNAPSHOT_MAX_MB. A page that failed to parse
+    is stored even with snapshots off, with the mode "failed".
+    Returns: The snapshot id, or None if not stored or saving failed.
+    """
+    mode = snapshot_mode()
+    if mode == "off" and not failed:
+        return None
+
+    import zstandard
+
+    content = html if mode == "page" else feed_html(html)
+    raw = content.encode("utf-8")
+    compressed = zstandard.ZstdCompressor(level=SNAPSHOT_LEVEL).compress(raw)
+
+    now = datetime.now(timezone.utc)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, f"{now:%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.html.zst")
+
+    try:
+        with open(path, "wb") as file:
+            file.write(compressed)
+
+        with Session(get_engine()) as session:
+            snapshot = Snapshot(
+                city = city,
+                category = category,
+                query = query,
+                timestamp = now.replace(tzinfo=None),
+                mode = FAILED if failed else mode,
+                path = path,
+                raw_bytes = len(raw),
+                stored_bytes = len(compressed),
+                listing_count = listing_count,
+            )
+            session.add(snapshot)
+            session.commit()
+            snapshot_id = snapshot.id
+            _enforce_size_cap(session, keep_id=snapshot_id)
+
+        logger.info(f"Saved {'failed page ' if failed else ''}snapshot {snapshot_id}: {len(raw)} -> {len(compressed)} bytes.")
+        return snapshot_id
+    except Exception as e:
+        logger.error(f"An error occurred while saving a snapshot: {e}")
+        return None
+
+
+def _enforce_size_cap(session, keep_id):
+    """
+    Delete the oldest snapshots until the store fits in SNAPSHOT_MAX_MB.
+    The snapshot keep_id, just saved, is never deleted. Files are removed once the delete is committed.
+    """
+    max_bytes = SNAPSHOT_MAX_MB * 1024 * 1024
+    total = session.execute(select(func.coalesce(func.sum(Snapshot.stored_bytes), 0))).scalar()
+    if total <= max_bytes:
+        return
+
+    expired, paths = [], []
+    oldest_first = (
+        select(Snapshot.id, Snapshot.path, Snapshot.stored_bytes)
+        .where(Snapshot.id != keep_id)
+        .order_by(Snapshot.timestamp, Snapshot.id)
+    )
+    for snapshot_id, path, stored_bytes in session.execute(oldest_first):
+        if total <= max_bytes:
+            break
+        expired.append(snapshot_id)
+        paths.append(path)
+        total -= stored_bytes
+
+    session.execute(delete(Snapshot).where(Snapshot.id.in_(expired)))
+    session.commit()
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    logger.info(f"Deleted {len(expired)} old snapshots to stay under {SNAPSHOT_MAX_MB} MB.")
+
+
+def expire_snapshots(session, now):
+    """
+    Delete the index rows of snapshots older than SNAPSHOT_RETENTION_DAYS, and of those whose
+    file is gone. Snapshots are not tied to a search, since crawls that never store a search,
+    such as failed pages, are the ones worth keeping. Does not commit.
+    Returns: The paths of the deleted snapshots, to pass to remove_snapshot_files once committed.
+    """
+    expired = []
+    rows = session.execute(select(Snapshot.id, Snapshot.path, Snapshot.timestamp))
+    for snapshot_id, path, timestamp in rows:
+        too_old = SNAPSHOT_RETENTION_DAYS > 0 and timestamp < now - timedelta(days=SNAPSHOT_RETENTION_DAYS)
+        if too_old or not os.path.exists(path):
+            expired.append((snapshot_id, path))
+    if expired:
+        session.execute(delete(Snapshot).where(Snapshot.id.in_([snapshot_id for snapshot_id, _ in expired])))
+    return [path for _, path in expired]
+
+
+def remove_snapshot_files(paths):
+    """
+    Remove the files of snapshots whose rows were deleted, after the delete is committed,
+    so a rollback never leaves rows without files. Also removes files in SNAPSHOT_DIR that
+    are not in the index, once they are an hour old, such as files left by a failed save.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    if os.path.isdir(SNAPSHOT_DIR):
+        with Session(get_engine()) as session:
+            indexed = {os.path.abspath(path) for path in session.scalars(select(Snapshot.path))}
+        for entry in os.scandir(SNAPSHOT_DIR):
+            if (entry.name.endswith(".zst") and os.path.abspath(entry.path) not in indexed
+                    and entry.stat().st_mtime < time.time() - 3600):
+                os.remove(entry.path)
+
+
+def find_snapshots(city=None, category=None, query=None, since=None, until=None, limit=100):
+    """
+    Returns: A list of snapshot index entries as dictionaries, newest first,
+    filtered by search and time (since inclusive, until exclusive).
+    """
+    stmt = select(
+        Snapshot.id, Snapshot.city, Snapshot.category, Snapshot.query, Snapshot.timestamp,
+        Snapshot.mode, Snapshot.raw_bytes, Snapshot.stored_bytes, Snapshot.listing_count
+    )
+    for column, value in ((Snapshot.city, city), (Snapshot.category, category), (Snapshot.query, query)):
+        if value is not None:
+            stmt = stmt.where(column == value)
+    if since is not None:
+        stmt = stmt.where(Snapshot.timestamp >= to_db_time(since))
+    if until is not None:
+        stmt = stmt.where(Snapshot.timestamp < to_db_time(until))
+    stmt = stmt.order_by(Snapshot.timestamp.desc(), Snapshot.id.desc()).limit(limit)
+
+    with Session(get_engine()) as session:
+        return [row._asdict() for row in session.execute(stmt)]
+
+
+def load_snapshot(snapshot_id):
+    """
+    Returns: The decompressed HTML of a snapshot.
+    Throws: KeyError if the snapshot does not exist, FileNotFoundError if its file is gone.
+    """
+    import zstandard
+
+    with Session(get_engine()) as session:
+        path = session.execute(select(Snapshot.path).where(Snapshot.id == snapshot_id)).scalar()
+    if path is None:
+        raise KeyError(snapshot_id)
+    with open(path, "rb") as file:
+        return zstandard.ZstdDecompressor().decompress(file.read()).decode("utf-8")
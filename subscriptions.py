@@ -0,0 +1,162 @@
+"""
+Description: Subscriptions of users or topics to canonical searches, with one crawl schedule and fanned out notifications
+Date Created: 2026-10-19
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.0.1
+"""
+
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from os import getenv
+from dotenv import load_dotenv
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from database import get_engine, get_or_insert_search_criteria, Schedule, SearchCriteria, Subscription
+from notify import notify_listings
+from schedules import get_schedule, set_schedule, SCHEDULE_MIN_INTERVAL
+
+load_dotenv()
+# New listings sent as separate notifications per crawl. The rest are summed up in one.
+SUBSCRIPTION_NOTIFY_LIMIT = int(getenv("SUBSCRIPTION_NOTIFY_LIMIT", 2))
+
+logger = getLogger(__name__)
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _subscription_dict(subscription, search):
+    return {
+        "id": subscription.id,
+        "search_id": subscription.search_id,
+        "subscriber": subscription.subscriber,
+        "ntfy_topic": subscription.ntfy_topic,
+        "interval_seconds": subscription.interval_seconds,
+        "city": search.city,
+        "category": search.category,
+        "query": search.query,
+    }
+
+
+def _sync_schedule(session, search, incremental, had_interval):
+    """
+    Crawl the search at the shortest interval any subscriber asked for. A new schedule runs
+    now. An existing schedule keeps its next run unless the new interval is due sooner,
+    so a new subscriber does not cause an extra crawl. If no subscriber wants an interval any more, the schedule
+    is removed, unless it was not made by a subscription (had_interval is False).
+    Returns: The schedule as a dictionary, or None.
+    """
+    interval = session.scalar(
+        select(func.min(Subscription.interval_seconds))
+        .where(Subscription.search_id == search.id, Subscription.interval_seconds.is_not(None))
+    )
+    schedule = session.scalar(select(Schedule).where(Schedule.search_id == search.id))
+    if interval is None:
+        if schedule is not None and had_interval:
+            session.delete(schedule)
+            session.commit()
+            logger.info(f"Search {search.id} has no scheduled subscribers. Removed its schedule.")
+        return None
+    if schedule is None:
+        return set_schedule(search.city, search.category, search.crawl_query or search.query, interval, incremental)
+
+    interval = max(interval, SCHEDULE_MIN_INTERVAL)
+    if schedule.interval_seconds != interval or schedule.incremental != incremental:
+        schedule.next_run_at = min(schedule.next_run_at, _now() + timedelta(seconds=interval))
+        schedule.interval_seconds = interval
+        schedule.incremental = incremental
+        session.commit()
+        logger.info(f"Search {search.id} now scheduled every {interval} seconds.")
+    return get_schedule(search.id)
+
+
+def subscribe(city, category, query, subscriber, interval_seconds=None, ntfy_topic=None, incremental=False):
+    """
+    Follow a search. The search is keyed canonically, so equivalent filters from
+    any number of subscribers share one search, one crawl per interval and one set of results.
+    Subscribing again with the same subscriber changes the interval and topic.
+    Returns: The subscription as a dictionary, with its search_id and schedule.
+    """
+    search_id = get_or_insert_search_criteria(city, category, query)
+    with Session(get_engine()) as session:
+        subscription = session.scalar(
+            select(Subscription).where(Subscription.search_id == search_id, Subscription.subscriber == subscriber)
+        )
+        if subscription is None:
+            subscription = Subscription(
+                search_id = search_id,
+                subscriber = subscriber,
+                created_at = _now(),
+            )
+            session.add(subscription)
+        had_interval = subscription.interval_seconds is not None
+        subscription.interval_seconds = interval_seconds
+        subscription.ntfy_topic = ntfy_topic or None
+        session.commit()
+
+        search = session.get(SearchCriteria, search_id)
+        result = _subscription_dict(subscription, search)
+        result["schedule"] = _sync_schedule(session, search, incremental, had_interval or interval_seconds is not None)
+    logger.info(f"{subscriber} subscribed to search {search_id}.")
+    return result
+
+
+def unsubscribe(subscription_id):
+    """Returns: True if the subscription existed."""
+    with Session(get_engine()) as session:
+        subscription = session.get(Subscription, subscription_id)
+        if subscription is None:
+            return False
+        search = session.get(SearchCriteria, subscription.search_id)
+        had_interval = subscription.interval_seconds is not None
+        session.delete(subscription)
+        session.commit()
+        if search is not None:
+            schedule = session.scalar(select(Schedule).where(Schedule.search_id == search.id))
+            incremental = schedule.incremental if schedule is not None else False
+            _sync_schedule(session, search, incremental, had_interval)
+        logger.info(f"Deleted subscription {subscription_id}.")
+        return True
+
+
+def get_subscriptions(search_id=None):
+    """Returns: All subscriptions, or those of one search, as dictionaries."""
+    with Session(get_engine()) as session:
+        stmt = (
+            select(Subscription, SearchCriteria)
+            .join(SearchCriteria, SearchCriteria.id == Subscription.search_id)
+            .order_by(Subscription.search_id, Subscription.id)
+        )
+        if search_id is not None:
+            stmt = stmt.where(Subscription.search_id == search_id)
+        return [_subscription_dict(subscription, search) for subscription, search in session.execute(stmt)]
+
+
+def notify_subscribers(search_id, listings, limit=SUBSCRIPTION_NOTIFY_LIMIT):
+    """
+    Send the new listings of a crawl to every ntfy topic subscribed to the search,
+    once per topic however many subscribers share it. A failed topic does not stop the others.
+    Returns: The number of topics notified.
+    """
+    if not listings:
+        return 0
+    with Session(get_engine()) as session:
+        topics = session.scalars(
+            select(Subscription.ntfy_topic)
+            .where(Subscription.search_id == search_id, Subscription.ntfy_topic.is_not(None))
+            .distinct()
+        ).all()
+
+    notified = 0
+    for topic in topics:
+        try:
+            notify_listings(topic, listings, limit)
+            notified += 1
+        except Exception as e:
+            logger.error(f"Notifying {topic} of search {search_id} failed: {e}")
+    return notified
+
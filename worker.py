@@ -0,0 +1,149 @@
+"""
+Description: Crawl workers that claim jobs from the database queue
+Date Created: 2026-10-18
+Date Modified: 2026-10-19
+Author: SPolton
+Version: 1.4.1
+Usage: python worker.py --workers 4
+"""
+
+import argparse, logging, multiprocessing, os, socket, threading
+
+from jobs import claim_job, complete_job, defer_job, fail_job, heartbeat, JobDeferred, JOB_LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before polling again when the queue is empty.
+POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", 2))
+
+
+def crawl_job(job, crawl=None):
+    """
+    Default job handler: crawl the search, apply the results to the database diff
+    and notify the search's subscribers and matching alert rules of new listings.
+    crawl defaults to app.run_crawl, so crawls in worker.py processes also take
+    from the crawl budget shared through the database.
+    Returns: A dictionary with search_id, result_count and new_count.
+    """
+    from app import run_crawl, INCREMENTAL_STOP_AFTER
+    from database import apply_crawl_results, get_or_insert_search_criteria, get_result_urls
+    from alerts import notify_alerts
+    from subscriptions import notify_subscribers
+
+    crawl = crawl or run_crawl
+    city, category, query = job["city"], job["category"], job["query"]
+    if category == "test":
+        results = crawl(city, category, job["crawl_query"] or query)
+        return {"search_id": None, "result_count": len(results), "new_count": 0}
+
+    search_id = get_or_insert_search_criteria(city, category, query)
+    known_urls = get_result_urls(search_id) if job["incremental"] else None
+    results = crawl(city, category, job["crawl_query"] or query, known_urls, INCREMENTAL_STOP_AFTER)
+
+    new_results = []
+    if results:
+        new_results, _ = apply_crawl_results(search_id, results, job["incremental"])
+        notify_subscribers(search_id, new_results)
+        notify_alerts(new_results)
+    return {"search_id": search_id, "result_count": len(results), "new_count": len(new_results)}
+
+
+class Worker:
+    """Claims jobs one at a time and runs handler(job), sending heartbeats while it runs."""
+
+    def __init__(self, worker_id=None, handler=crawl_job, lease_seconds=JOB_LEASE_SECONDS,
+                 poll_interval=POLL_INTERVAL):
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.handler = handler
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+
+    def _heartbeat_loop(self, job_id, done):
+        while not done.wait(self.lease_seconds / 3):
+            if not heartbeat(job_id, self.worker_id, self.lease_seconds):
+                logger.warning(f"Worker {self.worker_id} lost the lease on job {job_id}.")
+                return
+
+    def run_one(self):
+        """
+        Claim and run a single job.
+        Returns: False if no job was available.
+        """
+        job = claim_job(self.worker_id, self.lease_seconds)
+        if job is None:
+            return False
+
+        done = threading.Event()
+        beat = threading.Thread(target=self._heartbeat_loop, args=(job["id"], done), daemon=True)
+        beat.start()
+        try:
+            result = self.handler(job) or {}
+            complete_job(job["id"], self.worker_id, **result)
+            logger.info(f"Worker {self.worker_id} finished job {job['id']}.")
+        except JobDeferred as e:
+            logger.info(f"Worker {self.worker_id} deferred job {job['id']} by {e.retry_after:.0f} seconds: {e}")
+            defer_job(job["id"], self.worker_id, e.retry_after, str(e))
+        except Exception as e:
+            logger.error(f"Worker {self.worker_id} failed job {job['id']}: {e}", exc_info=True)
+            fail_job(job["id"], self.worker_id, e)
+        finally:
+            done.set()
+            beat.join()
+        return True
+
+    def run(self, exit_when_idle=False):
+        """Process jobs until stopped, or until the queue is empty if exit_when_idle."""
+        logger.info(f"Worker {self.worker_id} started.")
+        while not self.stop_event.is_set():
+            if not self.run_one():
+                if exit_when_idle:
+                    break
+                self.stop_event.wait(self.poll_interval)
+        logger.info(f"Worker {self.worker_id} stopped.")
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def run_worker_process(worker_id=None, handler=crawl_job, exit_when_idle=False, poll_interval=POLL_INTERVAL):
+    """Entry point for a worker process."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    Worker(worker_id, handler, poll_interval=poll_interval).run(exit_when_idle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run crawl workers for the job queue.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes on this machine")
+    parser.add_argument("--exit-when-idle", action="store_true", help="Stop once the queue is empty")
+    args = parser.parse_args()
+
+    from database import init_db, get_engine
+    init_db()
+    # Connections must not be shared with the forked worker processes.
+    get_engine().dispose()
+
+    host = socket.gethostname()
+    processes = [
+        multiprocessing.Process(
+            target=run_worker_process,
+            args=(f"{host}-{os.getpid()}-{i}", crawl_job, args.exit_when_idle),
+            name=f"worker-{i}"
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()